@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Chunker Throughput Benchmark
+
+Times the offset-based chunker in build_index.py (split_paragraphs +
+chunk_spans, strings built only for the emitted chunks) against the
+original implementation, which normalised the whole text with two
+re.sub passes, split it into paragraph strings and tried every section
+marker separately on each paragraph. Both must produce identical chunks;
+any difference is reported and makes the script exit non-zero.
+
+Documents are large synthetic papers (section headers, layout-style space
+runs, blank-line runs) and, with --pdf_dir, the extracted text of real
+PDFs such as sample_docs/.
+
+Usage:
+    python bench_chunker.py
+    python bench_chunker.py --pdf_dir ../sample_docs --doc_chars 2000000
+    python bench_chunker.py --json
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import argparse
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from build_index import SECTION_MARKERS, chunk_text, extract_text
+
+
+# ── Original chunker (reference) ─────────────────────────────────────────────
+
+def legacy_is_section_header(line: str) -> bool:
+    line_lower = line.strip().lower()
+    return any(re.match(p, line_lower, re.I) for p in SECTION_MARKERS)
+
+
+def legacy_chunk_text(text: str, target_tokens: int = 800,
+                      overlap_tokens: int = 100,
+                      min_tokens: int = 200) -> List[Dict]:
+    """chunk_text as it was before the offset-based rewrite."""
+    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = re.sub(r'[ \t]+', ' ', text)
+    paragraphs = text.split('\n\n')
+
+    chunks: List[Dict] = []
+    current_paras: List[str] = []
+    current_tokens = 0
+    current_section = "document"
+    chunk_id = 0
+
+    def _flush():
+        nonlocal chunk_id, current_paras, current_tokens
+        if current_tokens < min_tokens // 2:
+            return
+        chunk_text_str = '\n\n'.join(current_paras)
+        chunks.append({
+            'chunk_id': chunk_id,
+            'text': chunk_text_str,
+            'section': current_section,
+            'char_count': len(chunk_text_str),
+            'token_estimate': len(chunk_text_str) // 4,
+        })
+        chunk_id += 1
+
+        overlap_paras: List[str] = []
+        overlap_size = 0
+        for p in reversed(current_paras):
+            p_tok = len(p) // 4
+            if overlap_size + p_tok <= overlap_tokens:
+                overlap_paras.insert(0, p)
+                overlap_size += p_tok
+            else:
+                break
+        current_paras = overlap_paras
+        current_tokens = overlap_size
+
+    for para in paragraphs:
+        para = para.strip()
+        if not para:
+            continue
+
+        para_tokens = len(para) // 4
+        first_line = para.split('\n')[0] if '\n' in para else para
+
+        if legacy_is_section_header(first_line):
+            if current_tokens >= min_tokens:
+                _flush()
+            current_section = first_line.strip()
+
+        current_paras.append(para)
+        current_tokens += para_tokens
+
+        if current_tokens >= target_tokens:
+            _flush()
+
+    _flush()
+    return chunks
+
+
+# ── Documents ────────────────────────────────────────────────────────────────
+
+HEADERS = ['Abstract', 'INTRODUCTION', 'Background', 'Literature  Review',
+           'Data and Methods', 'Empirical\tStrategy', 'Results', 'Discussion',
+           '4.  Robustness checks', 'Policy Implications', 'Conclusion',
+           'References', 'Appendix A: Tables']
+WORDS = ('labor market wage employment policy regional fiscal municipal '
+         'education outcomes cohort estimate effect significant panel '
+         'institutional governance variation sample coefficient').split()
+
+
+def synthetic_document(n_chars: int, seed: int) -> str:
+    """pdftotext -layout style text of roughly *n_chars* characters."""
+    rng = random.Random(seed)
+    parts: List[str] = []
+    size = 0
+    while size < n_chars:
+        if rng.random() < 0.08:
+            block = f"{' ' * rng.randint(0, 8)}{rng.choice(HEADERS)}"
+        else:
+            lines = []
+            for _ in range(rng.randint(1, 12)):
+                words = rng.choices(WORDS, k=rng.randint(4, 14))
+                gap = ' ' * rng.choice([1, 1, 1, 2, 3, 6])
+                lines.append(' ' * rng.choice([0, 0, 2, 4])
+                             + gap.join(words) + rng.choice(['', ' ', '\t']))
+            block = '\n'.join(lines)
+        parts.append(block)
+        parts.append('\n' * rng.choice([2, 2, 2, 3, 4]) +
+                     ('\x0c' if rng.random() < 0.02 else ''))
+        size += len(block) + 3
+    return ''.join(parts)
+
+
+def load_documents(args) -> List[Tuple[str, str]]:
+    docs = [(f"synthetic-{i}", synthetic_document(args.doc_chars, seed=i))
+            for i in range(args.docs)]
+    if args.pdf_dir:
+        for pdf in sorted(Path(args.pdf_dir).glob('*.pdf')):
+            text, _ = extract_text(pdf)
+            if text:
+                docs.append((pdf.name, text))
+    return docs
+
+
+# ── Benchmark ────────────────────────────────────────────────────────────────
+
+def time_chunker(chunker, docs: List[Tuple[str, str]], repeat: int,
+                 params: Tuple[int, int, int]) -> Dict:
+    """Best-of-*repeat* time to chunk every document."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _, text in docs:
+            chunker(text, *params)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    chars = sum(len(text) for _, text in docs)
+    return {'seconds': round(best, 4),
+            'chars_per_sec': round(chars / best) if best else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the offset-based chunker with the original.'
+    )
+    parser.add_argument('--docs', type=int, default=4,
+                        help='Synthetic documents to generate (default: 4)')
+    parser.add_argument('--doc_chars', type=int, default=1_000_000,
+                        help='Characters per synthetic document '
+                             '(default: 1000000)')
+    parser.add_argument('--pdf_dir',
+                        help='Also chunk the extracted text of these PDFs')
+    parser.add_argument('--chunk_target', type=int, default=800)
+    parser.add_argument('--chunk_overlap', type=int, default=100)
+    parser.add_argument('--chunk_min', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Timing runs per chunker; the best counts '
+                             '(default: 3)')
+    parser.add_argument('--json', action='store_true',
+                        help='Output results as JSON')
+    args = parser.parse_args()
+
+    docs = load_documents(args)
+    params = (args.chunk_target, args.chunk_overlap, args.chunk_min)
+
+    mismatched = [name for name, text in docs
+                  if chunk_text(text, *params) != legacy_chunk_text(text, *params)]
+    before = time_chunker(legacy_chunk_text, docs, args.repeat, params)
+    after = time_chunker(chunk_text, docs, args.repeat, params)
+    results = {
+        'documents': len(docs),
+        'chars': sum(len(text) for _, text in docs),
+        'chunks': sum(len(chunk_text(text, *params)) for _, text in docs),
+        'identical': not mismatched,
+        'mismatched': mismatched,
+        'before': before,
+        'after': after,
+        'speedup': round(before['seconds'] / after['seconds'], 2)
+                   if after['seconds'] else None,
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{results['documents']} documents, {results['chars']:,} chars, "
+              f"{results['chunks']:,} chunks")
+        print(f"  before : {before['chars_per_sec']:>14,} chars/sec  "
+              f"({before['seconds']}s)")
+        print(f"  after  : {after['chars_per_sec']:>14,} chars/sec  "
+              f"({after['seconds']}s)")
+        print(f"  speedup: {results['speedup']}x")
+        print(f"  output : {'identical' if not mismatched else 'DIFFERS'}")
+    if mismatched:
+        print(f"ERROR: chunks differ for {', '.join(mismatched)}",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Encoding Throughput Benchmark
+
+Compares the legacy fixed-count batching (BATCH_SIZE chunks per batch, in
+document order) with length-bucketed, token-budget batching on the chunks
+of an existing build. Reports chunks/sec and padding efficiency (real
+tokens / padded tokens) for each mode.
+
+With --scaling, instead measures multi-process CPU encoding at each given
+worker count and reports chunks/sec, speedup over one worker and parallel
+efficiency (speedup / workers). Every count, including 1, runs on the
+worker pool (MultiProcessEncoder), so the baseline is the same code path
+rather than the in-process encoder a 1-worker build would use. Each worker
+runs a fixed number of torch threads (--threads_per_worker, default 1), so
+the total thread count grows with the worker count.
+
+Usage:
+    # e5-large-v2 on CPU, first 2,000 chunks of a build
+    python bench_encode.py --chunks ./index/chunks.jsonl --device cpu --limit 2000
+
+    # Batching behaviour only, without model weights
+    python bench_encode.py --chunks ./index/chunks.jsonl --encoder stub
+
+    # Scaling of multi-process CPU encoding with 1, 2, 4 and 8 workers
+    python bench_encode.py --chunks ./index/chunks.jsonl --device cpu \
+        --scaling 1,2,4,8
+
+    # Machine-readable output
+    python bench_encode.py --chunks ./index/chunks.jsonl --device cpu --json
+"""
+
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+
+from encoders import (
+    MultiProcessEncoder, load_encoder, length_bucketed_batches, fixed_batches,
+    padding_efficiency,
+)
+
+
+def load_passages(chunks_path: Path, limit: int):
+    """Read up to *limit* chunk texts as prefixed passages."""
+    texts = []
+    with open(chunks_path) as f:
+        for line in f:
+            texts.append(f"passage: {json.loads(line)['text']}")
+            if limit and len(texts) >= limit:
+                break
+    return texts
+
+
+def run_mode(encoder, texts, lengths, bucketed: bool) -> dict:
+    """Encode *texts* once in the given batching mode and time it."""
+    encoder.bucketed = bucketed
+    if bucketed:
+        batches = length_bucketed_batches(lengths, encoder.batch_tokens)
+    else:
+        batches = fixed_batches(len(texts), encoder.batch_size)
+
+    started = time.perf_counter()
+    encoder.encode(texts)
+    elapsed = time.perf_counter() - started
+    return {
+        'mode': 'tokens' if bucketed else 'fixed',
+        'batches': len(batches),
+        'padding_efficiency': padding_efficiency(lengths, batches),
+        'seconds': round(elapsed, 3),
+        'chunks_per_sec': round(len(texts) / elapsed, 2) if elapsed else None,
+    }
+
+
+def run_scaling(args, texts) -> dict:
+    """Time multi-process encoding of *texts* at each worker count.
+
+    Every count uses the same threads per worker; with the encoder's
+    default (cores / workers) the total would stay constant and the
+    speedup would measure nothing. Speedup is relative to the per-worker
+    rate at the smallest count.
+    """
+    counts = sorted({int(n) for n in args.scaling.split(',')})
+    threads = args.threads_per_worker or 1
+    rows = []
+    for n in counts:
+        encoder = MultiProcessEncoder(args.encoder, n, threads=threads,
+                                      batch_tokens=args.batch_tokens)
+        try:
+            encoder.warmup(texts[:n * 2])  # every worker
+            started = time.perf_counter()
+            encoder.encode(texts)
+            elapsed = time.perf_counter() - started
+        finally:
+            encoder.close()
+        rows.append({'workers': n, 'threads_per_worker': threads,
+                     'seconds': round(elapsed, 3),
+                     'chunks_per_sec': round(len(texts) / elapsed, 2)})
+
+    base = rows[0]['chunks_per_sec'] / counts[0]
+    for row in rows:
+        row['speedup'] = round(row['chunks_per_sec'] / base, 2)
+        row['efficiency'] = round(row['speedup'] / row['workers'], 2)
+    return {'encoder': args.encoder, 'device': 'cpu', 'chunks': len(texts),
+            'scaling': rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare fixed-count and length-bucketed encoding.'
+    )
+    parser.add_argument('--chunks', required=True,
+                        help='Path to chunks.jsonl from build_index.py')
+    parser.add_argument('--encoder', choices=['e5', 'stub'], default='e5',
+                        help='Encoder to benchmark (default: e5)')
+    parser.add_argument('--device', choices=['auto', 'cuda', 'cpu'],
+                        default='auto', help='Encoding device (default: auto)')
+    parser.add_argument('--batch_size', type=int, default=1300,
+                        help='Chunks per batch in fixed mode (default: 1300)')
+    parser.add_argument('--batch_tokens', type=int,
+                        help='Padded-token budget in bucketed mode')
+    parser.add_argument('--scaling',
+                        help='Comma-separated CPU worker counts to measure '
+                             'multi-process scaling, e.g. 1,2,4,8')
+    parser.add_argument('--threads_per_worker', type=int,
+                        help='Torch threads per worker with --scaling, '
+                             'the same at every count (default: 1)')
+    parser.add_argument('--limit', type=int, default=0,
+                        help='Benchmark only the first N chunks')
+    parser.add_argument('--json', action='store_true',
+                        help='Output results as JSON')
+    args = parser.parse_args()
+
+    texts = load_passages(Path(args.chunks), args.limit)
+    if not texts:
+        print("ERROR: no chunks to encode", file=sys.stderr)
+        sys.exit(1)
+
+    if args.scaling:
+        results = run_scaling(args, texts)
+        if args.json:
+            print(json.dumps(results, indent=2))
+            return
+        print(f"Encoder : {results['encoder']} on cpu, "
+              f"{results['chunks']} chunks")
+        for row in results['scaling']:
+            print(f"  {row['workers']:3d} workers x "
+                  f"{row['threads_per_worker']} threads  "
+                  f"{row['chunks_per_sec']:10.2f} chunks/sec  "
+                  f"speedup {row['speedup']:.2f}x  "
+                  f"efficiency {row['efficiency']:.0%}")
+        return
+
+    encoder = load_encoder(args.encoder, args.device, args.batch_tokens,
+                           batch_size=args.batch_size)
+    lengths = encoder.token_lengths(texts)
+    encoder.warmup(texts[:8])  # kernels and weights
+
+    results = {
+        'encoder': encoder.name,
+        'device': encoder.device,
+        'chunks': len(texts),
+        'mean_tokens': round(sum(lengths) / len(lengths), 1),
+        'modes': [run_mode(encoder, texts, lengths, bucketed=False),
+                  run_mode(encoder, texts, lengths, bucketed=True)],
+    }
+    fixed, bucketed = results['modes']
+    if fixed['seconds'] and bucketed['seconds']:
+        results['speedup'] = round(fixed['seconds'] / bucketed['seconds'], 2)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"Encoder : {results['encoder']} on {results['device']}")
+    print(f"Chunks  : {results['chunks']} "
+          f"(mean {results['mean_tokens']} tokens)")
+    for r in results['modes']:
+        print(f"  {r['mode']:6s}  batches {r['batches']:5d}  "
+              f"padding efficiency {r['padding_efficiency']:.2%}  "
+              f"{r['chunks_per_sec']} chunks/sec")
+    if 'speedup' in results:
+        print(f"Speedup : {results['speedup']}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Index Recall / Latency Benchmark
+
+Compares approximate FAISS indexes (build_index.py --index_type ivf_flat,
+ivf_pq or hnsw) against exact search over the same embeddings, sweeping the
+query-time search breadth (nprobe for IVF, efSearch for HNSW). For each
+setting it reports recall@k against the exact top-k and p50/p99 latency of
+single-query searches, so a point on the recall/latency curve can be picked
+per corpus.
+
+Queries come from --queries-file (encoded with the e5 query prefix) or, by
+default, from a sample of the stored passage embeddings.
+
+Usage:
+    python bench_index.py --embeddings ./index/embeddings.npy \
+        --index ./index_ivf/faiss.index --index ./index_hnsw/faiss.index \
+        --nprobe 1,4,16,64 --ef-search 16,64,256
+
+    # Real queries, JSON report
+    python bench_index.py --embeddings ./index/embeddings.npy \
+        --index ./index_ivf/faiss.index \
+        --queries-file ../demo/sample_queries.md --json
+"""
+
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import faiss
+
+from encoders import EMBEDDING_DIM, load_encoder
+from query import load_queries
+
+
+def exact_index(embeddings: np.ndarray, block_size: int = 4096):
+    """IndexFlatIP over L2-normalised *embeddings*, built block by block."""
+    index = faiss.IndexFlatIP(EMBEDDING_DIM)
+    for start in range(0, len(embeddings), block_size):
+        block = np.array(embeddings[start:start + block_size],
+                         dtype=np.float32)
+        faiss.normalize_L2(block)
+        index.add(block)
+    return index
+
+
+def base_index(index):
+    """The index inside an IndexIDMap2 (or *index* itself)."""
+    return faiss.downcast_index(index.index) if hasattr(index, 'id_map') \
+        else index
+
+
+def load_vectors(path: str) -> np.ndarray:
+    """embeddings.npy (memory-mapped), or the vectors of a single-copy index."""
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    index = faiss.read_index(path)
+    return base_index(index).reconstruct_n(0, index.ntotal)
+
+
+def sample_queries(embeddings: np.ndarray, n: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(embeddings), min(n, len(embeddings)),
+                              replace=False))
+    queries = np.array(embeddings[rows], dtype=np.float32)
+    faiss.normalize_L2(queries)
+    return queries
+
+
+def encode_query_file(path: Path, kind: str, device: str) -> np.ndarray:
+    queries = load_queries(path)
+    encoder = load_encoder(kind, device)
+    try:
+        vectors = np.array(encoder.encode([f"query: {q}" for q in queries]),
+                           dtype=np.float32)
+    finally:
+        encoder.close()
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def recall_at_k(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """Mean fraction of each exact top-k row found in the candidate row."""
+    k = reference.shape[1]
+    return float(np.mean([
+        len(set(r) & set(c[c >= 0])) / k for r, c in zip(reference, candidate)
+    ]))
+
+
+def measure(index, queries: np.ndarray, k: int, reference: np.ndarray) -> Dict:
+    """Recall@k of one batched search, then single-query latencies."""
+    started = time.perf_counter()
+    _, ids = index.search(queries, k)
+    batch_sec = time.perf_counter() - started
+
+    latencies = []
+    for q in queries:
+        started = time.perf_counter()
+        index.search(q[None, :], k)
+        latencies.append(1000 * (time.perf_counter() - started))
+    p50, p99 = np.percentile(latencies, [50, 99])
+    return {
+        'recall_at_k': round(recall_at_k(reference, ids), 4),
+        'p50_ms': round(float(p50), 3),
+        'p99_ms': round(float(p99), 3),
+        'batch_qps': round(len(queries) / batch_sec, 1) if batch_sec else None,
+    }
+
+
+def sweep(index) -> Optional[str]:
+    """Name of the search-breadth parameter that applies to *index*."""
+    if faiss.try_extract_index_ivf(index) is not None:
+        return 'nprobe'
+    if hasattr(base_index(index), 'hnsw'):
+        return 'efSearch'
+    return None
+
+
+def parse_int_list(text: str) -> List[int]:
+    return [int(v) for v in text.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark approximate indexes against exact search.'
+    )
+    parser.add_argument('--embeddings', required=True,
+                        help='embeddings.npy the indexes were built from (or '
+                             'the faiss.index of a --single_copy build)')
+    parser.add_argument('--index', action='append', default=[],
+                        help='faiss.index to benchmark (repeatable)')
+    parser.add_argument('--top-k', '-k', type=int, default=10,
+                        help='Recall depth (default: 10)')
+    parser.add_argument('--nprobe', default='1,4,16,64',
+                        help='IVF nprobe values (default: 1,4,16,64)')
+    parser.add_argument('--ef-search', default='16,64,256',
+                        help='HNSW efSearch values (default: 16,64,256)')
+    parser.add_argument('--queries-file',
+                        help='Queries to encode (.md, .jsonl or one per line)')
+    parser.add_argument('--sample', type=int, default=500,
+                        help='Stored embeddings used as queries when no '
+                             '--queries-file is given (default: 500)')
+    parser.add_argument('--encoder', choices=['e5', 'stub'], default='e5',
+                        help='Query encoder for --queries-file (default: e5)')
+    parser.add_argument('--device', choices=['auto', 'cuda', 'cpu'],
+                        default='auto')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    args = parser.parse_args()
+
+    embeddings = load_vectors(args.embeddings)
+    if args.queries_file:
+        queries = encode_query_file(Path(args.queries_file), args.encoder,
+                                    args.device)
+    else:
+        queries = sample_queries(embeddings, args.sample)
+    k = min(args.top_k, len(embeddings))
+
+    print(f"Exact baseline over {len(embeddings)} vectors, "
+          f"{len(queries)} queries, k={k} ...", file=sys.stderr)
+    flat = exact_index(embeddings)
+    _, reference = flat.search(queries, k)
+
+    rows = [{'index': 'exact (IndexFlatIP)', 'setting': None,
+             **measure(flat, queries, k, reference)}]
+    values = {'nprobe': parse_int_list(args.nprobe),
+              'efSearch': parse_int_list(args.ef_search)}
+    for path in args.index:
+        index = faiss.read_index(path)
+        if index.ntotal != len(embeddings):
+            print(f"WARNING: {path} has {index.ntotal} vectors, embeddings "
+                  f"have {len(embeddings)}", file=sys.stderr)
+        name = f"{path} ({type(base_index(index)).__name__})"
+        # Built indexes return chunk uids; map the exact rows to them
+        expected = reference
+        if hasattr(index, 'id_map'):
+            expected = faiss.vector_to_array(index.id_map)[reference]
+        param = sweep(index)
+        for value in (values[param] if param else [None]):
+            if param:
+                faiss.ParameterSpace().set_index_parameter(index, param,
+                                                           value)
+            rows.append({'index': name,
+                         'setting': f"{param}={value}" if param else None,
+                         **measure(index, queries, k, expected)})
+
+    if args.json:
+        print(json.dumps({'vectors': len(embeddings), 'queries': len(queries),
+                          'top_k': k, 'results': rows}, indent=2))
+        return
+
+    print(f"\n{'index':48s} {'setting':14s} {'recall@' + str(k):>9s} "
+          f"{'p50 ms':>8s} {'p99 ms':>8s} {'batch q/s':>10s}")
+    for r in rows:
+        print(f"{r['index'][-48:]:48s} {r['setting'] or '-':14s} "
+              f"{r['recall_at_k']:9.3f} {r['p50_ms']:8.3f} {r['p99_ms']:8.3f} "
+              f"{r['batch_qps'] or 0:10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,29 @@
 Semantic Index Builder for Research Corpora
 
 Builds a FAISS-indexed semantic search layer over a directory of PDF documents.
-Uses intfloat/e5-large-v2 embeddings (1024-dim) with FP16 precision on GPU.
+Uses intfloat/e5-large-v2 embeddings (1024-dim), computed in FP16 on GPU or
+FP32 on CPU and stored as FP16.
 
 Usage:
     python build_index.py --pdf_dir ./pdfs --output_dir ./index
 
+    # Embed each duplicate PDF and near-duplicate passage only once
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index --dedup
+
+    # Keep per-page pdftotext output so re-chunking skips extraction
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index \
+        --extract_cache ~/.cache/corpus-text --chunk_target 600
+
+    # Share an on-disk embedding cache across builds and corpora
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index \
+        --embedding_cache ~/.cache/corpus-embeddings
+
+    # Resume an interrupted build from its last completed embedding shard
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index --resume
+
+    # Re-embed only new or changed PDFs, reusing the previous build
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index --incremental
+
     # Custom chunking parameters
     python build_index.py --pdf_dir ./pdfs --output_dir ./index \
         --chunk_target 800 --chunk_overlap 100 --chunk_min 200
@@ -16,33 +34,98 @@ Usage:
     python build_index.py --pdf_dir ./pdfs --output_dir ./index \
         --skip_list skip.txt
 
+    # Encode on CPU (the default when no CUDA device is present)
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index --device cpu
+
+    # Encode on 8 CPU processes with 4 torch threads each
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index --device cpu \
+        --encode_workers 8 --threads_per_worker 4
+
+    # int8-quantized CPU encoding (requires a passing check_quantized.py run)
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index --device cpu \
+        --quantize int8 --quantize_check ./demo_index/quantization_check.json
+
+    # Extract and chunk on 8 worker processes
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index --workers 8
+
+    # Approximate index (ivf_flat, ivf_pq or hnsw) instead of exact flat
+    python build_index.py --pdf_dir ./pdfs --output_dir ./index_ivf \
+        --index_type ivf_flat --nlist 1024 --nprobe 16
+
+    # Build one institution's shard and register it for fan-out search
+    python build_index.py --pdf_dir ./pdfs/inst_a --output_dir ./inst_a_index \
+        --shard_manifest ./shards.json
+
 Output:
     output_dir/
-    ├── faiss.index       FAISS IndexFlatIP vector index
+    ├── faiss.index       FAISS vector index (IndexFlatIP unless --index_type)
     ├── chunks.jsonl      Chunk texts with metadata
+    ├── chunk_store/      Memory-mapped copy of chunks.jsonl for queries
+    ├── doc_index.npy     Pooled vector per document (query.py --per-doc)
     ├── metadata.jsonl    Document-level metadata
+    ├── embeddings.npy    FP16 embedding vectors
     └── index_report.json Build statistics and verification
 """
 
+import os
 import sys
 import json
 import re
+import time
+import fcntl
 import hashlib
+import shutil
 import argparse
+import threading
 import subprocess
+from queue import Queue, Empty, Full
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from bisect import bisect_right
 from pathlib import Path
 from datetime import datetime
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterator, Optional
 
 import numpy as np
 
+from extract_cache import ExtractCache
+from dedup import DEDUP_THRESHOLD, Deduplicator
+from instrument import Stages, peak_rss_mb
+from doc_index import (
+    DOC_INDEX_FILENAME, doc_centroids, measure_doc_recall, write_doc_index,
+)
+from chunk_store import (
+    STORE_DIRNAME, ChunkStoreWriter, read_tombstones, replace_store,
+)
+from shards import register_shard
+from encoders import (
+    EMBEDDING_DIM, BATCH_TOKENS, QUANTIZE_MODES, load_encoder,
+    model_label, require_quantization_check,
+)
+
 
 # ── Invariants ───────────────────────────────────────────────────────────────
 
-EMBEDDING_MODEL = "intfloat/e5-large-v2"
-EMBEDDING_DIM = 1024
-BATCH_SIZE = 1300
+BATCH_SIZE = 1300      # chunks per batch with --fixed_batches
 FP16 = True
+EXTRACT_TIMEOUT = 120  # seconds per pdftotext call
+PASSAGE_PREFIX = "passage: "
+SHARD_SIZE = 4096      # chunks per checkpointed embedding shard
+PIPELINE_DEPTH = 2     # chunk batches buffered between extraction and embedding
+
+# FAISS index types (--index_type). nlist defaults to ~4*sqrt(n) lists.
+# sq_fp16 / sq8 store each vector scalar-quantized to 2 / 1 bytes per dim.
+INDEX_TYPES = ('flat', 'sq_fp16', 'sq8', 'ivf_flat', 'ivf_pq', 'hnsw')
+STREAMED_INDEX_TYPES = ('flat', 'sq_fp16')  # filled shard by shard
+RECALL_QUERIES = 200   # stored vectors used to measure recall@10 after a build
+PQ_M = 64              # PQ sub-quantizers (1024 / 64 = 16 dims each)
+PQ_NBITS = 8
+HNSW_M = 32
+EF_CONSTRUCTION = 200
+NPROBE = 16            # default lists probed per query (IVF)
+EF_SEARCH = 128        # default HNSW search breadth
+TRAIN_PER_LIST = 256   # training vectors sampled per IVF list
 
 # Section markers for academic / policy papers
 SECTION_MARKERS = [
@@ -80,19 +163,58 @@ def compute_sha256(filepath: Path) -> str:
     return sha256.hexdigest()
 
 
+def _run_pdftotext(pdf_path: Path) -> Tuple[str, int]:
+    """Run pdftotext on *pdf_path*, raising on failure or timeout."""
+    result = subprocess.run(
+        ['pdftotext', '-layout', str(pdf_path), '-'],
+        capture_output=True, text=True, timeout=EXTRACT_TIMEOUT
+    )
+    text = result.stdout
+    page_count = text.count('\x0c') + 1 if text else 0
+    return text, page_count
+
+
+@lru_cache(maxsize=None)
+def extractor_version() -> str:
+    """pdftotext version and flags; part of every extraction cache key."""
+    try:
+        result = subprocess.run(['pdftotext', '-v'], capture_output=True,
+                                text=True, timeout=10)
+        output = (result.stderr + result.stdout).splitlines()
+        version = next((line.strip() for line in output if 'version' in line),
+                       'pdftotext')
+    except (OSError, subprocess.SubprocessError):
+        version = 'pdftotext'
+    return f"{version} -layout"
+
+
+def extract_pages(pdf_path: Path, sha256: str,
+                  cache: Optional[ExtractCache] = None) -> Tuple[List[str], bool]:
+    """Pages of *pdf_path*, from *cache* when it has them.
+
+    Returns ``(pages, cached)``. Pages are the pdftotext output split on
+    form feeds, so ``'\x0c'.join(pages)`` is the text pdftotext printed.
+    Fresh extractions are added to *cache*; failures raise as in
+    ``_run_pdftotext`` and are not cached.
+    """
+    if cache is not None:
+        pages = cache.get(sha256)
+        if pages is not None:
+            return pages, True
+    text, _ = _run_pdftotext(pdf_path)
+    pages = text.split('\x0c')
+    if cache is not None:
+        cache.put(sha256, pages)
+    return pages, False
+
+
 def extract_text(pdf_path: Path) -> Tuple[str, int]:
     """Extract text from a PDF using pdftotext.
 
     Returns (text, page_count).
     """
     try:
-        result = subprocess.run(
-            ['pdftotext', '-layout', str(pdf_path), '-'],
-            capture_output=True, text=True, timeout=120
-        )
-        text = result.stdout
-        page_count = text.count('\x0c') + 1 if text else 0
-        return text, page_count
+        return _run_pdftotext(pdf_path)
     except Exception as e:
         print(f"  ERROR extracting {pdf_path.name}: {e}")
         return "", 0
@@ -130,184 +252,828 @@ def parse_metadata(text: str, filename: str) -> Dict:
 
 # ── Chunking ─────────────────────────────────────────────────────────────────
 
+# All SECTION_MARKERS as one pattern, tried once per paragraph
+SECTION_PATTERN = re.compile('|'.join(f'(?:{p})' for p in SECTION_MARKERS),
+                             re.I)
+# Paragraph separator: a blank line (two or more newlines)
+_BLANK_LINES = re.compile(r'\n\n+')
+_SPACE_RUN = re.compile(r'[ \t]+')
+_SPACES = re.compile(r' {2,}')
+
+
 def is_section_header(line: str) -> bool:
     """Check if a line matches a known section header pattern."""
-    line_lower = line.strip().lower()
-    return any(re.match(p, line_lower, re.I) for p in SECTION_MARKERS)
+    return SECTION_PATTERN.match(line.strip().lower()) is not None
+
+
+def split_paragraphs(text: str) -> List[Tuple[int, int, int, Optional[str]]]:
+    """Paragraphs of *text* in one scan, as offsets rather than copies.
+
+    Returns ``(start, end, size, header)`` per non-blank paragraph:
+    *start*/*end* are character offsets of the stripped paragraph in
+    *text*, *size* its length once runs of spaces and tabs are collapsed,
+    and *header* the section name if its first line is a section header.
+    Paragraphs are separated by two or more newlines.
+    """
+    spans = []
+    start = 0
+    bounds = [(m.start(), m.end()) for m in _BLANK_LINES.finditer(text)]
+    for end, next_start in bounds + [(len(text), len(text))]:
+        piece = text[start:end]
+        stripped = piece.lstrip()
+        if stripped:
+            lo = start + len(piece) - len(stripped)
+            spans.append((lo, lo + len(stripped.rstrip())))
+        start = next_start
+    if not spans:
+        return []
+
+    # Normalisation removes every space or tab that follows another one;
+    # count those per paragraph from a running total. Only ASCII matters,
+    # so other characters encode to one placeholder byte each.
+    codes = np.frombuffer(text.encode('ascii', 'replace'), dtype=np.uint8)
+    blank = (codes == 32) | (codes == 9)
+    dropped = np.concatenate(([0], np.cumsum(blank[1:] & blank[:-1])))
+    starts, ends = np.array(spans).T
+    sizes = (ends - starts) - (dropped[ends - 1] - dropped[starts])
+
+    paragraphs = []
+    for (start, end), size in zip(spans, sizes.tolist()):
+        newline = text.find('\n', start, end)
+        line = text[start:newline if newline >= 0 else end]
+        header = None
+        if SECTION_PATTERN.match(line.strip().lower()):
+            header = _SPACE_RUN.sub(' ', line).strip()
+        paragraphs.append((start, end, size, header))
+    return paragraphs
+
+
+def chunk_spans(paragraphs: List[Tuple[int, int, int, Optional[str]]],
+                target_tokens: int = 800, overlap_tokens: int = 100,
+                min_tokens: int = 200) -> List[Tuple[int, int, str]]:
+    """Section-aware chunk boundaries over ``split_paragraphs`` output.
+
+    Returns ``(first, stop, section)`` per chunk: the chunk is paragraphs
+    ``first..stop-1``, so it spans ``paragraphs[first][0]`` to
+    ``paragraphs[stop - 1][1]`` of the original text. Consecutive chunks
+    share up to *overlap_tokens* of trailing paragraphs.
+
+    Token estimates use the approximation 1 token ~ 4 characters.
+    """
+    spans: List[Tuple[int, int, str]] = []
+    first = 0
+    tokens = 0
+    section = "document"
+
+    def _flush(stop: int):
+        nonlocal first, tokens
+        if tokens < min_tokens // 2:
+            return
+        spans.append((first, stop, section))
+
+        # Keep overlap
+        keep, kept = stop, 0
+        while keep > first:
+            p_tok = paragraphs[keep - 1][2] // 4
+            if kept + p_tok > overlap_tokens:
+                break
+            keep -= 1
+            kept += p_tok
+        first, tokens = keep, kept
+
+    for i, (_, _, size, header) in enumerate(paragraphs):
+        if header is not None:
+            if tokens >= min_tokens:
+                _flush(i)
+            section = header
+
+        tokens += size // 4
+        if tokens >= target_tokens:
+            _flush(i + 1)
+
+    # Final chunk
+    _flush(len(paragraphs))
+    return spans
+
+
+def span_text(text: str, paragraphs: List[Tuple[int, int, int, Optional[str]]],
+              first: int, stop: int) -> str:
+    """Materialise paragraphs *first..stop-1* with whitespace normalised."""
+    return '\n\n'.join(_SPACES.sub(' ', text[start:end].replace('\t', ' '))
+                       for start, end, _, _ in paragraphs[first:stop])
+
+
+def page_starts(pages: List[str]) -> List[int]:
+    """Offset of each page in ``'\x0c'.join(pages)``."""
+    starts = [0]
+    for page in pages[:-1]:
+        starts.append(starts[-1] + len(page) + 1)
+    return starts
 
 
 def chunk_text(text: str, target_tokens: int = 800,
-               overlap_tokens: int = 100, min_tokens: int = 200) -> List[Dict]:
+               overlap_tokens: int = 100, min_tokens: int = 200,
+               pages: Optional[List[int]] = None) -> List[Dict]:
     """Section-aware chunking for academic / policy documents.
 
     Splits on paragraph boundaries, respects section headers,
-    and maintains overlap between consecutive chunks.
+    and maintains overlap between consecutive chunks. Boundaries come
+    from ``chunk_spans`` as offsets into *text*; chunk strings are only
+    built here, with runs of spaces and tabs collapsed.
 
-    Token estimates use the approximation 1 token ~ 4 characters.
+    With *pages* (``page_starts`` of the document), each chunk also gets
+    the 1-based ``page_start`` and ``page_end`` its text spans.
     """
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    text = re.sub(r'[ \t]+', ' ', text)
-    paragraphs = text.split('\n\n')
-
+    paragraphs = split_paragraphs(text)
     chunks: List[Dict] = []
-    current_paras: List[str] = []
-    current_tokens = 0
-    current_section = "document"
-    chunk_id = 0
-
-    def _flush():
-        nonlocal chunk_id, current_paras, current_tokens
-        if current_tokens < min_tokens // 2:
-            return
-        chunk_text_str = '\n\n'.join(current_paras)
+    for chunk_id, (first, stop, section) in enumerate(
+            chunk_spans(paragraphs, target_tokens, overlap_tokens,
+                        min_tokens)):
+        chunk_text_str = span_text(text, paragraphs, first, stop)
         chunks.append({
             'chunk_id': chunk_id,
             'text': chunk_text_str,
-            'section': current_section,
+            'section': section,
             'char_count': len(chunk_text_str),
             'token_estimate': len(chunk_text_str) // 4,
         })
-        chunk_id += 1
+        if pages is not None:
+            start = paragraphs[first][0] if first < stop else 0
+            end = paragraphs[stop - 1][1] - 1 if first < stop else 0
+            chunks[-1]['page_start'] = bisect_right(pages, start)
+            chunks[-1]['page_end'] = bisect_right(pages, end)
+    return chunks
 
-        # Keep overlap
-        overlap_paras: List[str] = []
-        overlap_size = 0
-        for p in reversed(current_paras):
-            p_tok = len(p) // 4
-            if overlap_size + p_tok <= overlap_tokens:
-                overlap_paras.insert(0, p)
-                overlap_size += p_tok
-            else:
-                break
-        current_paras = overlap_paras
-        current_tokens = overlap_size
 
-    for para in paragraphs:
-        para = para.strip()
-        if not para:
-            continue
+# ── Embedding cache ──────────────────────────────────────────────────────────
 
-        para_tokens = len(para) // 4
-        first_line = para.split('\n')[0] if '\n' in para else para
+class EmbeddingCache:
+    """Content-addressed on-disk cache of passage embeddings.
 
-        if is_section_header(first_line):
-            if current_tokens >= min_tokens:
-                _flush()
-            current_section = first_line.strip()
+    Entries are keyed by a 16-byte digest of (model name, prefix,
+    whitespace-normalised chunk text), so identical passages share one
+    vector across builds and corpora. Layout of *cache_dir*:
 
-        current_paras.append(para)
-        current_tokens += para_tokens
+        vectors.f16   float16 rows, memory-mapped, grown by doubling
+        keys.npy      sorted (key, row, last_used) records
+        cache.json    dimension and row counts
 
-        if current_tokens >= target_tokens:
-            _flush()
+    A build holds an exclusive lock on the directory; a second build that
+    finds it locked runs without the cache rather than waiting. When the
+    vectors exceed *max_bytes* on close, the least recently used entries
+    are evicted and the vector file is compacted.
+    """
 
-    # Final chunk
-    _flush()
-    return chunks
+    KEY_DTYPE = np.dtype([('key', 'S16'), ('row', '<i8'), ('last_used', '<i8')])
+
+    def __init__(self, cache_dir: Path, dim: int, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.dim = dim
+        self.max_bytes = max_bytes
+        self.row_bytes = dim * np.dtype(np.float16).itemsize
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = open(cache_dir / "cache.lock", 'w')
+        try:
+            fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self._lock.close()
+            raise RuntimeError(f"embedding cache {cache_dir} is in use")
+
+        info_path = cache_dir / "cache.json"
+        info = {'dim': dim, 'rows': 0, 'capacity': 0}
+        if info_path.exists():
+            with open(info_path) as f:
+                info = json.load(f)
+            if info['dim'] != dim:
+                self._release()
+                raise RuntimeError(
+                    f"embedding cache {cache_dir} holds {info['dim']}-dim "
+                    f"vectors, expected {dim}"
+                )
+        self.rows = info['rows']
+        self.capacity = info['capacity']
+
+        keys_path = cache_dir / "keys.npy"
+        if keys_path.exists() and self.rows:
+            self.index = np.load(keys_path)
+        else:
+            self.index = np.empty(0, dtype=self.KEY_DTYPE)
+        self._pending: Dict[bytes, int] = {}
+        self._vectors = self._open_vectors()
+
+    @staticmethod
+    def make_keys(texts: List[str], model_name: str, prefix: str) -> np.ndarray:
+        """Return the cache key of each text as an ``S16`` array."""
+        keys = np.empty(len(texts), dtype='S16')
+        for i, text in enumerate(texts):
+            normalized = ' '.join(text.split())
+            digest = hashlib.blake2b(
+                f"{model_name}\0{prefix}\0{normalized}".encode('utf-8'),
+                digest_size=16,
+            )
+            keys[i] = digest.digest()
+        return keys
+
+    def _open_vectors(self) -> Optional[np.memmap]:
+        if not self.capacity:
+            return None
+        return np.memmap(self.cache_dir / "vectors.f16", dtype=np.float16,
+                         mode='r+', shape=(self.capacity, self.dim))
+
+    def _grow(self, needed: int) -> None:
+        capacity = max(self.capacity, 1024)
+        while capacity < needed:
+            capacity *= 2
+        if self._vectors is not None:
+            self._vectors.flush()
+            del self._vectors
+        with open(self.cache_dir / "vectors.f16", 'ab') as f:
+            f.truncate(capacity * self.row_bytes)
+        self.capacity = capacity
+        self._vectors = self._open_vectors()
+
+    def lookup(self, keys: np.ndarray) -> np.ndarray:
+        """Return the cache row of each key, or -1 where it is missing."""
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(self.index):
+            pos = np.searchsorted(self.index['key'], keys)
+            pos = np.minimum(pos, len(self.index) - 1)
+            found = self.index['key'][pos] == keys
+            rows[found] = self.index['row'][pos[found]]
+            self.index['last_used'][pos[found]] = int(time.time())
+        if self._pending:
+            for i in np.flatnonzero(rows < 0):
+                rows[i] = self._pending.get(keys[i].tobytes(), -1)
+        hit = int((rows >= 0).sum())
+        self.hits += hit
+        self.misses += len(keys) - hit
+        return rows
+
+    def get(self, rows: np.ndarray) -> np.ndarray:
+        """Read the vectors stored at *rows*."""
+        return np.asarray(self._vectors[rows])
+
+    def put(self, keys: np.ndarray, vectors: np.ndarray) -> None:
+        """Store *vectors* under *keys*, ignoring keys already present."""
+        new = []
+        for i, key in enumerate(keys):
+            k = key.tobytes()
+            if k not in self._pending:
+                self._pending[k] = -1
+                new.append(i)
+        if not new:
+            return
+        if self.rows + len(new) > self.capacity:
+            self._grow(self.rows + len(new))
+        start = self.rows
+        self._vectors[start:start + len(new)] = vectors[new].astype(np.float16)
+        for offset, i in enumerate(new):
+            self._pending[keys[i].tobytes()] = start + offset
+        self.rows += len(new)
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until the vectors fit."""
+        keep_rows = self.max_bytes // self.row_bytes
+        if len(self.index) <= keep_rows:
+            return
+        order = np.argsort(self.index['last_used'], kind='stable')[::-1]
+        kept = np.sort(order[:keep_rows])
+        self.evicted = len(self.index) - len(kept)
+        self.index = self.index[kept]
+
+        compact_path = self.cache_dir / "vectors.f16.tmp"
+        compact = np.memmap(compact_path, dtype=np.float16, mode='w+',
+                            shape=(max(len(self.index), 1), self.dim))
+        old_rows = self.index['row']
+        order = np.argsort(old_rows)
+        for start in range(0, len(order), 4096):
+            block = order[start:start + 4096]
+            compact[block] = self._vectors[old_rows[block]]
+        compact.flush()
+        del compact
+        del self._vectors
+        os.replace(compact_path, self.cache_dir / "vectors.f16")
+        self.index['row'] = np.arange(len(self.index))
+        self.rows = len(self.index)
+        self.capacity = max(self.rows, 1)
+        self._vectors = self._open_vectors()
+
+    def close(self) -> None:
+        """Merge new entries, evict if over budget, persist and unlock."""
+        now = int(time.time())
+        added = [(k, row) for k, row in self._pending.items() if row >= 0]
+        if added:
+            new = np.empty(len(added), dtype=self.KEY_DTYPE)
+            new['key'] = [k for k, _ in added]
+            new['row'] = [row for _, row in added]
+            new['last_used'] = now
+            self.index = np.concatenate([self.index, new])
+            self.index = self.index[np.argsort(self.index['key'], kind='stable')]
+        self._pending = {}
+        self._evict()
+        if self._vectors is not None:
+            self._vectors.flush()
+
+        keys_path = self.cache_dir / "keys.npy"
+        with open(_tmp_path(keys_path), 'wb') as f:
+            np.save(f, self.index)
+        os.replace(_tmp_path(keys_path), keys_path)
+        info_path = self.cache_dir / "cache.json"
+        with open(_tmp_path(info_path), 'w') as f:
+            json.dump({'dim': self.dim, 'rows': self.rows,
+                       'capacity': self.capacity}, f)
+        os.replace(_tmp_path(info_path), info_path)
+        self._release()
+
+    def _release(self) -> None:
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+
+    def report(self) -> Dict:
+        """Summary for ``index_report.json``."""
+        lookups = self.hits + self.misses
+        return {
+            'cache_dir': str(self.cache_dir),
+            'lookups': lookups,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'bytes_saved': self.hits * self.row_bytes,
+            'entries': len(self.index),
+            'evicted': self.evicted,
+        }
 
 
 # ── Embedding ────────────────────────────────────────────────────────────────
 
-def generate_embeddings(chunks: List[Dict]) -> np.ndarray:
-    """Generate e5-large-v2 embeddings on GPU.
+def encode_passages(texts: List[str], encoder) -> np.ndarray:
+    """Encode prefixed passage *texts*, returning FP16 vectors."""
+    print(f"Embedding {len(texts)} chunks ...")
+    embeddings = encoder.encode(texts)
+
+    if FP16:
+        embeddings = embeddings.astype(np.float16)
 
-    Requires CUDA. Uses FP16 precision to stay within a 3 GB VRAM envelope.
+    print(f"Embeddings shape: {embeddings.shape}")
+    return embeddings
+
+
+def generate_embeddings(chunks: List[Dict], encoder,
+                        cache: Optional[EmbeddingCache] = None) -> np.ndarray:
+    """Generate embeddings for *chunks* with *encoder*.
+
+    With a *cache*, vectors for previously seen passages are read from it
+    in one bulk lookup; only the misses (deduplicated) go to the model and
+    are then added to the cache.
     """
-    from sentence_transformers import SentenceTransformer
-    import torch
-
-    if not torch.cuda.is_available():
-        raise RuntimeError(
-            "CUDA not available. GPU is required for embedding generation. "
-            "Install a CUDA-capable PyTorch build or run on a machine with "
-            "an NVIDIA GPU."
-        )
+    texts = [f"{PASSAGE_PREFIX}{c['text']}" for c in chunks]
+    if cache is None:
+        return encode_passages(texts, encoder)
+
+    keys = cache.make_keys([c['text'] for c in chunks],
+                           encoder.name, PASSAGE_PREFIX)
+    rows = cache.lookup(keys)
+    hit = rows >= 0
+    print(f"Embedding cache: {int(hit.sum())}/{len(chunks)} hits")
+
+    embeddings = np.empty((len(chunks), EMBEDDING_DIM), dtype=np.float16)
+    if hit.any():
+        embeddings[hit] = cache.get(rows[hit])
+
+    misses = np.flatnonzero(~hit)
+    if len(misses):
+        _, first, inverse = np.unique(keys[misses], return_index=True,
+                                      return_inverse=True)
+        unique_misses = misses[first]
+        encoded = encode_passages([texts[i] for i in unique_misses], encoder)
+        embeddings[misses] = encoded[inverse.reshape(-1)]
+        cache.put(keys[unique_misses], encoded)
 
-    torch.cuda.empty_cache()
-    device = 'cuda'
+    return embeddings
 
-    print(f"Loading model: {EMBEDDING_MODEL}")
-    model = SentenceTransformer(EMBEDDING_MODEL, device=device)
-    model.half()  # FP16
 
-    texts = [f"passage: {c['text']}" for c in chunks]
-    print(f"Embedding {len(texts)} chunks ...")
+def embed_incremental(chunks: List[Dict], reuse_rows: List[int],
+                      previous_embeddings: Optional[np.ndarray], encoder,
+                      cache: Optional[EmbeddingCache] = None) -> np.ndarray:
+    """Assemble embeddings, copying reused rows and encoding the rest.
 
-    with torch.no_grad():
-        embeddings = model.encode(
-            texts,
-            batch_size=BATCH_SIZE,
-            show_progress_bar=True,
-            convert_to_numpy=True,
-            normalize_embeddings=True,
+    ``reuse_rows[i]`` is the row of chunk *i* in *previous_embeddings*,
+    or -1 if the chunk is new and must be embedded.
+    """
+    new_positions = [i for i, row in enumerate(reuse_rows) if row < 0]
+    reused_positions = [i for i, row in enumerate(reuse_rows) if row >= 0]
+    print(f"Reusing {len(reused_positions)} embeddings, "
+          f"embedding {len(new_positions)} new chunks")
+
+    embeddings = np.empty((len(chunks), EMBEDDING_DIM), dtype=np.float16)
+    if reused_positions:
+        rows = [reuse_rows[i] for i in reused_positions]
+        embeddings[reused_positions] = previous_embeddings[rows]
+    if new_positions:
+        embeddings[new_positions] = generate_embeddings(
+            [chunks[i] for i in new_positions], encoder, cache
         )
+    return embeddings
 
-    if FP16:
-        embeddings = embeddings.astype(np.float16)
 
-    print(f"Embeddings shape: {embeddings.shape}")
+# ── Sharded embedding ────────────────────────────────────────────────────────
+
+def _shard_fingerprint(chunks: List[Dict], model_name: str) -> str:
+    """Digest of the model and passage texts a shard was computed from."""
+    digest = hashlib.blake2b(model_name.encode('utf-8'), digest_size=16)
+    for chunk in chunks:
+        digest.update(b'\0' + chunk['text'].encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _write_manifest(manifest_path: Path, manifest: Dict) -> None:
+    with open(_tmp_path(manifest_path), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(_tmp_path(manifest_path), manifest_path)
+
+
+def embed_in_shards(batches: Iterator[Tuple[List[Dict], List[int]]],
+                    shard_dir: Path, shard_size: int, resume: bool,
+                    embed_fn, index, model_name: str,
+                    stages: Optional[Stages] = None
+                    ) -> Tuple[List[Path], Dict]:
+    """Embed chunk *batches* as checkpointed shards and add them to *index*.
+
+    *index* may be None for index types that must be trained on the
+    stitched embeddings first.
+
+    *batches* yields ``(chunks, reuse_rows)`` lists of *shard_size* chunks
+    (the last may be shorter); ``embed_fn(chunks, reuse_rows)`` returns
+    their embeddings. Every finished shard is written to *shard_dir* and
+    recorded in ``manifest.json`` with its chunk range and a fingerprint of
+    its texts, so an interrupted build loses at most one shard of work.
+    With *resume*, shards whose range and fingerprint still match are read
+    back instead of re-embedded.
+
+    Returns the shard paths in chunk order and a summary for the report.
+    Adding to *index* is timed as the ``index`` stage of *stages*.
+    """
+    stages = stages if stages is not None else Stages()
+    manifest_path = shard_dir / "manifest.json"
+    manifest = {'model': model_name, 'dim': EMBEDDING_DIM,
+                'shard_size': shard_size, 'shards': {}}
+    if resume and manifest_path.exists():
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if (previous.get('model') == model_name
+                and previous.get('shard_size') == shard_size):
+            manifest['shards'] = previous['shards']
+        else:
+            print("  Shard manifest does not match this build; starting over")
+    elif shard_dir.exists():
+        shutil.rmtree(shard_dir)
+    shard_dir.mkdir(parents=True, exist_ok=True)
+
+    paths: List[Path] = []
+    resumed = 0
+    start = 0
+    for chunks, reuse_rows in batches:
+        end = start + len(chunks)
+        path = shard_dir / f"emb_{start:09d}.npy"
+        fingerprint = _shard_fingerprint(chunks, model_name)
+        done = manifest['shards'].get(str(start))
+        if (done is not None and done['end'] == end
+                and done['fingerprint'] == fingerprint and path.exists()):
+            embeddings = np.load(path)
+            resumed += 1
+        else:
+            print(f"  Shard {len(paths) + 1}: chunks {start}-{end - 1}")
+            embeddings = embed_fn(chunks, reuse_rows)
+            with open(_tmp_path(path), 'wb') as f:
+                np.save(f, embeddings)
+            os.replace(_tmp_path(path), path)
+            manifest['shards'][str(start)] = {
+                'start': start, 'end': end, 'file': path.name,
+                'fingerprint': fingerprint,
+            }
+            _write_manifest(manifest_path, manifest)
+        if index is not None:
+            with stages.stage('index', items=len(embeddings)):
+                add_to_index(index, embeddings)
+        paths.append(path)
+        start = end
+
+    if resumed:
+        print(f"  Resumed {resumed} of {len(paths)} shards from {shard_dir}")
+    return paths, {'shard_size': shard_size, 'shards': len(paths),
+                   'resumed_shards': resumed}
+
+
+def stitch_shards(shard_paths: List[Path], n_rows: int,
+                  embeddings_path: Path) -> np.ndarray:
+    """Concatenate shard files into a memory-mapped ``.npy`` at *embeddings_path*.
+
+    Shards are copied one at a time, so peak memory stays at one shard.
+    """
+    embeddings = np.lib.format.open_memmap(
+        embeddings_path, mode='w+', dtype=np.float16,
+        shape=(n_rows, EMBEDDING_DIM),
+    )
+    row = 0
+    for path in shard_paths:
+        shard = np.load(path, mmap_mode='r')
+        embeddings[row:row + len(shard)] = shard
+        row += len(shard)
+    embeddings.flush()
     return embeddings
 
 
 # ── FAISS index ──────────────────────────────────────────────────────────────
 
-def build_faiss_index(embeddings: np.ndarray):
-    """Build a FAISS IndexFlatIP from L2-normalised embeddings.
+def resolve_index_params(index_type: str, n_vectors: int,
+                         nlist: Optional[int] = None, pq_m: int = PQ_M,
+                         pq_nbits: int = PQ_NBITS, hnsw_m: int = HNSW_M,
+                         ef_construction: int = EF_CONSTRUCTION,
+                         nprobe: int = NPROBE,
+                         ef_search: int = EF_SEARCH) -> Tuple[str, Dict]:
+    """Fill in defaults for *index_type* given the corpus size.
+
+    IVF types need enough vectors to train their coarse quantizer (and, for
+    PQ, 2**pq_nbits codebook entries); a corpus too small for that falls
+    back to ``flat``, which is exact anyway at that size. Returns the index
+    type actually used and its parameters.
+    """
+    if index_type in ('flat', 'sq_fp16', 'sq8'):
+        return index_type, {}
+    if index_type == 'hnsw':
+        return 'hnsw', {'hnsw_m': hnsw_m, 'ef_construction': ef_construction,
+                        'ef_search': ef_search}
+
+    if nlist is None:
+        nlist = max(1, min(int(4 * np.sqrt(n_vectors)), n_vectors // 39))
+    params = {'nlist': nlist, 'nprobe': min(nprobe, nlist)}
+    min_train = nlist
+    if index_type == 'ivf_pq':
+        if EMBEDDING_DIM % pq_m:
+            raise ValueError(f"--pq_m must divide {EMBEDDING_DIM}")
+        params.update(pq_m=pq_m, pq_nbits=pq_nbits)
+        min_train = max(min_train, 2 ** pq_nbits)
+    if n_vectors < min_train:
+        print(f"  {n_vectors} vectors are too few to train {index_type} "
+              f"(need {min_train}); using flat")
+        return 'flat', {'requested': index_type}
+    return index_type, params
+
+
+def new_faiss_index(index_type: str = 'flat', params: Optional[Dict] = None):
+    """Create an empty FAISS index of *index_type* for inner-product search.
+
+    IndexFlatIP with normalised vectors is equivalent to cosine similarity;
+    the approximate types use the same metric. IVF types must be trained
+    before vectors are added. The index is wrapped in an IndexIDMap2, so
+    searches return each chunk's stable ``uid`` rather than its row, and
+    update_index.py can append and remove chunks without renumbering.
+    """
+    import faiss
+
+    if index_type == 'flat':
+        index = faiss.IndexFlatIP(EMBEDDING_DIM)
+    elif index_type in ('sq_fp16', 'sq8'):
+        qtype = (faiss.ScalarQuantizer.QT_fp16 if index_type == 'sq_fp16'
+                 else faiss.ScalarQuantizer.QT_8bit)
+        index = faiss.IndexScalarQuantizer(EMBEDDING_DIM, qtype,
+                                           faiss.METRIC_INNER_PRODUCT)
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(EMBEDDING_DIM, params['hnsw_m'],
+                                    faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params['ef_construction']
+        index.hnsw.efSearch = params['ef_search']
+    else:
+        quantizer = faiss.IndexFlatIP(EMBEDDING_DIM)
+        if index_type == 'ivf_flat':
+            index = faiss.IndexIVFFlat(quantizer, EMBEDDING_DIM,
+                                       params['nlist'],
+                                       faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, EMBEDDING_DIM, params['nlist'],
+                                     params['pq_m'], params['pq_nbits'],
+                                     faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = params['nprobe']
+    return faiss.IndexIDMap2(index)
+
+
+def base_index(index):
+    """The index inside an IndexIDMap2 (or *index* itself), by row."""
+    import faiss
+
+    return faiss.downcast_index(index.index) if hasattr(index, 'id_map') \
+        else index
+
+
+def add_to_index(index, embeddings: np.ndarray,
+                 ids: Optional[np.ndarray] = None) -> None:
+    """L2-normalise a block of FP16 *embeddings* and append it to *index*.
+
+    Rows get the uids *ids*, by default the next ``index.ntotal`` onwards
+    (a fresh build numbers chunks in row order).
+    """
+    import faiss
+
+    block = np.array(embeddings, dtype=np.float32)
+    faiss.normalize_L2(block)
+    if ids is None:
+        ids = np.arange(index.ntotal, index.ntotal + len(block))
+    index.add_with_ids(block, np.asarray(ids, dtype=np.int64))
+
+
+def build_faiss_index(embeddings: np.ndarray, index_type: str = 'flat',
+                      params: Optional[Dict] = None,
+                      block_size: int = SHARD_SIZE) -> Tuple[object, Dict]:
+    """Build a FAISS index of *index_type* from L2-normalised embeddings.
+
+    Trained types are trained on up to ``TRAIN_PER_LIST * nlist`` rows
+    sampled evenly across the corpus. Vectors are converted to float32 one
+    block at a time, so a memory-mapped *embeddings* array is never copied
+    in full. Returns the index and a summary for the report.
+    """
+    import faiss
 
-    IndexFlatIP with normalised vectors is equivalent to cosine similarity.
+    params = params or {}
+    index = new_faiss_index(index_type, params)
+    info = {'type': index_type, **params}
+
+    started = time.time()
+    if not index.is_trained:
+        n_train = min(len(embeddings),
+                      TRAIN_PER_LIST * params.get('nlist', 256))
+        rows = np.unique(np.linspace(0, len(embeddings) - 1, n_train)
+                         .astype(np.int64))
+        sample = np.array(embeddings[rows], dtype=np.float32)
+        faiss.normalize_L2(sample)
+        print(f"  Training {index_type} on {len(sample)} vectors ...")
+        index.train(sample)
+        info['train_vectors'] = len(sample)
+        info['train_sec'] = round(time.time() - started, 2)
+        started = time.time()
+
+    for start in range(0, len(embeddings), block_size):
+        add_to_index(index, embeddings[start:start + block_size])
+    info['add_sec'] = round(time.time() - started, 2)
+
+    print(f"FAISS index: {index.ntotal} vectors ({index_type})")
+    return index, info
+
+
+def measure_recall(index, embeddings: np.ndarray, k: int = 10,
+                   n_queries: int = RECALL_QUERIES,
+                   block_size: int = SHARD_SIZE) -> Dict:
+    """Recall@k of *index* against exact search over *embeddings*.
+
+    Queries are stored vectors sampled evenly across the corpus; the exact
+    top-k is computed block by block from the (memory-mapped) embeddings,
+    so no full float32 copy is made.
     """
     import faiss
 
-    embeddings_f32 = embeddings.astype(np.float32)
-    faiss.normalize_L2(embeddings_f32)
+    n = len(embeddings)
+    k = min(k, n)
+    rows = np.unique(np.linspace(0, n - 1, min(n_queries, n)).astype(np.int64))
+    queries = np.array(embeddings[rows], dtype=np.float32)
+    faiss.normalize_L2(queries)
+
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), k), dtype=np.int64)
+    for start in range(0, n, block_size):
+        block = np.array(embeddings[start:start + block_size], dtype=np.float32)
+        faiss.normalize_L2(block)
+        scores = np.hstack([best_scores, queries @ block.T])
+        ids = np.hstack([best_ids, np.broadcast_to(
+            np.arange(start, start + len(block)), (len(queries), len(block)))])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+
+    _, found = index.search(queries, k)
+    recall = np.mean([len(set(e) & set(f)) / k
+                      for e, f in zip(best_ids, found)])
+    return {'recall_at_k': round(float(recall), 4), 'recall_k': k,
+            'recall_queries': len(queries)}
+
+
+class IndexVectors:
+    """Read-only, array-like view of the vectors stored in a FAISS index.
+
+    Stands in for ``embeddings.npy`` when a build kept only the index
+    (``--single_copy``); rows (not uids) are decoded to FP16 on access.
+    """
+
+    def __init__(self, index):
+        self._owner = index     # keeps the wrapped index alive
+        self.index = base_index(index)
+        self.shape = (index.ntotal, index.d)
 
-    index = faiss.IndexFlatIP(EMBEDDING_DIM)
-    index.add(embeddings_f32)
+    def __len__(self) -> int:
+        return self.shape[0]
 
-    print(f"FAISS index: {index.ntotal} vectors")
-    return index
+    def __getitem__(self, rows) -> np.ndarray:
+        if isinstance(rows, (int, np.integer)):
+            return self.index.reconstruct(int(rows)).astype(np.float16)
+        if isinstance(rows, slice):
+            start, stop, _ = rows.indices(len(self))
+            vectors = self.index.reconstruct_n(start, max(stop - start, 0))
+        else:
+            vectors = self.index.reconstruct_batch(
+                np.asarray(rows, dtype=np.int64))
+        return vectors.astype(np.float16)
 
 
 # ── I/O ──────────────────────────────────────────────────────────────────────
 
-def save_outputs(output_dir: Path, chunks, metadata, embeddings, index, stats):
-    """Write all build artifacts to *output_dir*."""
+def make_fingerprint(timestamp: str, model_name: str, ntotal: int) -> str:
+    """Identity of one index state; query caches key results by it."""
+    return hashlib.sha256(
+        f"{timestamp}\0{model_name}\0{ntotal}".encode()
+    ).hexdigest()[:16]
+
+
+def _tmp_path(path: Path) -> Path:
+    """Sibling path used to write *path* before atomically replacing it."""
+    return path.with_name(path.name + '.tmp')
+
+
+def save_outputs(output_dir: Path, embeddings, index, stats,
+                 single_copy: bool = False, centroids=None,
+                 stages: Optional[Stages] = None):
+    """Write all build artifacts to *output_dir*.
+
+    ``chunks.jsonl``, ``metadata.jsonl`` and the ``chunk_store/`` directory
+    are streamed to temporary siblings during the build, and *embeddings*
+    is a memory map of the temporary ``embeddings.npy``. Each artifact is
+    renamed over the previous one only here, so an incremental build that
+    reads *output_dir* never observes a half-written file. Writing them is
+    timed as the ``save`` stage, and the report includes every stage of
+    *stages*.
+    """
     import faiss
 
     output_dir.mkdir(parents=True, exist_ok=True)
     timestamp = datetime.utcnow().isoformat() + 'Z'
+    stages = stages if stages is not None else Stages()
+    with stages.stage('save', items=index.ntotal):
+        for name in ("chunks.jsonl", "metadata.jsonl"):
+            path = output_dir / name
+            os.replace(_tmp_path(path), path)
+            print(f"Saved: {path}")
+
+        # Random-access chunk store (see chunk_store.py)
+        store_path = output_dir / STORE_DIRNAME
+        replace_store(_tmp_path(store_path), store_path)
+        print(f"Saved: {store_path}/")
+
+        # FAISS index
+        index_path = output_dir / "faiss.index"
+        faiss.write_index(index, str(_tmp_path(index_path)))
+        os.replace(_tmp_path(index_path), index_path)
+        print(f"Saved: {index_path}")
+
+        # Document-centroid index for per-document search (see doc_index.py)
+        if centroids is not None:
+            doc_index_path = output_dir / DOC_INDEX_FILENAME
+            write_doc_index(_tmp_path(doc_index_path), centroids)
+            os.replace(_tmp_path(doc_index_path), doc_index_path)
+            print(f"Saved: {doc_index_path}")
+
+        # Embeddings backup (already on disk, stitched from shards). A
+        # single-copy build keeps the vectors only in the FP16 index.
+        embeddings_path = output_dir / "embeddings.npy"
+        n_embeddings = len(embeddings)
+        if single_copy:
+            del embeddings
+            _tmp_path(embeddings_path).unlink()
+            if embeddings_path.exists():
+                embeddings_path.unlink()
+            print(f"Skipped: {embeddings_path} (vectors kept in the index only)")
+        else:
+            embeddings.flush()
+            os.replace(_tmp_path(embeddings_path), embeddings_path)
+            print(f"Saved: {embeddings_path}")
 
-    # chunks.jsonl
-    chunks_path = output_dir / "chunks.jsonl"
-    with open(chunks_path, 'w') as f:
-        for chunk in chunks:
-            f.write(json.dumps(chunk) + '\n')
-    print(f"Saved: {chunks_path}")
-
-    # metadata.jsonl
-    metadata_path = output_dir / "metadata.jsonl"
-    with open(metadata_path, 'w') as f:
-        for doc in metadata:
-            f.write(json.dumps(doc) + '\n')
-    print(f"Saved: {metadata_path}")
-
-    # FAISS index
-    index_path = output_dir / "faiss.index"
-    faiss.write_index(index, str(index_path))
-    print(f"Saved: {index_path}")
-
-    # Embeddings backup
-    embeddings_path = output_dir / "embeddings.npy"
-    np.save(embeddings_path, embeddings)
-    print(f"Saved: {embeddings_path}")
-
-    # Report
+    # Report. The fingerprint changes with every build; query caches use it
+    # to drop results memoized against an older index.
     report = {
         'build_timestamp': timestamp,
-        'embedding_model': EMBEDDING_MODEL,
+        'index_fingerprint': make_fingerprint(timestamp,
+                                              stats['encoder']['model'],
+                                              index.ntotal),
+        'embedding_model': stats['encoder']['model'],
         'embedding_dim': EMBEDDING_DIM,
         'fp16': FP16,
-        'batch_size': BATCH_SIZE,
+        'index': stats['index'],
+        'device': stats['encoder']['device'],
+        'batching': stats['encoder']['batching'],
+        'encoding': stats['encoder']['throughput'],
+        'quantization': stats['encoder']['quantization'],
+        'extraction_workers': stats['workers'],
+        'chunking': stats['chunking'],
         'stats': {
             'pdf_count': stats['total_pdfs'],
             'docs_indexed': stats['processed'],
@@ -315,9 +1081,36 @@ def save_outputs(output_dir: Path, chunks, metadata, embeddings, index, stats):
             'faiss_ntotal': index.ntotal,
             'empty_text_docs': stats['empty_text'],
             'low_text_docs': stats['low_text'],
+            'failed_docs': stats['failed'],
+            'timed_out_docs': stats['timed_out'],
+        },
+        'failures': stats['failures'],
+        'incremental': stats.get('incremental'),
+        'dedup': stats.get('dedup'),
+        'extract_cache': stats.get('extract_cache'),
+        'embedding_cache': stats.get('embedding_cache'),
+        'sharding': stats.get('sharding'),
+        'doc_index': stats.get('doc_index'),
+        # Stable chunk ids (uids) run 0..n-1 after a build; update_index.py
+        # continues from next_uid and counts removed-but-present chunks
+        'ids': {'next_uid': index.ntotal, 'tombstones': 0},
+        'storage': {
+            'index_bytes': index_path.stat().st_size,
+            'embeddings_bytes': (None if single_copy
+                                 else embeddings_path.stat().st_size),
+            'single_copy': single_copy,
         },
+        'memory': stats.get('memory'),
+        'pipeline': stats.get('pipeline'),
+        # Wall / CPU / RSS / throughput per stage (see instrument.py)
+        'stages': stages.report(),
+        # Process-wide: pdftotext and worker processes, not split by stage
+        'children_cpu_s': stages.children_cpu_s(),
+        'profiles': stages.profile_dir and str(stages.profile_dir),
         'integrity': {
-            'alignment_verified': index.ntotal == len(chunks),
+            'alignment_verified': (
+                index.ntotal == stats['total_chunks'] == n_embeddings
+            ),
         },
         'extraction_quality': {
             'empty_text_pct': round(100 * stats['empty_text'] / max(stats['total_pdfs'], 1), 2),
@@ -333,68 +1126,458 @@ def save_outputs(output_dir: Path, chunks, metadata, embeddings, index, stats):
     return report
 
 
+# ── Incremental rebuilds ─────────────────────────────────────────────────────
+
+def load_previous_build(output_dir: Path, chunking: Dict,
+                        model_name: str) -> Optional[Dict]:
+    """Load a previous build from *output_dir* for reuse.
+
+    Returns ``{'docs': {filename: {...}}, 'embeddings': array,
+    'chunks_file': file}`` (for a ``--single_copy`` build, ``embeddings``
+    decodes rows from the previous index) where each document entry holds
+    its metadata, the ``(start, end)`` embedding rows its chunks occupy and
+    the byte range of those chunks in the previous ``chunks.jsonl``. Chunk
+    texts stay on disk until ``read_previous_chunks`` needs them. Returns
+    None when there is nothing that can safely be reused: missing
+    artifacts, a different model or chunking configuration, or chunks and
+    embeddings that are out of alignment.
+    Documents that failed extraction last time are left out so they are
+    retried, as are documents --dedup shortened.
+    """
+    report_path = output_dir / "index_report.json"
+    report: Dict = {}
+    if report_path.exists():
+        with open(report_path) as f:
+            report = json.load(f)
+    single_copy = (report.get('storage') or {}).get('single_copy', False)
+    vectors_path = output_dir / ("faiss.index" if single_copy
+                                 else "embeddings.npy")
+    needed = [report_path, output_dir / "chunks.jsonl",
+              output_dir / "metadata.jsonl", vectors_path]
+    missing = [p.name for p in needed if not p.exists()]
+    if missing:
+        print(f"  No previous build to reuse (missing {', '.join(missing)})")
+        return None
+
+    if report.get('embedding_model') != model_name:
+        print(f"  Previous build used {report.get('embedding_model')}; "
+              f"rebuilding everything")
+        return None
+    if report.get('chunking') != chunking:
+        print("  Chunking parameters changed (or were not recorded); "
+              "rebuilding everything")
+        return None
+
+    if single_copy:
+        import faiss
+        embeddings = IndexVectors(faiss.read_index(str(vectors_path)))
+    else:
+        embeddings = np.load(vectors_path, mmap_mode='r')
+    failed = {f['filename'] for f in report.get('failures', [])}
+
+    docs: Dict[str, Dict] = {}
+    with open(output_dir / "metadata.jsonl") as f:
+        for line in f:
+            meta = json.loads(line)
+            # Deduplicated documents lack some of their chunks; they are
+            # processed again so that nothing is lost if the copy they
+            # point to has gone
+            deduplicated = 'duplicate_of' in meta or 'duplicate_chunks' in meta
+            if meta['filename'] not in failed and not deduplicated:
+                docs[meta['filename']] = {'meta': meta, 'rows': (0, 0),
+                                          'offsets': (0, 0)}
+
+    # Chunks removed by update_index.py stay in place until compaction;
+    # their rows are never reused
+    tombstones = set(read_tombstones(output_dir / STORE_DIRNAME).tolist())
+    chunks_file = open(output_dir / "chunks.jsonl", 'rb')
+    row = 0
+    offset = 0
+    for line in chunks_file:
+        chunk = json.loads(line)
+        doc = docs.get(chunk['filename'])
+        if doc is not None and chunk.get('uid', row) not in tombstones:
+            if doc['rows'][1] == 0:
+                doc['rows'] = (row, row)
+                doc['offsets'] = (offset, offset)
+            doc['rows'] = (doc['rows'][0], row + 1)
+            doc['offsets'] = (doc['offsets'][0], offset + len(line))
+        row += 1
+        offset += len(line)
+
+    if row != embeddings.shape[0]:
+        print(f"  Previous build is misaligned ({row} chunks, "
+              f"{embeddings.shape[0]} embeddings); rebuilding everything")
+        chunks_file.close()
+        return None
+
+    print(f"  Previous build: {len(docs)} documents, {row} chunks")
+    return {'docs': docs, 'embeddings': embeddings, 'chunks_file': chunks_file}
+
+
+def read_previous_chunks(previous: Dict, doc: Dict) -> List[Dict]:
+    """Read one document's chunks back from the previous ``chunks.jsonl``."""
+    start, end = doc['offsets']
+    chunks_file = previous['chunks_file']
+    chunks_file.seek(start)
+    return [json.loads(line) for line in
+            chunks_file.read(end - start).splitlines()]
+
+
 # ── Pipeline ─────────────────────────────────────────────────────────────────
 
-def process_pdfs(pdf_dir: Path, skip_set: set,
-                 chunk_target: int, chunk_overlap: int, chunk_min: int):
-    """Extract text from all PDFs, chunk, and collect metadata."""
-    pdfs = sorted(pdf_dir.glob("*.pdf"))
-    print(f"Found {len(pdfs)} PDFs in {pdf_dir}")
+def process_document(pdf_path: Path, chunk_target: int,
+                     chunk_overlap: int, chunk_min: int,
+                     previous_sha256: Optional[str] = None,
+                     extract_cache: Optional[str] = None,
+                     stages: Optional[Stages] = None) -> Dict:
+    """Extract, hash, parse metadata and chunk a single PDF.
 
-    all_chunks: List[Dict] = []
-    all_metadata: List[Dict] = []
-    stats = {
-        'total_pdfs': len(pdfs),
+    Runs in the parent process for serial builds and in a pool worker
+    for ``--workers N``. Extraction failures do not raise: the document
+    is kept with empty text and the error is returned alongside it.
+
+    If the file still hashes to *previous_sha256*, extraction is skipped
+    and ``result['reused']`` is set so the caller can take the document's
+    metadata and chunks from the previous build.
+
+    With *extract_cache* (a directory), per-page text is read from or
+    added to the extraction cache and ``result['extract_cached']`` says
+    which.
+
+    Hashing, extraction and chunking are timed into *stages*; without it
+    (in a pool worker) their totals come back in ``result['stages']``.
+    """
+    timer = stages if stages is not None else Stages()
+    with timer.stage('hash', items=1, thread_cpu=True):
+        sha256 = compute_sha256(pdf_path)
+    if previous_sha256 is not None and sha256 == previous_sha256:
+        result = {'meta': None, 'chunks': [], 'error': None, 'reused': True}
+        if stages is None:
+            result['stages'] = timer.totals()
+        return result
+
+    error = None
+    cache = (ExtractCache(Path(extract_cache), extractor_version())
+             if extract_cache else None)
+    cached = False
+    with timer.stage('extract', items=1, thread_cpu=True):
+        try:
+            pages, cached = extract_pages(pdf_path, sha256, cache)
+        except subprocess.TimeoutExpired:
+            print(f"  ERROR extracting {pdf_path.name}: timed out "
+                  f"after {EXTRACT_TIMEOUT}s")
+            pages, error = [], 'timeout'
+        except Exception as e:
+            print(f"  ERROR extracting {pdf_path.name}: {e}")
+            pages, error = [], str(e)
+    text = '\x0c'.join(pages)
+    page_count = len(pages) if text else 0
+
+    doc_id = pdf_path.stem
+    meta = parse_metadata(text, pdf_path.name)
+    meta['doc_id'] = doc_id
+    meta['filename'] = pdf_path.name
+    meta['sha256'] = sha256
+    meta['bytes'] = pdf_path.stat().st_size
+    meta['pages'] = page_count
+
+    text_len = len(text.strip())
+    if text_len < 100:
+        meta['extraction_quality'] = 'empty'
+    elif text_len < 1000:
+        meta['extraction_quality'] = 'low'
+    else:
+        meta['extraction_quality'] = 'ok'
+
+    chunks: List[Dict] = []
+    if text_len >= 100:
+        with timer.stage('chunk', thread_cpu=True) as record:
+            chunks = chunk_text(text, chunk_target, chunk_overlap, chunk_min,
+                                page_starts(pages))
+            record['items'] = len(chunks)
+        for chunk in chunks:
+            chunk['doc_id'] = doc_id
+            chunk['filename'] = pdf_path.name
+            chunk['title'] = meta.get('title', '')
+            chunk['year'] = meta.get('year')
+    meta['chunk_count'] = len(chunks)
+
+    result = {'meta': meta, 'chunks': chunks, 'error': error, 'reused': False}
+    if cache is not None and error is None:
+        result['extract_cached'] = cached
+    if stages is None:
+        result['stages'] = timer.totals()
+    return result
+
+
+def iter_documents(pdfs: List[Path], skip_set: set,
+                   chunk_target: int, chunk_overlap: int, chunk_min: int,
+                   workers: int = 1,
+                   previous_hashes: Optional[Dict[str, str]] = None,
+                   extract_cache: Optional[str] = None,
+                   stages: Optional[Stages] = None
+                   ) -> Iterator[Tuple[int, Path, Dict]]:
+    """Yield ``(position, pdf_path, result)`` for every non-skipped PDF.
+
+    Results are always yielded in *pdfs* order, so parallel builds write
+    the same chunk and metadata order as serial ones. With ``workers > 1``
+    documents are processed on a process pool with a bounded window of
+    in-flight submissions. A document whose worker raises is yielded with
+    ``result['meta'] is None`` and the exception text in ``result['error']``.
+
+    *previous_hashes* maps filenames to their SHA-256 in a previous build;
+    unchanged files come back with ``result['reused']`` set.
+    *extract_cache* is passed on to ``process_document``. Per-document
+    stage times are added to *stages*, including those measured in workers.
+    """
+    params = (chunk_target, chunk_overlap, chunk_min)
+    previous_hashes = previous_hashes or {}
+    todo = []
+    for i, pdf_path in enumerate(pdfs):
+        if pdf_path.name in skip_set:
+            print(f"[{i+1}/{len(pdfs)}] Skipping (skip list): {pdf_path.name}")
+            continue
+        todo.append((i, pdf_path))
+
+    if workers <= 1:
+        for i, pdf_path in todo:
+            try:
+                result = process_document(pdf_path, *params,
+                                          previous_hashes.get(pdf_path.name),
+                                          extract_cache, stages)
+            except Exception as e:
+                result = {'meta': None, 'chunks': [], 'error': str(e),
+                          'reused': False}
+            yield i, pdf_path, result
+        return
+
+    window = workers * 4
+    todo_iter = iter(todo)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending: deque = deque()
+
+        def _submit_next() -> None:
+            item = next(todo_iter, None)
+            if item is not None:
+                future = pool.submit(process_document, item[1], *params,
+                                     previous_hashes.get(item[1].name),
+                                     extract_cache)
+                pending.append((item[0], item[1], future))
+
+        for _ in range(window):
+            _submit_next()
+        while pending:
+            i, pdf_path, future = pending.popleft()
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'meta': None, 'chunks': [],
+                          'error': str(e) or type(e).__name__,
+                          'reused': False}
+            worker_stages = result.pop('stages', None)
+            if stages is not None and worker_stages:
+                stages.merge(worker_stages)
+            _submit_next()
+            yield i, pdf_path, result
+
+
+def new_stats(n_pdfs: int, workers: int, chunk_target: int,
+              chunk_overlap: int, chunk_min: int) -> Dict:
+    """Counters filled in while documents stream through the build."""
+    return {
+        'total_pdfs': n_pdfs,
         'processed': 0,
         'empty_text': 0,
         'low_text': 0,
         'total_chunks': 0,
+        'failed': 0,
+        'timed_out': 0,
+        'failures': [],
+        'workers': workers,
+        'chunking': {
+            'target': chunk_target,
+            'overlap': chunk_overlap,
+            'min': chunk_min,
+        },
     }
 
-    for i, pdf_path in enumerate(pdfs):
-        if pdf_path.name in skip_set:
-            print(f"[{i+1}/{len(pdfs)}] Skipping (skip list): {pdf_path.name}")
-            continue
 
+def iter_chunk_batches(documents: Iterator[Tuple[int, Path, Dict]],
+                       n_pdfs: int, stats: Dict, previous: Optional[Dict],
+                       chunks_file, metadata_file, batch_size: int,
+                       chunk_store: Optional[ChunkStoreWriter] = None,
+                       dedup: Optional[Deduplicator] = None
+                       ) -> Iterator[Tuple[List[Dict], List[int]]]:
+    """Stream per-document results into fixed-size chunk batches.
+
+    Each document's metadata and chunks are written to *metadata_file* and
+    *chunks_file* (and *chunk_store*, if given) as soon as it arrives, and
+    its chunks are buffered only until a batch of *batch_size* is full.
+    Yields ``(chunks, reuse_rows)``, where ``reuse_rows`` gives each chunk's
+    row in the *previous* build's embeddings (-1 for chunks that need
+    embedding). *stats* is updated in place as documents are consumed.
+
+    With *dedup*, exact duplicate documents and near-duplicate chunks are
+    dropped here, before they reach a batch, and recorded as aliases of
+    the chunk that was kept (in *chunk_store*).
+    """
+    previous_docs = previous['docs'] if previous else {}
+    seen: set = set()
+    reused_docs = 0
+    reused_chunks = 0
+    batch: List[Dict] = []
+    batch_rows: List[int] = []
+
+    for i, pdf_path, result in documents:
         if i % 50 == 0:
-            print(f"[{i+1}/{len(pdfs)}] Processing: {pdf_path.name}")
-
-        doc_id = pdf_path.stem
-        text, page_count = extract_text(pdf_path)
-        meta = parse_metadata(text, pdf_path.name)
-        meta['doc_id'] = doc_id
-        meta['filename'] = pdf_path.name
-        meta['sha256'] = compute_sha256(pdf_path)
-        meta['bytes'] = pdf_path.stat().st_size
-        meta['pages'] = page_count
-
-        text_len = len(text.strip())
-        if text_len < 100:
+            print(f"[{i+1}/{n_pdfs}] Processing: {pdf_path.name}")
+
+        if result['reused']:
+            doc = previous_docs[pdf_path.name]
+            result['meta'] = doc['meta']
+            result['chunks'] = read_previous_chunks(previous, doc)
+            rows = list(range(*doc['rows']))
+            reused_docs += 1
+            reused_chunks += len(rows)
+        else:
+            rows = [-1] * len(result['chunks'])
+
+        if result['error'] is not None:
+            if result['error'] == 'timeout':
+                stats['timed_out'] += 1
+            stats['failures'].append({
+                'filename': pdf_path.name,
+                'error': result['error'],
+            })
+
+        meta = result['meta']
+        if meta is None:
+            print(f"  ERROR processing {pdf_path.name}: {result['error']}")
+            stats['failed'] += 1
+            continue
+
+        if 'extract_cached' in result:
+            stats['extract_cache']['hits' if result['extract_cached']
+                                   else 'misses'] += 1
+
+        if meta['extraction_quality'] == 'empty':
             stats['empty_text'] += 1
-            meta['extraction_quality'] = 'empty'
-        elif text_len < 1000:
+        elif meta['extraction_quality'] == 'low':
             stats['low_text'] += 1
-            meta['extraction_quality'] = 'low'
-        else:
-            meta['extraction_quality'] = 'ok'
-
-        if text_len >= 100:
-            chunks = chunk_text(text, chunk_target, chunk_overlap, chunk_min)
-            for chunk in chunks:
-                chunk['doc_id'] = doc_id
-                chunk['filename'] = pdf_path.name
-                chunk['title'] = meta.get('title', '')
-                chunk['year'] = meta.get('year')
-                all_chunks.append(chunk)
-            meta['chunk_count'] = len(chunks)
-            stats['total_chunks'] += len(chunks)
-        else:
-            meta['chunk_count'] = 0
 
-        all_metadata.append(meta)
+        chunks = result['chunks']
+        if dedup is not None:
+            keep, aliases = dedup.filter_document(meta, chunks,
+                                                  stats['total_chunks'])
+            chunks = [chunks[j] for j in keep]
+            rows = [rows[j] for j in keep]
+            if chunk_store is not None:
+                for uid, chunk, similarity in aliases:
+                    chunk_store.add_alias(uid, chunk, similarity)
+
+        metadata_file.write(json.dumps(meta) + '\n')
+        for j, (chunk, row) in enumerate(zip(chunks, rows)):
+            chunk['uid'] = stats['total_chunks'] + j
+            chunks_file.write(json.dumps(chunk) + '\n')
+            if chunk_store is not None:
+                chunk_store.add(chunk)
+            batch.append(chunk)
+            batch_rows.append(row)
+            if len(batch) == batch_size:
+                yield batch, batch_rows
+                batch, batch_rows = [], []
+        stats['total_chunks'] += len(chunks)
         stats['processed'] += 1
-
-    return all_chunks, all_metadata, stats
+        seen.add(meta['filename'])
+
+    if batch:
+        yield batch, batch_rows
+
+    if previous is not None:
+        stats['incremental'] = {
+            'reused_docs': reused_docs,
+            'changed_or_new_docs': stats['processed'] - reused_docs,
+            'removed_docs': len(set(previous_docs) - seen),
+            'reused_chunks': reused_chunks,
+            'embedded_chunks': stats['total_chunks'] - reused_chunks,
+        }
+
+
+def overlap_stages(batches: Iterator, depth: int, timings: Dict) -> Iterator:
+    """Run the *batches* producer on a thread, feeding a bounded queue.
+
+    Extraction and chunking (the producer) then proceed while the caller
+    embeds the previous batch (the consumer). At most *depth* batches wait
+    in the queue; a full queue blocks the producer, which bounds memory.
+    Per-stage busy and idle seconds are written to *timings* when the
+    stream is exhausted: producer idle time is time blocked on a full
+    queue, consumer idle time is time waiting for the next batch.
+    Exceptions raised by the producer are re-raised in the caller.
+    """
+    queue: Queue = Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+    done = object()
+    producer = {'wall': 0.0, 'idle': 0.0}
+
+    def _put(item) -> None:
+        waited = time.perf_counter()
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                break
+            except Full:
+                continue
+        producer['idle'] += time.perf_counter() - waited
+
+    def _produce() -> None:
+        started = time.perf_counter()
+        try:
+            for batch in batches:
+                _put(batch)
+                if stop.is_set():
+                    return
+            _put(done)
+        except BaseException as e:
+            _put(e)
+        finally:
+            close = getattr(batches, 'close', None)
+            if close is not None:
+                close()
+            producer['wall'] = time.perf_counter() - started
+
+    thread = threading.Thread(target=_produce, name='extract', daemon=True)
+    consumer_idle = 0.0
+    started = time.perf_counter()
+    thread.start()
+    try:
+        while True:
+            waited = time.perf_counter()
+            while True:
+                try:
+                    item = queue.get(timeout=0.1)
+                    break
+                except Empty:
+                    if not thread.is_alive() and queue.empty():
+                        raise RuntimeError("extraction thread exited early")
+            consumer_idle += time.perf_counter() - waited
+            if item is done:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+        wall = time.perf_counter() - started
+        timings['extract'] = {
+            'busy_s': round(producer['wall'] - producer['idle'], 3),
+            'idle_s': round(producer['idle'], 3),
+        }
+        timings['embed'] = {
+            'busy_s': round(wall - consumer_idle, 3),
+            'idle_s': round(consumer_idle, 3),
+        }
 
 
 def main():
@@ -413,8 +1596,106 @@ def main():
                         help='Minimum chunk size in tokens (default: 200)')
     parser.add_argument('--skip_list',
                         help='File listing PDF filenames to skip (one per line)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes for extraction and chunking '
+                             '(default: 1, serial)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Reuse chunks and embeddings of unchanged PDFs '
+                             'from the build already in --output_dir')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Drop exact duplicate PDFs and near-duplicate '
+                             'chunks before embedding; they become aliases '
+                             'of the chunk that is kept')
+    parser.add_argument('--dedup_threshold', type=float,
+                        default=DEDUP_THRESHOLD,
+                        help='Estimated Jaccard similarity (word 5-gram '
+                             'shingles) at which chunks count as duplicates '
+                             f'(default: {DEDUP_THRESHOLD})')
+    parser.add_argument('--extract_cache',
+                        help='Directory of cached per-page pdftotext output, '
+                             'shared between builds (e.g. '
+                             '~/.cache/corpus-text)')
+    parser.add_argument('--embedding_cache',
+                        help='Directory of a persistent embedding cache '
+                             'shared across builds')
+    parser.add_argument('--embedding_cache_max_gb', type=float, default=20.0,
+                        help='Evict least recently used cache entries above '
+                             'this size (default: 20)')
+    parser.add_argument('--shard_size', type=int, default=SHARD_SIZE,
+                        help='Chunks per checkpointed embedding shard '
+                             f'(default: {SHARD_SIZE})')
+    parser.add_argument('--resume', action='store_true',
+                        help='Keep embedding shards completed by an '
+                             'interrupted build and continue from there')
+    parser.add_argument('--device', choices=['auto', 'cuda', 'cpu'],
+                        default='auto',
+                        help='Encoding device; auto uses CUDA when available '
+                             '(default: auto)')
+    parser.add_argument('--encoder', choices=['e5', 'stub'], default='e5',
+                        help='e5 for intfloat/e5-large-v2, stub for '
+                             'deterministic hash vectors in smoke tests '
+                             '(default: e5)')
+    parser.add_argument('--batch_tokens', type=int,
+                        help='Padded-token budget per length-bucketed batch '
+                             f'(default: {BATCH_TOKENS["cuda"]} on CUDA, '
+                             f'{BATCH_TOKENS["cpu"]} on CPU)')
+    parser.add_argument('--fixed_batches', action='store_true',
+                        help=f'Encode in document order, {BATCH_SIZE} chunks '
+                             'per batch, instead of length-bucketed batches')
+    parser.add_argument('--encode_workers', type=int, default=1,
+                        help='CPU encoder processes, each with its own model '
+                             'copy (default: 1, in-process)')
+    parser.add_argument('--threads_per_worker', type=int,
+                        help='Torch intra-op threads per encoder process '
+                             '(default: cores / encode_workers)')
+    parser.add_argument('--quantize', choices=QUANTIZE_MODES,
+                        help='Dynamically quantize the CPU model; refused '
+                             'unless --quantize_check recorded a pass')
+    parser.add_argument('--quantize_check',
+                        help='quantization_check.json from check_quantized.py')
+    parser.add_argument('--pipeline_depth', type=int, default=PIPELINE_DEPTH,
+                        help='Chunk batches buffered between extraction and '
+                             'embedding, which then overlap; 0 runs them in '
+                             f'lockstep (default: {PIPELINE_DEPTH})')
+    parser.add_argument('--index_type', choices=INDEX_TYPES, default='flat',
+                        help='FAISS index type (default: flat, exact search)')
+    parser.add_argument('--single_copy', action='store_true',
+                        help='With --index_type sq_fp16, keep the vectors '
+                             'only in the index (no embeddings.npy)')
+    parser.add_argument('--nlist', type=int,
+                        help='IVF lists (default: ~4*sqrt(chunks))')
+    parser.add_argument('--nprobe', type=int, default=NPROBE,
+                        help=f'Default IVF lists probed per query '
+                             f'(default: {NPROBE})')
+    parser.add_argument('--pq_m', type=int, default=PQ_M,
+                        help=f'IVF-PQ sub-quantizers (default: {PQ_M})')
+    parser.add_argument('--pq_nbits', type=int, default=PQ_NBITS,
+                        help=f'Bits per PQ code (default: {PQ_NBITS})')
+    parser.add_argument('--hnsw_m', type=int, default=HNSW_M,
+                        help=f'HNSW neighbours per node (default: {HNSW_M})')
+    parser.add_argument('--ef_construction', type=int, default=EF_CONSTRUCTION,
+                        help=f'HNSW build breadth (default: {EF_CONSTRUCTION})')
+    parser.add_argument('--ef_search', type=int, default=EF_SEARCH,
+                        help=f'Default HNSW search breadth '
+                             f'(default: {EF_SEARCH})')
+    parser.add_argument('--shard_manifest',
+                        help='Register the output as a shard in this manifest '
+                             '(see shards.py; created if missing)')
+    parser.add_argument('--shard_name',
+                        help='Shard name in --shard_manifest (default: the '
+                             'output directory name)')
+    parser.add_argument('--profile',
+                        help='Directory to write a cProfile dump and summary '
+                             'of each build stage to')
     args = parser.parse_args()
 
+    if args.single_copy and args.index_type != 'sq_fp16':
+        parser.error("--single_copy requires --index_type sq_fp16, whose "
+                     "vectors are the FP16 embeddings themselves")
+    if args.index_type == 'ivf_pq' and EMBEDDING_DIM % args.pq_m:
+        parser.error(f"--pq_m must divide the embedding dimension "
+                     f"({EMBEDDING_DIM})")
+
     pdf_dir = Path(args.pdf_dir)
     output_dir = Path(args.output_dir)
 
@@ -439,31 +1720,206 @@ def main():
     print(f"  Chunk target  : {args.chunk_target} tokens")
     print(f"  Chunk overlap : {args.chunk_overlap} tokens")
     print(f"  Chunk minimum : {args.chunk_min} tokens")
+    print(f"  Workers       : {args.workers}")
+    print(f"  Incremental   : {args.incremental}")
+    print(f"  Dedup         : {args.dedup_threshold if args.dedup else 'off'}")
+    print(f"  Extract cache : {args.extract_cache or 'off'}")
+    print(f"  Embed cache   : {args.embedding_cache or 'off'}")
+    print(f"  Profile       : {args.profile or 'off'}")
     print("=" * 60)
 
-    # Step 1: Extract and chunk
-    print("\n[1/4] Extracting and chunking PDFs ...")
-    chunks, metadata, stats = process_pdfs(
-        pdf_dir, skip_set,
-        args.chunk_target, args.chunk_overlap, args.chunk_min
-    )
-    print(f"  {len(chunks)} chunks from {stats['processed']} documents")
+    stages = Stages(Path(args.profile) if args.profile else None)
+
+    quantization = None
+    if args.quantize:
+        try:
+            quantization = require_quantization_check(
+                args.quantize_check, args.quantize, 'build',
+                model_label(args.encoder)
+            )
+        except RuntimeError as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+
+    with stages.stage('load_model'):
+        encoder = load_encoder(args.encoder, args.device, args.batch_tokens,
+                               workers=args.encode_workers,
+                               threads=args.threads_per_worker,
+                               bucketed=not args.fixed_batches,
+                               batch_size=BATCH_SIZE, quantize=args.quantize)
+    print(f"Encoder: {encoder.name} on {encoder.device}")
+
+    previous = None
+    if args.incremental:
+        print("\nLoading previous build ...")
+        previous = load_previous_build(output_dir, {
+            'target': args.chunk_target,
+            'overlap': args.chunk_overlap,
+            'min': args.chunk_min,
+        }, encoder.name)
+
+    cache = None
+    if args.embedding_cache:
+        try:
+            cache = EmbeddingCache(
+                Path(args.embedding_cache).expanduser(), EMBEDDING_DIM,
+                int(args.embedding_cache_max_gb * 1024 ** 3),
+            )
+        except RuntimeError as e:
+            print(f"  WARNING: {e}; continuing without the cache")
+
+    def _embed_batch(chunks: List[Dict], reuse_rows: List[int]) -> np.ndarray:
+        with stages.stage('embed', items=len(chunks)):
+            if previous is not None:
+                return embed_incremental(chunks, reuse_rows,
+                                         previous['embeddings'], encoder,
+                                         cache)
+            return generate_embeddings(chunks, encoder, cache)
+
+    # Step 1: Extract, chunk, embed and index, one batch at a time
+    print("\n[1/3] Extracting, chunking and embedding PDFs (streaming) ...")
+    pdfs = sorted(pdf_dir.glob("*.pdf"))
+    print(f"Found {len(pdfs)} PDFs in {pdf_dir}")
+    stats = new_stats(len(pdfs), args.workers, args.chunk_target,
+                      args.chunk_overlap, args.chunk_min)
+    stats['encoder'] = {
+        'quantization': quantization and {
+            'mode': quantization['mode'],
+            'top_k': quantization['top_k'],
+            'agreement': quantization['uses']['build']['overlap'],
+        },
+        'model': encoder.name,
+        'device': encoder.device,
+        'batching': (
+            {'mode': 'tokens', 'batch_tokens': encoder.batch_tokens}
+            if encoder.bucketed else
+            {'mode': 'fixed', 'batch_size': BATCH_SIZE}
+        ),
+    }
+    dedup = Deduplicator(args.dedup_threshold) if args.dedup else None
+    extract_cache = None
+    if args.extract_cache:
+        extract_cache = str(Path(args.extract_cache).expanduser())
+        stats['extract_cache'] = {'hits': 0, 'misses': 0}
+    previous_hashes = {
+        name: doc['meta']['sha256']
+        for name, doc in (previous['docs'] if previous else {}).items()
+    }
+
+    shard_dir = output_dir / "shards"
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    # Flat and FP16 indexes are filled shard by shard; the others are built
+    # from the stitched embeddings in step 2.
+    index = (new_faiss_index(args.index_type)
+             if args.index_type in STREAMED_INDEX_TYPES else None)
+    try:
+        with open(_tmp_path(output_dir / "chunks.jsonl"), 'w') as chunks_file, \
+                open(_tmp_path(output_dir / "metadata.jsonl"), 'w') as metadata_file, \
+                ChunkStoreWriter(_tmp_path(output_dir / STORE_DIRNAME)) as chunk_store:
+            documents = iter_documents(
+                pdfs, skip_set, args.chunk_target, args.chunk_overlap,
+                args.chunk_min, args.workers, previous_hashes, extract_cache,
+                stages,
+            )
+            batches = iter_chunk_batches(
+                documents, len(pdfs), stats, previous,
+                chunks_file, metadata_file, args.shard_size, chunk_store,
+                dedup,
+            )
+            if args.pipeline_depth > 0:
+                stats['pipeline'] = {'depth': args.pipeline_depth, 'stages': {}}
+                batches = overlap_stages(batches, args.pipeline_depth,
+                                         stats['pipeline']['stages'])
+            shard_paths, stats['sharding'] = embed_in_shards(
+                batches, shard_dir, args.shard_size, args.resume,
+                _embed_batch, index, encoder.name, stages,
+            )
+    finally:
+        encoder.close()
+        stats['encoder']['throughput'] = encoder.report()
+        if cache is not None:
+            cache.close()
+            stats['embedding_cache'] = cache.report()
+
+    print(f"  {stats['total_chunks']} chunks from {stats['processed']} documents")
+    if dedup is not None:
+        stats['dedup'] = dedup.report()
+        print(f"  Deduplication: {stats['dedup']['chunks_collapsed']} chunks "
+              f"collapsed ({stats['dedup']['exact_duplicate_docs']} duplicate "
+              f"documents, {stats['dedup']['near_duplicate_chunks']} "
+              f"near-duplicate chunks)")
+    if extract_cache:
+        stats['extract_cache'].update(
+            ExtractCache(Path(extract_cache), extractor_version()).report())
+        print(f"  Extraction cache: {stats['extract_cache']['hits']} hits, "
+              f"{stats['extract_cache']['misses']} extracted")
+    if stats['failures']:
+        print(f"  {len(stats['failures'])} documents reported errors "
+              f"({stats['timed_out']} timed out)")
+    if stats.get('pipeline'):
+        pipeline = stats['pipeline']['stages']
+        for name, t in pipeline.items():
+            print(f"  {name:8s}: busy {t['busy_s']:.1f}s, idle {t['idle_s']:.1f}s")
+        stats['pipeline']['bottleneck'] = max(
+            pipeline, key=lambda name: pipeline[name]['busy_s']
+        )
+    if 'incremental' in stats:
+        inc = stats['incremental']
+        print(f"  Reused {inc['reused_docs']} unchanged documents, "
+              f"{inc['changed_or_new_docs']} new or changed, "
+              f"{inc['removed_docs']} removed")
 
-    if not chunks:
+    if not stats['total_chunks']:
         print("ERROR: No chunks produced. Check PDF directory and extraction.")
         sys.exit(1)
 
-    # Step 2: Embed
-    print("\n[2/4] Generating embeddings ...")
-    embeddings = generate_embeddings(chunks)
-
-    # Step 3: Build FAISS index
-    print("\n[3/4] Building FAISS index ...")
-    index = build_faiss_index(embeddings)
-
-    # Step 4: Save
-    print("\n[4/4] Saving outputs ...")
-    report = save_outputs(output_dir, chunks, metadata, embeddings, index, stats)
+    # Step 2: Stitch shards into the embeddings backup
+    print("\n[2/3] Stitching embedding shards ...")
+    with stages.stage('stitch', items=stats['total_chunks']):
+        embeddings = stitch_shards(shard_paths, stats['total_chunks'],
+                                   _tmp_path(output_dir / "embeddings.npy"))
+    if index is None:
+        index_type, params = resolve_index_params(
+            args.index_type, len(embeddings), args.nlist, args.pq_m,
+            args.pq_nbits, args.hnsw_m, args.ef_construction, args.nprobe,
+            args.ef_search,
+        )
+        with stages.stage('index', items=len(embeddings)):
+            index, stats['index'] = build_faiss_index(embeddings, index_type,
+                                                      params)
+    else:
+        stats['index'] = {'type': args.index_type}
+        print(f"FAISS index: {index.ntotal} vectors ({args.index_type})")
+    if stats['index']['type'] != 'flat':
+        with stages.stage('recall'):
+            stats['index'].update(measure_recall(index, embeddings))
+        print(f"  Recall@{stats['index']['recall_k']} vs exact search: "
+              f"{stats['index']['recall_at_k']:.3f}")
+
+    # Pooled vector per document, aligned with the chunk store's ranges
+    started = time.time()
+    ranges = np.load(_tmp_path(output_dir / STORE_DIRNAME) / "doc_ranges.npy")
+    with stages.stage('doc_index', items=len(ranges)):
+        centroids = doc_centroids(embeddings, ranges)
+    stats['doc_index'] = {'documents': len(ranges),
+                          'build_sec': round(time.time() - started, 2)}
+    with stages.stage('recall'):
+        stats['doc_index'].update(measure_doc_recall(embeddings, ranges,
+                                                     centroids))
+    recall = stats['doc_index']['recall_at_candidates']
+    print(f"Document index: {len(ranges)} documents; per-document "
+          f"recall@{stats['doc_index']['recall_k']} vs exhaustive: " +
+          ', '.join(f"{recall[c]:.3f} ({c} candidates)" for c in recall))
+
+    # Step 3: Save
+    print("\n[3/3] Saving outputs ...")
+    stats['memory'] = {'peak_rss_mb': peak_rss_mb(),
+                       'worker_peak_rss_mb': peak_rss_mb(children=True)}
+    stats['memory']['batch_chunks'] = args.shard_size
+    report = save_outputs(output_dir, embeddings, index, stats,
+                          args.single_copy, centroids, stages)
+    shutil.rmtree(shard_dir)
+    profiles = stages.write_profiles()
 
     aligned = report['integrity']['alignment_verified']
     print("\n" + "=" * 60)
@@ -471,8 +1927,19 @@ def main():
     print(f"  Chunks  : {stats['total_chunks']}")
     print(f"  Vectors : {index.ntotal}")
     print(f"  Aligned : {aligned}")
+    print(f"  Peak RSS: {stats['memory']['peak_rss_mb']} MB")
+    print("Stages:")
+    print(stages.format())
+    print(f"  child processes: {report['children_cpu_s']:.3f}s CPU")
+    if profiles:
+        print(f"Profiles: {len(profiles)} stages in {args.profile}")
     print("=" * 60)
 
+    if args.shard_manifest:
+        name = args.shard_name or output_dir.resolve().name
+        register_shard(Path(args.shard_manifest), name, output_dir)
+        print(f"Registered shard '{name}' in {args.shard_manifest}")
+
 
 if __name__ == '__main__':
     main()
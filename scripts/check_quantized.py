@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Quantized Encoding Recall Check
+
+Measures how closely int8-quantized e5-large-v2 reproduces full-precision
+retrieval on a small corpus (typically the sample_docs build) and records
+the verdict. build_index.py and query.py refuse --quantize int8 unless the
+recorded top-k agreement meets the threshold.
+
+Two uses are checked against the full-precision ranking:
+    query   int8 query vectors searched against full-precision passages
+            (query.py --quantize int8 on an ordinary index)
+    build   int8 query and passage vectors
+            (an index built with build_index.py --quantize int8)
+
+Usage:
+    python check_quantized.py --chunks ./demo_index/chunks.jsonl \
+        --queries ../demo/sample_queries.md \
+        --output ./demo_index/quantization_check.json
+
+    # Stricter agreement at top-5
+    python check_quantized.py --chunks ./demo_index/chunks.jsonl \
+        --top-k 5 --threshold 0.95
+"""
+
+import re
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from datetime import datetime
+from typing import List
+
+import numpy as np
+
+from encoders import load_encoder, model_label
+from query import load_queries
+
+
+def chunk_queries(chunks: List[str], limit: int) -> List[str]:
+    """Use the first sentence of up to *limit* chunks as extra queries."""
+    queries = []
+    step = max(1, len(chunks) // max(limit, 1))
+    for text in chunks[::step][:limit]:
+        sentence = re.split(r'(?<=[.!?])\s', ' '.join(text.split()), 1)[0]
+        queries.append(sentence[:200])
+    return queries
+
+
+def top_k_overlap(reference: np.ndarray, candidate: np.ndarray) -> float:
+    """Mean fraction of each reference top-k row found in the candidate row."""
+    k = reference.shape[1]
+    return float(np.mean([
+        len(set(r) & set(c)) / k for r, c in zip(reference, candidate)
+    ]))
+
+
+def top_k(queries: np.ndarray, passages: np.ndarray, k: int) -> np.ndarray:
+    scores = queries @ passages.T
+    return np.argsort(-scores, axis=1, kind='stable')[:, :k]
+
+
+def per_query_latency_ms(encoder, queries: List[str]) -> float:
+    """Mean wall time to encode one query at a time, as query.py does."""
+    encoder.warmup(queries[:1])
+    started = time.perf_counter()
+    for q in queries:
+        encoder.encode([q])
+    return 1000 * (time.perf_counter() - started) / len(queries)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check int8 encoding against full precision.'
+    )
+    parser.add_argument('--chunks', required=True,
+                        help='Path to chunks.jsonl of a reference build')
+    parser.add_argument('--queries',
+                        help='Queries file (.md, .jsonl or one per line)')
+    parser.add_argument('--chunk-queries', type=int, default=50,
+                        help='Also query with the first sentence of this many '
+                             'chunks (default: 50)')
+    parser.add_argument('--top-k', '-k', type=int, default=10,
+                        help='Ranking depth to compare (default: 10)')
+    parser.add_argument('--threshold', type=float, default=0.9,
+                        help='Minimum mean top-k agreement (default: 0.9)')
+    parser.add_argument('--encoder', choices=['e5', 'stub'], default='e5',
+                        help='Encoder to check (default: e5)')
+    parser.add_argument('--output',
+                        help='Where to write the verdict (default: '
+                             'quantization_check.json next to --chunks)')
+    args = parser.parse_args()
+
+    chunks_path = Path(args.chunks)
+    with open(chunks_path) as f:
+        chunk_texts = [json.loads(line)['text'] for line in f]
+    queries = load_queries(Path(args.queries)) if args.queries else []
+    queries += chunk_queries(chunk_texts, args.chunk_queries)
+    if not chunk_texts or not queries:
+        print("ERROR: need at least one chunk and one query", file=sys.stderr)
+        sys.exit(1)
+    k = min(args.top_k, len(chunk_texts))
+
+    passages = [f"passage: {t}" for t in chunk_texts]
+    prefixed = [f"query: {q}" for q in queries]
+    full = load_encoder(args.encoder, 'cpu')
+    int8 = load_encoder(args.encoder, 'cpu', quantize='int8')
+
+    print(f"Encoding {len(passages)} passages and {len(queries)} queries "
+          f"in full precision and int8 ...", file=sys.stderr)
+    p_full, q_full = full.encode(passages), full.encode(prefixed)
+    p_int8, q_int8 = int8.encode(passages), int8.encode(prefixed)
+
+    reference = top_k(q_full, p_full, k)
+    overlaps = {
+        'query': top_k_overlap(reference, top_k(q_int8, p_full, k)),
+        'build': top_k_overlap(reference, top_k(q_int8, p_int8, k)),
+    }
+    latency_full = per_query_latency_ms(full, prefixed)
+    latency_int8 = per_query_latency_ms(int8, prefixed)
+
+    result = {
+        'model': model_label(args.encoder),
+        'mode': 'int8',
+        'top_k': k,
+        'threshold': args.threshold,
+        'passages': len(passages),
+        'queries': len(queries),
+        'uses': {
+            use: {'overlap': round(overlap, 4),
+                  'passed': overlap >= args.threshold}
+            for use, overlap in overlaps.items()
+        },
+        'latency_ms': {
+            'full': round(latency_full, 2),
+            'int8': round(latency_int8, 2),
+            'speedup': round(latency_full / latency_int8, 2)
+            if latency_int8 else None,
+        },
+        'checked_at': datetime.utcnow().isoformat() + 'Z',
+    }
+
+    output = Path(args.output) if args.output else \
+        chunks_path.parent / "quantization_check.json"
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2)
+
+    for use, r in result['uses'].items():
+        verdict = 'PASS' if r['passed'] else 'REFUSED'
+        print(f"  {use:5s}  top-{k} agreement {r['overlap']:.3f}  {verdict}")
+    print(f"  Per-query encode: {result['latency_ms']['full']} ms full, "
+          f"{result['latency_ms']['int8']} ms int8")
+    print(f"Saved: {output}")
+
+    if not all(r['passed'] for r in result['uses'].values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+In-Place Update Round-Trip Check
+
+update_index.py and compaction rewrite a build's index, chunk store,
+tombstones, aliases and document index in place. This check replays a
+sequence of updates with the deterministic stub encoder and compares the
+result with a full rebuild of the same documents, before and after
+compaction:
+
+    plain   build all but the last two PDFs; add those two; re-add the
+            first PDF (replacing it); remove the second
+    dedup   --dedup build of every PDF plus an exact copy of one of them,
+            then remove a document that no alias points into
+
+Builds are compared by what a reader can observe, ignoring row order and
+uids: live chunks and their vectors, dedup aliases, metadata.jsonl,
+per-document centroids, the top-k chunks of every chunk vector as a query,
+and the report's document and chunk counts.
+
+Usage:
+    python check_updates.py --pdf_dir ../sample_docs
+
+    # Also check HNSW, which compaction rebuilds rather than edits
+    python check_updates.py --pdf_dir ../sample_docs --index_type hnsw
+"""
+
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from chunk_store import STORE_DIRNAME, ChunkStore
+from doc_index import DOC_INDEX_FILENAME
+
+SCRIPTS = Path(__file__).resolve().parent
+TOP_K = 5
+
+
+def run(script: str, *args) -> None:
+    """Run one of the pipeline scripts; print its output if it fails."""
+    command = [sys.executable, str(SCRIPTS / script), *map(str, args)]
+    done = subprocess.run(command, capture_output=True, text=True)
+    if done.returncode:
+        print(done.stdout + done.stderr, file=sys.stderr)
+        raise RuntimeError(f"{script} {args[0]} failed "
+                           f"(exit code {done.returncode})")
+
+
+def copy_pdfs(pdfs: List[Path], pdf_dir: Path) -> Path:
+    pdf_dir.mkdir(parents=True)
+    for pdf in pdfs:
+        shutil.copy(pdf, pdf_dir / pdf.name)
+    return pdf_dir
+
+
+# ── Snapshot ─────────────────────────────────────────────────────────────────
+
+def snapshot(index_dir: Path) -> Dict:
+    """Order- and uid-independent view of the build in *index_dir*."""
+    import faiss
+    from build_index import IndexVectors
+
+    with open(index_dir / "index_report.json") as f:
+        report = json.load(f)
+    with open(index_dir / "metadata.jsonl") as f:
+        metadata = {m['doc_id']: m for m in map(json.loads, f)}
+    index = faiss.read_index(str(index_dir / "faiss.index"))
+    embeddings_path = index_dir / "embeddings.npy"
+    vectors = np.load(embeddings_path, mmap_mode='r') \
+        if embeddings_path.exists() else IndexVectors(index)
+
+    store = ChunkStore(index_dir / STORE_DIRNAME)
+    try:
+        live = np.flatnonzero(store.live_mask())
+        keys = {}
+        chunks, chunk_vectors = {}, {}
+        for row in live.tolist():
+            chunk = store[row]
+            key = (chunk['doc_id'], chunk['chunk_id'])
+            keys[chunk.pop('uid')] = key
+            chunks[key] = chunk
+            chunk_vectors[key] = np.asarray(vectors[row], dtype=np.float32)
+
+        aliases = {}
+        for alias in store.aliases:
+            canonical = keys.get(store.uid(store.row_of(int(alias['uid']))))
+            if canonical is not None:
+                source = (store.docs[alias['doc']]['doc_id'],
+                          int(alias['chunk_id']))
+                aliases[source] = canonical
+
+        ranges = np.load(index_dir / STORE_DIRNAME / "doc_ranges.npy")
+        centroids = np.load(index_dir / DOC_INDEX_FILENAME)
+        doc_vectors: Dict[str, List] = {}
+        for (doc, start, end), centroid in zip(ranges, centroids):
+            if store.live_mask()[start:end].any():
+                doc_vectors.setdefault(store.docs[doc]['doc_id'],
+                                       []).append(centroid)
+
+        # Tombstoned chunks stay in the index until compaction: over-fetch
+        # and drop them, as query.py's selector does. Chunks tied at the
+        # k-th score may come back in either order, so the top-k is its
+        # scores plus the chunks that score strictly better than the k-th.
+        queries = np.stack(list(chunk_vectors.values()))
+        faiss.normalize_L2(queries)
+        scores, uids = index.search(queries,
+                                    2 * TOP_K + len(store.tombstones))
+        neighbours = {}
+        for key, row_scores, row_uids in zip(chunk_vectors, scores, uids):
+            hits = sorted((-round(float(s), 4), keys[int(u)])
+                          for s, u in zip(row_scores, row_uids)
+                          if int(u) in keys)[:TOP_K]
+            kth = hits[-1][0]
+            neighbours[key] = ([score for score, _ in hits],
+                               [hit for score, hit in hits if score < kth])
+    finally:
+        store.close()
+
+    return {
+        'chunks': chunks, 'vectors': chunk_vectors, 'aliases': aliases,
+        'metadata': metadata, 'doc_vectors': doc_vectors,
+        'neighbours': neighbours,
+        'counts': {'docs_indexed': report['stats']['docs_indexed'],
+                   'chunk_count': report['stats']['chunk_count']},
+    }
+
+
+def differences(got: Dict, want: Dict) -> List[str]:
+    """What *got* (an updated build) gets wrong relative to *want*."""
+    problems = []
+    for name in ('chunks', 'aliases', 'metadata', 'counts', 'neighbours'):
+        if got[name] == want[name]:
+            continue
+        missing = set(want[name]) - set(got[name])
+        extra = set(got[name]) - set(want[name])
+        changed = [k for k in set(got[name]) & set(want[name])
+                   if got[name][k] != want[name][k]]
+        problems.append(f"{name}: {len(missing)} missing, {len(extra)} "
+                        f"extra, {len(changed)} differ "
+                        f"(e.g. {sorted(missing | extra | set(changed))[:3]})")
+    for name in ('vectors', 'doc_vectors'):
+        if set(got[name]) != set(want[name]):
+            problems.append(f"{name}: keys differ")
+            continue
+        bad = [k for k in want[name]
+               if not np.allclose(got[name][k], want[name][k], atol=1e-3)]
+        if bad:
+            problems.append(f"{name}: {len(bad)} differ (e.g. {bad[:3]})")
+    return problems
+
+
+def compare(label: str, index_dir: Path, reference: Dict) -> bool:
+    problems = differences(snapshot(index_dir), reference)
+    print(f"  {label:24s} {'OK' if not problems else 'MISMATCH'}")
+    for problem in problems:
+        print(f"    {problem}")
+    return not problems
+
+
+# ── Scenarios ────────────────────────────────────────────────────────────────
+
+def check_plain(pdfs: List[Path], work: Path, build_args: List[str]) -> bool:
+    base, new = pdfs[:-2], pdfs[-2:]
+    readd, removed = pdfs[0], pdfs[1]
+
+    reference_dir = work / "plain_reference"
+    kept = [p for p in pdfs if p != removed]
+    run('build_index.py', '--pdf_dir', copy_pdfs(kept, work / "plain_all"),
+        '--output_dir', reference_dir, *build_args)
+    reference = snapshot(reference_dir)
+
+    index_dir = work / "plain_updated"
+    run('build_index.py', '--pdf_dir', copy_pdfs(base, work / "plain_base"),
+        '--output_dir', index_dir, *build_args)
+    run('update_index.py', 'add', '--index_dir', index_dir, '--encoder',
+        'stub', *[a for p in new for a in ('--pdf', p)])
+    run('update_index.py', 'add', '--index_dir', index_dir, '--encoder',
+        'stub', '--pdf', readd)
+    run('update_index.py', 'remove', '--index_dir', index_dir, '--doc_id',
+        removed.stem)
+    ok = compare('plain, tombstoned', index_dir, reference)
+    run('update_index.py', 'compact', '--index_dir', index_dir, '--force')
+    return compare('plain, compacted', index_dir, reference) and ok
+
+
+def check_dedup(pdfs: List[Path], work: Path, build_args: List[str]) -> bool:
+    original = pdfs[0]
+    copy = work / f"zz_copy_of_{original.name}"
+    shutil.copy(original, copy)
+    corpus = pdfs + [copy]
+    build_args = build_args + ['--dedup']
+
+    index_dir = work / "dedup_updated"
+    run('build_index.py', '--pdf_dir', copy_pdfs(corpus, work / "dedup_all"),
+        '--output_dir', index_dir, *build_args)
+
+    # Removing a document that aliases point into drops those aliases by
+    # design (a rebuild would keep them), so remove one that has none
+    store = ChunkStore(index_dir / STORE_DIRNAME)
+    try:
+        canonical = {store[store.row_of(int(uid))]['doc_id']
+                     for uid in np.unique(store.aliases['uid'])}
+        n_aliases = len(store.aliases)
+    finally:
+        store.close()
+    removable = [p for p in pdfs[1:] if p.stem not in canonical]
+    if not n_aliases or not removable:
+        print("  dedup: skipped (no aliases, or no document free of them)")
+        return True
+    removed = removable[0]
+
+    reference_dir = work / "dedup_reference"
+    kept = [p for p in corpus if p != removed]
+    run('build_index.py', '--pdf_dir', copy_pdfs(kept, work / "dedup_kept"),
+        '--output_dir', reference_dir, *build_args)
+    reference = snapshot(reference_dir)
+
+    run('update_index.py', 'remove', '--index_dir', index_dir, '--doc_id',
+        removed.stem)
+    ok = compare(f'dedup ({n_aliases} aliases), tombstoned', index_dir,
+                 reference)
+    run('update_index.py', 'compact', '--index_dir', index_dir, '--force')
+    return compare('dedup, compacted', index_dir, reference) and ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check in-place updates against a full rebuild.'
+    )
+    parser.add_argument('--pdf_dir', required=True,
+                        help='Directory with at least four PDFs')
+    parser.add_argument('--index_type', default='flat',
+                        help='Index type to build (default: flat)')
+    parser.add_argument('--work_dir',
+                        help='Keep the builds here instead of a temporary '
+                             'directory')
+    args = parser.parse_args()
+
+    pdfs = sorted(Path(args.pdf_dir).glob("*.pdf"))
+    if len(pdfs) < 4:
+        print(f"ERROR: need at least 4 PDFs in {args.pdf_dir}",
+              file=sys.stderr)
+        sys.exit(1)
+    build_args = ['--encoder', 'stub', '--index_type', args.index_type]
+
+    work = Path(args.work_dir or tempfile.mkdtemp(prefix='check_updates_'))
+    work.mkdir(parents=True, exist_ok=True)
+    print(f"Checking updates of {len(pdfs)} PDFs ({args.index_type}) "
+          f"in {work}")
+    try:
+        ok = check_plain(pdfs, work, build_args)
+        ok = check_dedup(pdfs, work, build_args) and ok
+    except RuntimeError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        ok = False
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+    print("PASS" if ok else "FAIL")
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
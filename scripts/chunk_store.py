@@ -0,0 +1,520 @@
+"""
+Random-Access Chunk Store
+
+A memory-mapped, columnar copy of ``chunks.jsonl`` written by build_index.py
+next to it, so query tools can fetch the handful of top-k rows they need
+without parsing every chunk at startup.
+
+Layout of ``chunk_store/``:
+    columns.npy   fixed-width per-chunk columns (structured array)
+    offsets.npy   uint64 byte offsets into text.bin, one more than chunks
+    text.bin      UTF-8 chunk texts, concatenated
+    tables.json   per-document strings (doc_id, filename, title, year) and
+                  the section-name vocabulary referenced by the columns
+    doc_ranges.npy      (doc, start, end) row range of each document's chunks
+    section_bitmaps.npy one packed row bitmap per section name (bitorder
+                        little, the layout faiss.IDSelectorBitmap expects)
+    ids.npy             int64 stable chunk id (``uid``) of each row,
+                        ascending; the ids of the FAISS IndexIDMap2
+    tombstones.npy      sorted uids of removed chunks not yet compacted away
+    aliases.npy         (uid, doc, chunk_id, pages, similarity) of chunks
+                        deduplicated into chunk *uid* (build_index.py
+                        --dedup), sorted by uid; their documents are in
+                        tables.json but own no rows
+
+``ChunkStore(path)[i]`` returns the same dict as line *i* of chunks.jsonl,
+and ``ChunkStore.by_uid(uid)`` the chunk a FAISS search returned, with
+the other sources of its text under ``aliases``. Opening a
+store reads only tables.json (one entry per document); columns, offsets and
+text are paged in on access. ``ChunkStore.match(filters)`` turns year /
+doc_id / filename / section filters into a row mask from the range table
+and bitmaps, without touching the chunks themselves.
+
+update_index.py appends rows in place (append_store) and records removals
+as tombstones; compaction writes a fresh store with ChunkStoreWriter.
+"""
+
+import os
+import json
+import mmap
+import shutil
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+STORE_DIRNAME = "chunk_store"
+STORE_VERSION = 1
+
+COLUMNS_DTYPE = np.dtype([
+    ('doc', '<i4'),             # row in tables.json 'docs'
+    ('chunk_id', '<i4'),
+    ('section', '<i4'),         # row in tables.json 'sections'
+    ('char_count', '<i4'),
+    ('token_estimate', '<i4'),
+    ('page_start', '<i4'),      # 1-based; 0 when unknown
+    ('page_end', '<i4'),
+])
+DOC_FIELDS = ('doc_id', 'filename', 'title', 'year')
+RANGES_DTYPE = np.dtype([('doc', '<i4'), ('start', '<i8'), ('end', '<i8')])
+ALIASES_DTYPE = np.dtype([
+    ('uid', '<i8'),             # chunk that holds the shared vector
+    ('doc', '<i4'),             # row in tables.json 'docs'
+    ('chunk_id', '<i4'),
+    ('page_start', '<i4'),
+    ('page_end', '<i4'),
+    ('similarity', '<f4'),      # estimated Jaccard similarity; 1 for copies
+])
+
+
+def matches_doc(doc: Dict, filters: Dict) -> bool:
+    """Whether document fields satisfy the doc-level *filters*.
+
+    *filters* may hold ``year`` as an inclusive ``(min, max)`` pair (either
+    end None for open) and ``doc_id`` / ``filename`` as collections of
+    accepted values. Fields within a filter are OR-ed, filters are AND-ed.
+    """
+    year = filters.get('year')
+    if year is not None:
+        lo, hi = year
+        if doc.get('year') is None:
+            return False
+        if (lo is not None and doc['year'] < lo) or \
+                (hi is not None and doc['year'] > hi):
+            return False
+    for field in ('doc_id', 'filename'):
+        wanted = filters.get(field)
+        if wanted and doc.get(field) not in wanted:
+            return False
+    return True
+
+
+def doc_ranges(doc_column: np.ndarray) -> np.ndarray:
+    """Contiguous (doc, start, end) runs in a per-chunk doc column."""
+    n = len(doc_column)
+    starts = np.flatnonzero(np.diff(doc_column, prepend=-1)) if n else \
+        np.empty(0, dtype=np.int64)
+    ranges = np.empty(len(starts), dtype=RANGES_DTYPE)
+    ranges['doc'] = doc_column[starts] if n else []
+    ranges['start'] = starts
+    ranges['end'] = np.append(starts[1:], n)
+    return ranges
+
+
+def section_bitmaps(section_column: np.ndarray, n_sections: int) -> np.ndarray:
+    """Packed row bitmap (bitorder little) for each section id."""
+    return np.stack([
+        np.packbits(section_column == i, bitorder='little')
+        for i in range(n_sections)
+    ]) if n_sections else np.empty((0, 0), dtype=np.uint8)
+
+
+def append_npy(path: Path, rows: np.ndarray):
+    """Append *rows* to the 1-d or 2-d ``.npy`` array at *path* in place.
+
+    The header is rewritten with the new length; it is padded, so it keeps
+    its size unless the length gains more digits than the padding holds, in
+    which case the file is rewritten once.
+    """
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 \
+            if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, fortran, dtype = read_header(f)
+        data_start = f.tell()
+        rows = np.ascontiguousarray(rows, dtype=dtype)
+        if fortran or rows.shape[1:] != shape[1:]:
+            raise ValueError(f"{path}: cannot append {rows.shape} rows to "
+                             f"{shape}")
+        new_shape = (shape[0] + len(rows),) + shape[1:]
+        header = {'descr': np.lib.format.dtype_to_descr(dtype),
+                  'fortran_order': False, 'shape': new_shape}
+        f.seek(0)
+        np.lib.format.write_array_header_1_0(f, header) if version == (1, 0) \
+            else np.lib.format.write_array_header_2_0(f, header)
+        if f.tell() == data_start:
+            f.seek(0, os.SEEK_END)
+            f.write(rows.tobytes())
+            return
+    # Header grew: rewrite the whole array once
+    merged = np.concatenate([np.load(path), rows])
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, merged)
+    os.replace(tmp, path)
+
+
+def read_tombstones(path: Path) -> np.ndarray:
+    tombstones_path = Path(path) / "tombstones.npy"
+    if tombstones_path.exists():
+        return np.load(tombstones_path)
+    return np.empty(0, dtype=np.int64)
+
+
+def write_aliases(path: Path, aliases: np.ndarray):
+    """Replace the store's aliases (an empty array removes them)."""
+    aliases_path = Path(path) / "aliases.npy"
+    if not len(aliases):
+        if aliases_path.exists():
+            aliases_path.unlink()
+        return
+    aliases = np.sort(np.asarray(aliases, dtype=ALIASES_DTYPE), order='uid',
+                      kind='stable')
+    tmp = aliases_path.with_name(aliases_path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, aliases)
+    os.replace(tmp, aliases_path)
+
+
+def write_tombstones(path: Path, uids: np.ndarray):
+    """Set the store's tombstones to *uids* (an empty array clears them)."""
+    tombstones_path = Path(path) / "tombstones.npy"
+    uids = np.unique(np.asarray(uids, dtype=np.int64))
+    if not len(uids):
+        if tombstones_path.exists():
+            tombstones_path.unlink()
+        return
+    tmp = tombstones_path.with_name(tombstones_path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        np.save(f, uids)
+    os.replace(tmp, tombstones_path)
+
+
+class ChunkStoreWriter:
+    """Append chunks in build order; files are finalised by close()."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True)
+        self._text = open(self.path / "text.bin", 'wb')
+        self._offsets = array('Q', [0])
+        self._ids = array('q')
+        self._columns = {name: array('i') for name in COLUMNS_DTYPE.names}
+        self._docs: List[Dict] = []
+        self._doc_rows: Dict[tuple, int] = {}
+        self._sections: Dict[str, int] = {}
+        self._aliases: List[tuple] = []
+
+    def _doc(self, chunk: Dict) -> int:
+        doc_key = tuple(chunk.get(f) for f in DOC_FIELDS)
+        doc = self._doc_rows.get(doc_key)
+        if doc is None:
+            doc = self._doc_rows[doc_key] = len(self._docs)
+            self._docs.append(dict(zip(DOC_FIELDS, doc_key)))
+        return doc
+
+    def add(self, chunk: Dict):
+        doc = self._doc(chunk)
+        section = self._sections.setdefault(chunk['section'],
+                                            len(self._sections))
+
+        self._ids.append(chunk.get('uid', len(self._ids)))
+        encoded = chunk['text'].encode('utf-8')
+        self._text.write(encoded)
+        self._offsets.append(self._offsets[-1] + len(encoded))
+        row = {'doc': doc, 'chunk_id': chunk['chunk_id'], 'section': section,
+               'char_count': chunk['char_count'],
+               'token_estimate': chunk['token_estimate'],
+               'page_start': chunk.get('page_start', 0),
+               'page_end': chunk.get('page_end', 0)}
+        for name, value in row.items():
+            self._columns[name].append(value)
+
+    def add_alias(self, uid: int, chunk: Dict, similarity: float = 1.0):
+        """Record *chunk* (not added itself) as another source of *uid*."""
+        self._aliases.append((uid, self._doc(chunk), chunk['chunk_id'],
+                              chunk.get('page_start', 0),
+                              chunk.get('page_end', 0), similarity))
+
+    def close(self):
+        if self._text.closed:
+            return
+        self._text.close()
+        columns = np.empty(len(self._offsets) - 1, dtype=COLUMNS_DTYPE)
+        for name, values in self._columns.items():
+            columns[name] = np.frombuffer(values, dtype=np.intc)
+        np.save(self.path / "columns.npy", columns)
+        np.save(self.path / "offsets.npy",
+                np.frombuffer(self._offsets, dtype=np.uint64))
+        np.save(self.path / "ids.npy", np.frombuffer(self._ids, dtype=np.int64))
+        np.save(self.path / "doc_ranges.npy", doc_ranges(columns['doc']))
+        np.save(self.path / "section_bitmaps.npy",
+                section_bitmaps(columns['section'], len(self._sections)))
+        write_aliases(self.path, np.array(self._aliases, dtype=ALIASES_DTYPE))
+        with open(self.path / "tables.json", 'w') as f:
+            json.dump({
+                'version': STORE_VERSION,
+                'count': len(columns),
+                'docs': self._docs,
+                'sections': list(self._sections),
+            }, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def append_store(path: Path, chunks: List[Dict]):
+    """Append *chunks* to the store at *path* in place.
+
+    Each chunk needs a ``uid`` above every uid already in the store. Text,
+    offsets, columns, ids and document ranges grow by the new rows only;
+    tables.json (one entry per document) and the section bitmaps are
+    rewritten.
+    """
+    path = Path(path)
+    with open(path / "tables.json") as f:
+        tables = json.load(f)
+    n = tables['count']
+    docs = tables['docs']
+    doc_rows = {tuple(d[f] for f in DOC_FIELDS): i for i, d in enumerate(docs)}
+    sections = {name: i for i, name in enumerate(tables['sections'])}
+
+    ids_path = path / "ids.npy"
+    if not ids_path.exists():
+        np.save(ids_path, np.arange(n, dtype=np.int64))
+    last_uid = int(np.load(ids_path, mmap_mode='r')[-1]) if n else -1
+
+    # Stores written before a column existed keep their own layout
+    dtype = np.load(path / "columns.npy", mmap_mode='r').dtype
+    columns = np.empty(len(chunks), dtype=dtype)
+    uids = np.empty(len(chunks), dtype=np.int64)
+    lengths = np.empty(len(chunks), dtype=np.uint64)
+    with open(path / "text.bin", 'ab') as text:
+        for j, chunk in enumerate(chunks):
+            doc_key = tuple(chunk.get(f) for f in DOC_FIELDS)
+            if doc_key not in doc_rows:
+                doc_rows[doc_key] = len(docs)
+                docs.append(dict(zip(DOC_FIELDS, doc_key)))
+            section = sections.setdefault(chunk['section'], len(sections))
+            encoded = chunk['text'].encode('utf-8')
+            text.write(encoded)
+            lengths[j] = len(encoded)
+            uids[j] = chunk['uid']
+            row = {'doc': doc_rows[doc_key], 'chunk_id': chunk['chunk_id'],
+                   'section': section, 'char_count': chunk['char_count'],
+                   'token_estimate': chunk['token_estimate'],
+                   'page_start': chunk.get('page_start', 0),
+                   'page_end': chunk.get('page_end', 0)}
+            columns[j] = tuple(row[name] for name in dtype.names)
+    if len(uids) and (uids[0] <= last_uid or np.any(np.diff(uids) <= 0)):
+        raise ValueError("appended uids must be ascending and above the "
+                         "store's last uid")
+
+    end = np.load(path / "offsets.npy", mmap_mode='r')[-1]
+    append_npy(path / "offsets.npy", end + np.cumsum(lengths))
+    append_npy(path / "columns.npy", columns)
+    append_npy(ids_path, uids)
+    ranges = doc_ranges(columns['doc'])
+    ranges['start'] += n
+    ranges['end'] += n
+    if (path / "doc_ranges.npy").exists():
+        append_npy(path / "doc_ranges.npy", ranges)
+
+    bitmaps_path = path / "section_bitmaps.npy"
+    if bitmaps_path.exists():
+        old = np.load(bitmaps_path)
+        total = n + len(chunks)
+        bitmaps = np.zeros((len(sections), (total + 7) // 8), dtype=np.uint8)
+        bitmaps[:old.shape[0], :old.shape[1]] = old
+        rows = np.arange(n, total)
+        np.bitwise_or.at(bitmaps, (columns['section'], rows >> 3),
+                         (1 << (rows & 7)).astype(np.uint8))
+        tmp = bitmaps_path.with_name(bitmaps_path.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, bitmaps)
+        os.replace(tmp, bitmaps_path)
+
+    tables.update(count=n + len(chunks), docs=docs, sections=list(sections))
+    tmp = path / "tables.json.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(tables, f)
+    os.replace(tmp, path / "tables.json")
+
+
+class ChunkStore:
+    """Read-only, lazily paged view of a chunk store directory."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        with open(self.path / "tables.json") as f:
+            tables = json.load(f)
+        if tables.get('version') != STORE_VERSION:
+            raise ValueError(f"{self.path}: unsupported chunk store version "
+                             f"{tables.get('version')}")
+        self.docs = tables['docs']
+        self.sections = tables['sections']
+        self.columns = np.load(self.path / "columns.npy", mmap_mode='r')
+        self.offsets = np.load(self.path / "offsets.npy", mmap_mode='r')
+        # Stores without ids.npy, or whose ids are still 0..n-1, map uids to
+        # rows directly
+        ids_path = self.path / "ids.npy"
+        self.ids = np.load(ids_path, mmap_mode='r') \
+            if ids_path.exists() else None
+        if self.ids is not None and (
+                not len(self.ids) or self.ids[-1] == len(self.ids) - 1):
+            self.ids = None
+        self.tombstones = read_tombstones(self.path)
+        aliases_path = self.path / "aliases.npy"
+        self.aliases = np.load(aliases_path) if aliases_path.exists() else \
+            np.empty(0, dtype=ALIASES_DTYPE)
+        self._text_file = open(self.path / "text.bin", 'rb')
+        self._text = (mmap.mmap(self._text_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+                      if self.offsets[-1] else b'')
+
+    def __len__(self) -> int:
+        return len(self.columns)
+
+    def text(self, i: int) -> str:
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        return self._text[start:end].decode('utf-8')
+
+    def uid(self, i: int) -> int:
+        return int(self.ids[i]) if self.ids is not None else i
+
+    def row_of(self, uid: int) -> int:
+        """Row holding chunk *uid*, or -1 if the store has no such chunk."""
+        if self.ids is None:
+            return uid if 0 <= uid < len(self) else -1
+        row = int(np.searchsorted(self.ids, uid))
+        return row if row < len(self.ids) and self.ids[row] == uid else -1
+
+    def rows_of(self, uids: np.ndarray) -> np.ndarray:
+        """Rows holding any of *uids*; uids the store lacks are skipped."""
+        uids = np.unique(np.asarray(uids, dtype=np.int64))
+        if self.ids is None:
+            return uids[(uids >= 0) & (uids < len(self))]
+        rows = np.searchsorted(self.ids, uids)
+        found = rows < len(self.ids)
+        rows, uids = rows[found], uids[found]
+        return rows[np.asarray(self.ids)[rows] == uids]
+
+    def by_uid(self, uid: int) -> Optional[Dict]:
+        row = self.row_of(uid)
+        if row < 0:
+            return None
+        chunk = self[row]
+        aliases = self.aliases_of(uid)
+        if aliases:
+            chunk['aliases'] = aliases
+        return chunk
+
+    def aliases_of(self, uid: int) -> List[Dict]:
+        """Other sources of chunk *uid*'s text, as chunk-like dicts."""
+        lo, hi = np.searchsorted(self.aliases['uid'], [uid, uid + 1])
+        sources = []
+        for alias in self.aliases[lo:hi]:
+            source = dict(self.docs[alias['doc']])
+            source.update(chunk_id=int(alias['chunk_id']),
+                          similarity=round(float(alias['similarity']), 4))
+            if alias['page_start'] > 0:
+                source.update(page_start=int(alias['page_start']),
+                              page_end=int(alias['page_end']))
+            sources.append(source)
+        return sources
+
+    def uid_space(self) -> int:
+        """One more than the largest uid (the size of a uid bitmap)."""
+        return int(self.ids[-1]) + 1 if self.ids is not None else len(self)
+
+    def uid_mask(self, row_mask: np.ndarray) -> np.ndarray:
+        """Translate a row mask into a mask indexed by uid."""
+        if self.ids is None:
+            return row_mask
+        mask = np.zeros(self.uid_space(), dtype=bool)
+        mask[np.asarray(self.ids)[row_mask]] = True
+        return mask
+
+    def live_mask(self) -> np.ndarray:
+        """Rows not tombstoned."""
+        if not len(self.tombstones):
+            return np.ones(len(self), dtype=bool)
+        uids = np.asarray(self.ids) if self.ids is not None else \
+            np.arange(len(self))
+        return ~np.isin(uids, self.tombstones)
+
+    def __getitem__(self, i: int) -> Dict:
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        i = int(i) % len(self)
+        row = self.columns[i]
+        doc = self.docs[row['doc']]
+        chunk = {
+            'uid': self.uid(i),
+            'chunk_id': int(row['chunk_id']),
+            'text': self.text(i),
+            'section': self.sections[row['section']],
+            'char_count': int(row['char_count']),
+            'token_estimate': int(row['token_estimate']),
+            'doc_id': doc['doc_id'],
+            'filename': doc['filename'],
+            'title': doc['title'],
+            'year': doc['year'],
+        }
+        if 'page_start' in row.dtype.names and row['page_start'] > 0:
+            chunk['page_start'] = int(row['page_start'])
+            chunk['page_end'] = int(row['page_end'])
+        return chunk
+
+    def match(self, filters: Dict, aliases: bool = True) -> np.ndarray:
+        """Boolean row mask for *filters* (see matches_doc; plus ``section``,
+        a collection of section names matched case-insensitively).
+        Tombstoned rows never match. With *aliases*, a chunk also matches
+        doc-level filters through the documents of its aliases."""
+        n = len(self)
+        ranges_path = self.path / "doc_ranges.npy"
+        ranges = np.load(ranges_path) if ranges_path.exists() else \
+            doc_ranges(np.asarray(self.columns['doc']))
+
+        if any(filters.get(f) for f in ('year', 'doc_id', 'filename')):
+            docs = [i for i, doc in enumerate(self.docs)
+                    if matches_doc(doc, filters)]
+            mask = np.zeros(n, dtype=bool)
+            for _, start, end in ranges[np.isin(ranges['doc'], docs)]:
+                mask[start:end] = True
+            if aliases and len(self.aliases):
+                uids = self.aliases['uid'][np.isin(self.aliases['doc'], docs)]
+                mask[self.rows_of(uids)] = True
+        else:
+            mask = np.ones(n, dtype=bool)
+
+        sections = filters.get('section')
+        if sections:
+            wanted = [i for i, name in enumerate(self.sections)
+                      if name.lower() in {s.lower() for s in sections}]
+            bitmaps_path = self.path / "section_bitmaps.npy"
+            if bitmaps_path.exists():
+                bitmaps = np.load(bitmaps_path, mmap_mode='r')
+                bits = np.bitwise_or.reduce(bitmaps[wanted], axis=0) \
+                    if wanted else np.zeros(bitmaps.shape[1], dtype=np.uint8)
+                mask &= np.unpackbits(bits, count=n,
+                                      bitorder='little').astype(bool)
+            else:
+                mask &= np.isin(self.columns['section'], wanted)
+        if len(self.tombstones):
+            mask &= self.live_mask()
+        return mask
+
+    def close(self):
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
+        self._text_file.close()
+
+
+def replace_store(tmp_path: Path, path: Path):
+    """Swap a finished store at *tmp_path* into place at *path*."""
+    old = path.with_name(path.name + '.old')
+    if old.exists():
+        shutil.rmtree(old)
+    if path.exists():
+        path.rename(old)
+    tmp_path.rename(path)
+    if old.exists():
+        shutil.rmtree(old)
@@ -0,0 +1,174 @@
+"""
+Pre-Embedding Deduplication
+
+Drops repeated content from a build before it is embedded
+(build_index.py --dedup), so every distinct passage gets one vector:
+
+    exact   a PDF whose SHA-256 matches an earlier document contributes no
+            chunks; each of its chunks becomes an alias of the chunk the
+            earlier copy kept
+    near    a chunk whose MinHash signature agrees with an earlier kept
+            chunk's on at least ``threshold`` of its hashes (the estimated
+            Jaccard similarity of their word 5-gram shingles) is dropped and
+            becomes an alias of that chunk
+
+Candidates come from LSH banding: a signature of NUM_PERM hashes is cut
+into BANDS bands, and a chunk is compared only with kept chunks that share
+a band with it. With 16 bands of 4 hashes, pairs at 0.8 similarity are
+found with probability > 0.999 and pairs at 0.3 are compared 12% of the
+time.
+
+The first copy in build order is kept. Aliases are stored in the chunk
+store (aliases.npy), so query results list every source of a passage and
+doc-level filters match a passage through any of its sources. Memory is
+one signature (NUM_PERM uint32) and BANDS bucket entries per kept chunk.
+"""
+
+import re
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+SHINGLE_WORDS = 5
+NUM_PERM = 64
+BANDS = 16
+DEDUP_THRESHOLD = 0.8
+
+_WORD = re.compile(r'\w+')
+_SHINGLE_BASE = np.uint64(1000003)
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    """uint64 hashes of the lower-cased word 5-grams of *text*.
+
+    Texts shorter than SHINGLE_WORDS words hash as one shingle; texts
+    without words have none.
+    """
+    words = np.array([zlib.crc32(w.encode('utf-8'))
+                      for w in _WORD.findall(text.lower())], dtype=np.uint64)
+    if not len(words):
+        return words
+    k = min(SHINGLE_WORDS, len(words))
+    n = len(words) - k + 1
+    hashes = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        hashes = hashes * _SHINGLE_BASE + words[j:j + n]
+    return hashes
+
+
+class Deduplicator:
+    """Streaming exact-document and near-duplicate-chunk detector.
+
+    Documents are passed to ``filter_document`` in build order; it returns
+    the chunks to keep and aliases for the ones dropped.
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, seed: int = 0):
+        if NUM_PERM % BANDS:
+            raise ValueError("NUM_PERM must be a multiple of BANDS")
+        self.threshold = threshold
+        rng = np.random.default_rng(seed)
+        # Multiply-shift hashing: (a * x + b) mod 2**64, top 32 bits
+        self._a = rng.integers(1, 2 ** 63, NUM_PERM, dtype=np.uint64) * \
+            np.uint64(2) + np.uint64(1)
+        self._b = rng.integers(0, 2 ** 63, NUM_PERM, dtype=np.uint64)
+        self._rows = NUM_PERM // BANDS
+        self._buckets: List[Dict[bytes, List[int]]] = \
+            [{} for _ in range(BANDS)]
+        self._signatures: Dict[int, np.ndarray] = {}
+        self._documents: Dict[str, Tuple[str, List[int]]] = {}
+        self.stats = {'exact_duplicate_docs': 0, 'near_duplicate_chunks': 0,
+                      'chunks_collapsed': 0, 'chunks_kept': 0}
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        hashes = shingle_hashes(text)
+        if not len(hashes):
+            return None
+        with np.errstate(over='ignore'):
+            mixed = self._a[:, None] * hashes[None, :] + self._b[:, None]
+        return (mixed >> np.uint64(32)).min(axis=1).astype(np.uint32)
+
+    def _bands(self, signature: np.ndarray):
+        for band in range(BANDS):
+            yield band, signature[band * self._rows:
+                                  (band + 1) * self._rows].tobytes()
+
+    def find(self, signature: np.ndarray) -> Tuple[Optional[int], float]:
+        """Most similar kept chunk at or above the threshold, if any."""
+        candidates = set()
+        for band, key in self._bands(signature):
+            candidates.update(self._buckets[band].get(key, ()))
+        best, best_similarity = None, 0.0
+        for uid in sorted(candidates):
+            similarity = float(np.mean(self._signatures[uid] == signature))
+            if similarity > best_similarity:
+                best, best_similarity = uid, similarity
+        if best_similarity >= self.threshold:
+            return best, best_similarity
+        return None, best_similarity
+
+    def add(self, uid: int, signature: np.ndarray):
+        self._signatures[uid] = signature
+        for band, key in self._bands(signature):
+            self._buckets[band].setdefault(key, []).append(uid)
+
+    def filter_document(self, meta: Dict, chunks: List[Dict],
+                        next_uid: int) -> Tuple[List[int], List[Tuple]]:
+        """Deduplicate one document's chunks.
+
+        Kept chunks will get uids ``next_uid, next_uid + 1, ...`` in order.
+        Returns the positions of the kept chunks in *chunks* and
+        ``(canonical_uid, chunk, similarity)`` for each dropped one. Marks
+        *meta* with ``duplicate_of`` (an exact copy) or
+        ``duplicate_chunks`` (how many chunks were dropped).
+        """
+        meta.pop('duplicate_of', None)
+        meta.pop('duplicate_chunks', None)
+        original = self._documents.get(meta['sha256'])
+        if original is not None:
+            doc_id, resolved = original
+            meta['duplicate_of'] = doc_id
+            aliases = [(uid, chunk, 1.0)
+                       for uid, chunk in zip(resolved, chunks)]
+            self.stats['exact_duplicate_docs'] += 1
+            self.stats['chunks_collapsed'] += len(aliases)
+            return [], aliases
+
+        keep: List[int] = []
+        aliases: List[Tuple] = []
+        resolved: List[int] = []
+        for j, chunk in enumerate(chunks):
+            signature = self.signature(chunk['text'])
+            canonical, similarity = (None, 0.0) if signature is None \
+                else self.find(signature)
+            if canonical is not None:
+                aliases.append((canonical, chunk, similarity))
+                resolved.append(canonical)
+                continue
+            uid = next_uid + len(keep)
+            if signature is not None:
+                self.add(uid, signature)
+            keep.append(j)
+            resolved.append(uid)
+
+        self._documents[meta['sha256']] = (meta['doc_id'], resolved)
+        if aliases:
+            meta['duplicate_chunks'] = len(aliases)
+        self.stats['near_duplicate_chunks'] += len(aliases)
+        self.stats['chunks_collapsed'] += len(aliases)
+        self.stats['chunks_kept'] += len(keep)
+        return keep, aliases
+
+    def report(self) -> Dict:
+        total = self.stats['chunks_kept'] + self.stats['chunks_collapsed']
+        return {
+            **self.stats,
+            'collapsed_ratio': round(self.stats['chunks_collapsed'] / total, 4)
+                               if total else 0.0,
+            'threshold': self.threshold,
+            'num_perm': NUM_PERM,
+            'bands': BANDS,
+            'shingle_words': SHINGLE_WORDS,
+        }
@@ -0,0 +1,208 @@
+"""
+Document-Centroid Index
+
+Per-document search (query.py --per-doc): the best-matching chunk of each
+of the top-k *distinct* documents, without over-fetching chunk hits and
+hoping enough documents survive. Search runs in two stages:
+
+    1. score the query against one pooled vector per document (the
+       normalised mean of its unit chunk vectors) and keep the best
+       ``candidates`` documents
+    2. score every chunk of those documents exactly and rank the
+       documents by their best chunk
+
+Stage 2 touches only the candidates' rows of embeddings.npy (or of a
+single-copy index), so its cost is bounded by ``candidates`` documents
+rather than the corpus. Exhaustive per-document search, the max chunk score
+of every document, is the reference; build_index.py records the recall of
+the two-stage search against it in index_report.json.
+
+Layout: ``doc_index.npy`` in the build directory, float32, row *i* the
+pooled vector of row *i* of chunk_store/doc_ranges.npy (the row range of
+one document's chunks). update_index.py appends rows for added documents
+and rewrites the file on compaction.
+"""
+
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from chunk_store import STORE_DIRNAME
+
+
+DOC_INDEX_FILENAME = "doc_index.npy"
+DOC_CANDIDATES = 100            # documents scored exactly per query
+RECALL_CANDIDATES = (10, 25, 50, 100)
+BLOCK_SIZE = 4096
+
+
+def _unit(vectors) -> np.ndarray:
+    """float32 copy of *vectors* with L2-normalised rows."""
+    block = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return block / norms
+
+
+def doc_centroids(vectors, ranges: np.ndarray) -> np.ndarray:
+    """Pooled unit vector of each (doc, start, end) row range of *vectors*."""
+    centroids = np.zeros((len(ranges), vectors.shape[1]), dtype=np.float32)
+    for i, (_, start, end) in enumerate(ranges):
+        for lo in range(start, end, BLOCK_SIZE):
+            centroids[i] += _unit(vectors[lo:min(lo + BLOCK_SIZE, end)]) \
+                .sum(axis=0)
+    return _unit(centroids) if len(ranges) else centroids
+
+
+def write_doc_index(path: Path, centroids: np.ndarray):
+    with open(path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(centroids, dtype=np.float32))
+
+
+def exhaustive_search(queries: np.ndarray, vectors, ranges: np.ndarray,
+                      top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-k ranges by best chunk score, scanning every row in blocks.
+
+    *ranges* must cover the rows of *vectors* in order (as doc_ranges.npy
+    does). Returns ``(scores, range rows)``, both ``(len(queries), k)``.
+    """
+    range_of_row = np.repeat(np.arange(len(ranges)),
+                             ranges['end'] - ranges['start'])
+    best = np.full((len(queries), len(ranges)), -np.inf, dtype=np.float32)
+    for start in range(0, len(vectors), BLOCK_SIZE):
+        scores = queries @ _unit(vectors[start:start + BLOCK_SIZE]).T
+        owners = range_of_row[start:start + len(scores[0])]
+        bounds = np.flatnonzero(np.diff(owners, prepend=-1))
+        block_best = np.maximum.reduceat(scores, bounds, axis=1)
+        ids = owners[bounds]
+        best[:, ids] = np.maximum(best[:, ids], block_best)
+    k = min(top_k, len(ranges))
+    top = np.argsort(-best, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(best, top, axis=1), top
+
+
+class DocIndex:
+    """Two-stage per-document search over one build."""
+
+    def __init__(self, centroids: np.ndarray, ranges: np.ndarray, vectors):
+        if len(centroids) != len(ranges):
+            raise ValueError(
+                f"{DOC_INDEX_FILENAME} has {len(centroids)} documents but "
+                f"the chunk store has {len(ranges)} document ranges; "
+                f"rebuild the index")
+        self.centroids = centroids
+        self.ranges = ranges
+        self.vectors = vectors
+
+    @classmethod
+    def open(cls, build_dir: Path, index=None) -> 'DocIndex':
+        """Load the document index of the build in *build_dir*.
+
+        Chunk vectors come from embeddings.npy (memory-mapped) or, for a
+        single-copy build, from *index* itself.
+        """
+        build_dir = Path(build_dir)
+        path = build_dir / DOC_INDEX_FILENAME
+        ranges_path = build_dir / STORE_DIRNAME / "doc_ranges.npy"
+        if not path.exists() or not ranges_path.exists():
+            raise ValueError(f"{build_dir} has no document index; rebuild it "
+                             f"with build_index.py")
+        embeddings_path = build_dir / "embeddings.npy"
+        if embeddings_path.exists():
+            vectors = np.load(embeddings_path, mmap_mode='r')
+        elif index is not None:
+            from build_index import IndexVectors
+            vectors = IndexVectors(index)
+        else:
+            raise ValueError(f"{build_dir} has neither embeddings.npy nor an "
+                             f"index to read chunk vectors from")
+        return cls(np.load(path), np.load(ranges_path), vectors)
+
+    def candidates(self, queries: np.ndarray, n: int,
+                   live: Optional[np.ndarray] = None) -> np.ndarray:
+        """Stage 1: the *n* best range rows per query by centroid score."""
+        scores = queries @ self.centroids.T
+        if live is not None:
+            scores[:, ~live] = -np.inf
+            n = min(n, int(live.sum()))
+        n = min(n, len(self.ranges))
+        if n <= 0:
+            return np.empty((len(queries), 0), dtype=np.int64)
+        top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+        return np.sort(top, axis=1)
+
+    def rerank(self, query: np.ndarray, candidates: np.ndarray, top_k: int,
+               mask: Optional[np.ndarray] = None) -> List[Tuple[float, int]]:
+        """Stage 2: exact scores of the candidates' chunks for one query.
+
+        Returns up to *top_k* ``(score, row)`` pairs, the best row of each
+        distinct document, best first. Rows outside *mask* never count.
+        """
+        selected = self.ranges[candidates]
+        lengths = selected['end'] - selected['start']
+        if not len(selected) or not lengths.sum():
+            return []
+        rows = np.concatenate([np.arange(s, e) for s, e in
+                               zip(selected['start'], selected['end'])])
+        scores = _unit(self.vectors[rows]) @ query
+        if mask is not None:
+            scores[~mask[rows]] = -np.inf
+
+        best: Dict[int, Tuple[float, int]] = {}
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        for doc, lo, hi in zip(selected['doc'], offsets[:-1], offsets[1:]):
+            j = lo + int(np.argmax(scores[lo:hi]))
+            if scores[j] == -np.inf:
+                continue
+            # A re-added document has a range per copy; keep its best row
+            if doc not in best or scores[j] > best[doc][0]:
+                best[doc] = (float(scores[j]), int(rows[j]))
+        return sorted(best.values(), key=lambda hit: -hit[0])[:top_k]
+
+    def search(self, queries: np.ndarray, top_k: int,
+               candidates: int = DOC_CANDIDATES,
+               mask: Optional[np.ndarray] = None
+               ) -> List[List[Tuple[float, int]]]:
+        """Per-document top-k ``(score, row)`` lists, one per query.
+
+        *queries* are unit vectors; *mask* is a row mask (filters and
+        tombstones) or None for every row.
+        """
+        live = None
+        if mask is not None:
+            starts = self.ranges['start']
+            live = np.add.reduceat(mask, starts) > 0 if len(starts) else \
+                np.zeros(0, dtype=bool)
+        picked = self.candidates(queries, max(candidates, top_k), live)
+        return [self.rerank(q, c, top_k, mask) for q, c in zip(queries, picked)]
+
+
+def measure_doc_recall(vectors, ranges: np.ndarray, centroids: np.ndarray,
+                       k: int = 10, n_queries: int = 200,
+                       candidates=RECALL_CANDIDATES) -> Dict:
+    """Recall@k of two-stage per-document search against exhaustive search.
+
+    Queries are stored chunk vectors sampled evenly across the corpus.
+    Recall is the fraction of each exhaustive top-k document set found by
+    the two-stage search, for each candidate count.
+    """
+    n = len(vectors)
+    k = min(k, len(ranges))
+    rows = np.unique(np.linspace(0, n - 1, min(n_queries, n)).astype(np.int64))
+    queries = _unit(vectors[rows])
+    _, reference = exhaustive_search(queries, vectors, ranges, k)
+
+    doc_index = DocIndex(centroids, ranges, vectors)
+    range_of_row = np.repeat(np.arange(len(ranges)),
+                             ranges['end'] - ranges['start'])
+    results = {}
+    for c in candidates:
+        picked = doc_index.candidates(queries, max(c, k))
+        found = [[range_of_row[row] for _, row in doc_index.rerank(q, p, k)]
+                 for q, p in zip(queries, picked)]
+        recall = np.mean([len(set(r) & set(f)) / k
+                          for r, f in zip(reference, found)])
+        results[str(c)] = round(float(recall), 4)
+    return {'recall_k': k, 'recall_queries': len(queries),
+            'recall_at_candidates': results}
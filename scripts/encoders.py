@@ -0,0 +1,517 @@
+#!/usr/bin/env python3
+"""
+Passage and Query Encoders
+
+Shared by build_index.py and query.py. An encoder turns a list of prefixed
+texts into L2-normalised float32 vectors and reports token lengths so that
+batches can be formed by a token budget instead of a fixed count.
+
+Encoders:
+    SentenceTransformerEncoder  e5-large-v2 on CUDA (FP16) or CPU (FP32)
+    StubEncoder                 Deterministic hash-seeded vectors for smoke
+                                tests and benchmarks without model weights
+    MultiProcessEncoder         N CPU worker processes, each with its own
+                                model copy, writing into one shared array
+
+Quantization:
+    quantize='int8' applies PyTorch dynamic int8 quantization to the Linear
+    layers of the CPU model. Because it changes the vectors, it is refused
+    unless a recall check (check_quantized.py) has passed and recorded its
+    result, and the model name gains a "+int8" suffix so caches, resumed
+    shards and incremental builds never mix int8 and full-precision vectors.
+
+Batching:
+    Texts are sorted by token length and packed into batches whose padded
+    size (longest text x batch size) stays within a token budget. Short
+    chunks then share large batches, long chunks get small ones, and very
+    little compute is spent on padding. Results are returned in the
+    original order.
+"""
+
+import os
+import json
+import time
+import hashlib
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from queue import Empty
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+EMBEDDING_MODEL = "intfloat/e5-large-v2"
+EMBEDDING_DIM = 1024
+
+# Padded tokens per forward pass. CPU budgets are kept small because
+# attention memory grows with batch x sequence length squared.
+BATCH_TOKENS = {'cuda': 131072, 'cpu': 16384}
+
+# Seconds between liveness checks of multi-process encoder workers
+WORKER_POLL_S = 5.0
+
+
+# ── Quantization ─────────────────────────────────────────────────────────────
+
+QUANTIZE_MODES = ('int8',)
+
+
+def quantize_int8(model):
+    """Dynamically quantize the Linear layers of *model* to int8 (CPU only)."""
+    import torch
+
+    return torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def require_quantization_check(check_path, mode: str, use: str,
+                               model: str) -> Dict:
+    """Refuse quantized encoding unless a passing recall check is on record.
+
+    *check_path* is a ``quantization_check.json`` written by
+    check_quantized.py; *use* is ``build`` (passages and queries quantized)
+    or ``query`` (queries quantized against full-precision passages);
+    *model* is the ``model_label`` of the encoder being quantized.
+    Raises RuntimeError when the file is missing, was recorded for another
+    model, covers another mode, or recorded a top-k agreement below its
+    threshold for *use*.
+    """
+    if check_path is None or not Path(check_path).exists():
+        raise RuntimeError(
+            f"--quantize {mode} requires a passing recall check; run "
+            f"check_quantized.py first (looked for {check_path})"
+        )
+    with open(check_path) as f:
+        check = json.load(f)
+    if check.get('model') != model:
+        raise RuntimeError(
+            f"{check_path} was recorded for model {check.get('model')!r}, "
+            f"not {model!r}; run check_quantized.py with this encoder"
+        )
+    result = check.get('uses', {}).get(use)
+    if check.get('mode') != mode or result is None:
+        raise RuntimeError(f"{check_path} does not cover {mode} {use} mode")
+    if not result['passed']:
+        raise RuntimeError(
+            f"{mode} {use} mode refused: top-{check['top_k']} agreement "
+            f"{result['overlap']:.3f} is below threshold {check['threshold']}"
+        )
+    return check
+
+
+def model_label(kind: str, quantize: Optional[str] = None) -> str:
+    """Name recorded for vectors from *kind*, e.g. ``intfloat/e5-large-v2+int8``."""
+    name = EMBEDDING_MODEL if kind == 'e5' else kind
+    return f"{name}+{quantize}" if quantize else name
+
+
+# ── Devices ──────────────────────────────────────────────────────────────────
+
+def resolve_device(device: str = 'auto') -> str:
+    """Map ``auto`` to ``cuda`` when available, else ``cpu``.
+
+    Raises RuntimeError if ``cuda`` is requested explicitly but missing.
+    """
+    import torch
+
+    if device == 'auto':
+        return 'cuda' if torch.cuda.is_available() else 'cpu'
+    if device == 'cuda' and not torch.cuda.is_available():
+        raise RuntimeError(
+            "CUDA not available. Install a CUDA-capable PyTorch build, run on "
+            "a machine with an NVIDIA GPU, or use --device cpu."
+        )
+    return device
+
+
+# ── Batching ─────────────────────────────────────────────────────────────────
+
+def length_bucketed_batches(lengths: List[int], batch_tokens: int,
+                            max_batch: int = 4096) -> List[np.ndarray]:
+    """Group text positions into batches by a padded-token budget.
+
+    Positions are visited longest first; a batch is closed when adding the
+    next text would push ``longest_in_batch * batch_len`` past
+    *batch_tokens* (a single over-long text still gets its own batch).
+    """
+    order = np.argsort(-np.asarray(lengths, dtype=np.int64), kind='stable')
+    batches: List[np.ndarray] = []
+    start = 0
+    while start < len(order):
+        longest = max(int(lengths[order[start]]), 1)
+        size = max(1, min(batch_tokens // longest, max_batch))
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+
+def fixed_batches(n: int, batch_size: int) -> List[np.ndarray]:
+    """Consecutive fixed-count batches in input order."""
+    return [np.arange(start, min(start + batch_size, n))
+            for start in range(0, n, batch_size)]
+
+
+def padding_efficiency(lengths: List[int], batches: List[np.ndarray]) -> float:
+    """Real tokens divided by padded tokens computed over *batches*."""
+    lengths_arr = np.asarray(lengths, dtype=np.int64)
+    real = int(lengths_arr.sum())
+    padded = sum(int(lengths_arr[b].max()) * len(b) for b in batches if len(b))
+    return round(real / padded, 4) if padded else 1.0
+
+
+def encode_in_batches(encode_batch, texts: List[str],
+                      batches: List[np.ndarray], dim: int) -> np.ndarray:
+    """Run *encode_batch* over index *batches* and restore input order."""
+    out = np.empty((len(texts), dim), dtype=np.float32)
+    for batch in batches:
+        out[batch] = encode_batch([texts[i] for i in batch])
+    return out
+
+
+# ── Encoders ─────────────────────────────────────────────────────────────────
+
+class Encoder:
+    """Base class: times every ``encode`` call and counts encoded texts.
+
+    Subclasses set ``name``, ``device``, ``dim``, ``batch_tokens``,
+    ``bucketed`` and ``batch_size`` and implement ``_encode``.
+    """
+
+    def __init__(self):
+        self.stats = {'texts': 0, 'seconds': 0.0}
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Encode prefixed *texts* into normalised float32 vectors."""
+        started = time.perf_counter()
+        out = self._encode(texts)
+        self.stats['texts'] += len(texts)
+        self.stats['seconds'] += time.perf_counter() - started
+        return out
+
+    def warmup(self, texts: List[str]) -> None:
+        """Encode *texts* without counting them in the throughput stats."""
+        self._encode(texts)
+
+    def _batches(self, texts: List[str]) -> List[np.ndarray]:
+        if self.bucketed:
+            return length_bucketed_batches(self.token_lengths(texts),
+                                           self.batch_tokens)
+        return fixed_batches(len(texts), self.batch_size)
+
+    def report(self) -> Dict:
+        """Throughput summary for the build report."""
+        seconds = self.stats['seconds']
+        return {
+            'texts': self.stats['texts'],
+            'seconds': round(seconds, 3),
+            'texts_per_sec': (round(self.stats['texts'] / seconds, 2)
+                              if seconds else None),
+        }
+
+    def close(self) -> None:
+        pass
+
+
+class SentenceTransformerEncoder(Encoder):
+    """e5-large-v2 through sentence-transformers on CUDA or CPU.
+
+    CUDA runs in FP16 to stay within a 3 GB VRAM envelope; CPU runs in FP32.
+    With ``bucketed=True`` texts are batched by *batch_tokens*; otherwise
+    they are encoded in input order in batches of *batch_size*. The model
+    weights are loaded on first use, so a build that finds every vector in
+    a cache or a previous build never loads them. With ``quantize='int8'``
+    the CPU model is dynamically quantized after loading.
+    """
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL, device: str = 'auto',
+                 batch_tokens: Optional[int] = None, bucketed: bool = True,
+                 batch_size: int = 1300, threads: Optional[int] = None,
+                 quantize: Optional[str] = None):
+        super().__init__()
+        self.model_name = model_name
+        self.name = f"{model_name}+{quantize}" if quantize else model_name
+        self.device = resolve_device(device)
+        if quantize and self.device != 'cpu':
+            raise RuntimeError(f"--quantize {quantize} is CPU-only; "
+                               f"use --device cpu")
+        self.quantize = quantize
+        self.dim = EMBEDDING_DIM
+        self.batch_tokens = batch_tokens or BATCH_TOKENS[self.device]
+        self.bucketed = bucketed
+        self.batch_size = batch_size
+        self.threads = threads
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            from sentence_transformers import SentenceTransformer
+            import torch
+
+            if self.threads:
+                torch.set_num_threads(self.threads)
+            if self.device == 'cuda':
+                torch.cuda.empty_cache()
+            print(f"Loading model: {self.name} ({self.device})")
+            self._model = SentenceTransformer(self.model_name,
+                                              device=self.device)
+            if self.device == 'cuda':
+                self._model.half()  # FP16
+            if self.quantize == 'int8':
+                self._model = quantize_int8(self._model)
+        return self._model
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        """Token count of each text after truncation, special tokens included."""
+        encoded = self.model.tokenizer(
+            texts, add_special_tokens=True, truncation=True,
+            max_length=self.model.max_seq_length,
+        )
+        return [len(ids) for ids in encoded['input_ids']]
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        import torch
+
+        with torch.no_grad():
+            return self.model.encode(
+                texts,
+                batch_size=len(texts),
+                show_progress_bar=False,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+            )
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return encode_in_batches(self._encode_batch, texts,
+                                 self._batches(texts), self.dim)
+
+
+class StubEncoder(Encoder):
+    """Deterministic stand-in for the embedding model.
+
+    Each text maps to a fixed unit vector seeded from its BLAKE2b digest,
+    so identical texts always get identical vectors and repeated runs are
+    byte-identical. Token lengths use the 1 token ~ 4 characters estimate.
+    With ``quantize='int8'`` each vector is rounded to an int8 grid.
+    """
+
+    def __init__(self, dim: int = EMBEDDING_DIM, batch_tokens: int = 16384,
+                 bucketed: bool = True, batch_size: int = 1300,
+                 threads: Optional[int] = None, quantize: Optional[str] = None):
+        super().__init__()
+        self.name = model_label('stub', quantize)
+        self.quantize = quantize
+        self.device = 'cpu'
+        self.dim = dim
+        self.max_seq_length = 512
+        self.batch_tokens = batch_tokens
+        self.bucketed = bucketed
+        self.batch_size = batch_size
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        return [min(len(t) // 4 + 2, self.max_seq_length) for t in texts]
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            seed = hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest()
+            rng = np.random.default_rng(int.from_bytes(seed, 'little'))
+            vec = rng.standard_normal(self.dim).astype(np.float32)
+            vec /= np.linalg.norm(vec)
+            if self.quantize == 'int8':
+                # Mimic int8 rounding error so the recall check has signal
+                vec = np.round(vec * 127 / np.abs(vec).max()).astype(np.float32)
+                vec /= np.linalg.norm(vec)
+            out[i] = vec
+        return out
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return encode_in_batches(self._encode_batch, texts,
+                                 self._batches(texts), self.dim)
+
+
+# ── Multi-process CPU encoding ───────────────────────────────────────────────
+
+def _encode_worker(worker_id: int, kind: str, kwargs: Dict,
+                   tasks, results) -> None:
+    """Worker loop: encode batches of texts into a shared output array.
+
+    Each task is ``(shm_name, n_rows, positions, texts)``. Vectors are
+    written straight into the shared block at *positions*, so only texts
+    and small status tuples cross process boundaries.
+    """
+    try:
+        encoder = load_encoder(kind, 'cpu', **kwargs)
+        encoder.warmup(["warmup"])
+        results.put(('ready', worker_id, None))
+    except BaseException:
+        results.put(('error', worker_id, traceback.format_exc()))
+        return
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        shm_name, n_rows, positions, texts = task
+        try:
+            started = time.perf_counter()
+            vectors = encoder.encode(texts)
+            shm = shared_memory.SharedMemory(name=shm_name)
+            try:
+                out = np.ndarray((n_rows, encoder.dim), dtype=np.float32,
+                                 buffer=shm.buf)
+                out[positions] = vectors
+                del out
+            finally:
+                shm.close()
+            results.put(('done', worker_id,
+                         (len(texts), time.perf_counter() - started)))
+        except BaseException:
+            results.put(('error', worker_id, traceback.format_exc()))
+
+
+class MultiProcessEncoder(Encoder):
+    """Encode on *workers* CPU processes, each holding its own model copy.
+
+    Every worker pins torch to *threads* intra-op threads (default: the
+    cores divided evenly between workers). ``encode`` allocates one
+    shared-memory float32 array for the call, splits the texts into
+    length-bucketed batches on a common task queue (workers pull batches as
+    they finish, which balances long and short chunks), and each worker
+    writes its vectors directly into the shared array.
+    """
+
+    def __init__(self, kind: str = 'e5', workers: int = 2,
+                 threads: Optional[int] = None,
+                 batch_tokens: Optional[int] = None, **kwargs):
+        super().__init__()
+        self.workers = workers
+        self.threads = threads or max(1, (os.cpu_count() or 1) // workers)
+        self.name = model_label(kind, kwargs.get('quantize'))
+        self.device = 'cpu'
+        self.dim = EMBEDDING_DIM
+        self.batch_tokens = batch_tokens or BATCH_TOKENS['cpu']
+        self.bucketed = kwargs.get('bucketed', True)
+        self.batch_size = kwargs.get('batch_size', 1300)
+        self._lengths = StubEncoder(batch_tokens=self.batch_tokens)
+        self._worker_texts = [0] * workers
+        self._worker_seconds = [0.0] * workers
+
+        ctx = mp.get_context('spawn')
+        self._tasks = ctx.Queue()
+        self._results = ctx.Queue()
+        worker_kwargs = dict(kwargs, threads=self.threads,
+                             batch_tokens=self.batch_tokens)
+        self._procs = [
+            ctx.Process(target=_encode_worker, daemon=True,
+                        args=(i, kind, worker_kwargs, self._tasks,
+                              self._results))
+            for i in range(workers)
+        ]
+        for proc in self._procs:
+            proc.start()
+        print(f"Starting {workers} encoder processes "
+              f"({self.threads} threads each) ...")
+        for _ in range(workers):
+            self._wait('ready')
+
+    def _wait(self, expected: str):
+        """Next worker status; raises if a worker failed or died."""
+        while True:
+            try:
+                status, worker_id, payload = self._results.get(
+                    timeout=WORKER_POLL_S)
+                break
+            except Empty:
+                dead = [(i, proc.exitcode) for i, proc in enumerate(self._procs)
+                        if not proc.is_alive()]
+                if dead:
+                    self.close()
+                    # A negative exit code is the signal that killed it
+                    # (9: SIGKILL, typically the out-of-memory killer)
+                    raise RuntimeError("encoder workers died: " + ', '.join(
+                        f"{i} (killed by signal {-code})" if code and code < 0
+                        else f"{i} (exit code {code})" for i, code in dead))
+        if status == 'error':
+            self.close()
+            raise RuntimeError(f"encoder worker {worker_id} failed:\n{payload}")
+        if status != expected:
+            raise RuntimeError(f"unexpected worker status {status!r}")
+        return worker_id, payload
+
+    def token_lengths(self, texts: List[str]) -> List[int]:
+        # Character estimate: tokenizing in the parent would need a model copy
+        return self._lengths.token_lengths(texts)
+
+    def warmup(self, texts: List[str]) -> None:
+        counts = list(self._worker_texts)
+        seconds = list(self._worker_seconds)
+        super().warmup(texts)
+        self._worker_texts, self._worker_seconds = counts, seconds
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, self.dim), dtype=np.float32)
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=len(texts) * self.dim * 4)
+        try:
+            batches = self._batches(texts)
+            for positions in batches:
+                self._tasks.put((shm.name, len(texts), positions,
+                                 [texts[i] for i in positions]))
+            for _ in batches:
+                worker_id, (count, seconds) = self._wait('done')
+                self._worker_texts[worker_id] += count
+                self._worker_seconds[worker_id] += seconds
+            out = np.ndarray((len(texts), self.dim), dtype=np.float32,
+                             buffer=shm.buf)
+            vectors = out.copy()
+            del out
+        finally:
+            shm.close()
+            shm.unlink()
+        return vectors
+
+    def report(self) -> Dict:
+        summary = super().report()
+        summary['workers'] = self.workers
+        summary['threads_per_worker'] = self.threads
+        summary['per_worker'] = [
+            {'texts': n, 'busy_s': round(t, 3),
+             'texts_per_sec': round(n / t, 2) if t else None}
+            for n, t in zip(self._worker_texts, self._worker_seconds)
+        ]
+        return summary
+
+    def close(self) -> None:
+        for proc in self._procs:
+            if proc.is_alive():
+                self._tasks.put(None)
+        for proc in self._procs:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
+
+
+def load_encoder(kind: str = 'e5', device: str = 'auto',
+                 batch_tokens: Optional[int] = None, workers: int = 1,
+                 **kwargs) -> Encoder:
+    """Construct the encoder named by *kind* (``e5`` or ``stub``).
+
+    With ``workers > 1`` on CPU, returns a MultiProcessEncoder running
+    *workers* copies of that encoder.
+    """
+    if workers > 1:
+        if kind == 'stub' or resolve_device(device) == 'cpu':
+            return MultiProcessEncoder(kind, workers,
+                                       batch_tokens=batch_tokens, **kwargs)
+        print("NOTE: multi-process encoding is CPU-only; using one CUDA "
+              "encoder")
+    if kind == 'stub':
+        return StubEncoder(batch_tokens=batch_tokens or BATCH_TOKENS['cpu'],
+                           **kwargs)
+    return SentenceTransformerEncoder(EMBEDDING_MODEL, device=device,
+                                      batch_tokens=batch_tokens, **kwargs)
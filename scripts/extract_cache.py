@@ -0,0 +1,124 @@
+"""
+PDF Text Extraction Cache
+
+Per-page pdftotext output shared between builds (build_index.py
+--extract_cache), so re-chunking a corpus with new parameters, or
+rebuilding it after a crash, does not run pdftotext again.
+
+Entries are keyed by the PDF's SHA-256 and a tag of the extractor (the
+pdftotext version and its flags), so upgrading poppler invalidates them.
+Layout of *cache_dir*:
+
+    <sha256[:2]>/<sha256>-<tag>.pages
+
+Each file holds a magic string, the page count, a uint64 table of page
+offsets and the zlib-compressed pages. Readers memory-map the file and
+decompress pages one at a time; ``read_page`` touches a single page.
+Files are written to a temporary name and renamed into place, so
+concurrent extraction workers and builds can share one directory.
+"""
+
+import os
+import zlib
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+PAGES_MAGIC = b'PDFPAGES1\n'
+COMPRESS_LEVEL = 6
+
+
+def extractor_tag(extractor: str) -> str:
+    """Short, filename-safe tag of an extractor description."""
+    return hashlib.sha256(extractor.encode('utf-8')).hexdigest()[:12]
+
+
+def write_pages(path: Path, pages: List[str]):
+    """Write *pages* to *path* (atomically, via a temporary file)."""
+    blobs = [zlib.compress(page.encode('utf-8'), COMPRESS_LEVEL)
+             for page in pages]
+    offsets = np.zeros(len(blobs) + 1, dtype='<u8')
+    np.cumsum([len(b) for b in blobs], out=offsets[1:])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(PAGES_MAGIC)
+        f.write(np.uint32(len(blobs)).tobytes())
+        f.write(offsets.tobytes())
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp, path)
+
+
+def _open_pages(path: Path):
+    """(memory map, page offsets, data start) of a .pages file."""
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+    if bytes(data[:len(PAGES_MAGIC)]) != PAGES_MAGIC:
+        raise ValueError(f"{path}: not an extraction cache file")
+    head = len(PAGES_MAGIC)
+    if len(data) < head + 4:
+        raise ValueError(f"{path}: truncated")
+    count = int(data[head:head + 4].view('<u4')[0])
+    base = head + 4 + 8 * (count + 1)
+    if len(data) < base:
+        raise ValueError(f"{path}: truncated")
+    offsets = data[head + 4:base].view('<u8')
+    if len(data) < base + int(offsets[-1]):
+        raise ValueError(f"{path}: truncated")
+    return data, offsets, base
+
+
+def read_pages(path: Path) -> List[str]:
+    data, offsets, base = _open_pages(path)
+    return [zlib.decompress(data[base + int(offsets[i]):
+                                 base + int(offsets[i + 1])]).decode('utf-8')
+            for i in range(len(offsets) - 1)]
+
+
+def read_page(path: Path, page: int) -> str:
+    """Text of 1-based *page* without decompressing the others."""
+    data, offsets, base = _open_pages(path)
+    if not 1 <= page < len(offsets):
+        raise IndexError(page)
+    return zlib.decompress(data[base + int(offsets[page - 1]):
+                                base + int(offsets[page])]).decode('utf-8')
+
+
+class ExtractCache:
+    """On-disk per-page text cache for one extractor."""
+
+    def __init__(self, cache_dir: Path, extractor: str):
+        self.cache_dir = Path(cache_dir)
+        self.extractor = extractor
+        self.tag = extractor_tag(extractor)
+
+    def path(self, sha256: str) -> Path:
+        return self.cache_dir / sha256[:2] / f"{sha256}-{self.tag}.pages"
+
+    def get(self, sha256: str) -> Optional[List[str]]:
+        """Cached pages of the PDF with this hash, or None.
+
+        An unreadable entry (e.g. truncated by a full disk) is a miss.
+        """
+        path = self.path(sha256)
+        if not path.exists():
+            return None
+        try:
+            return read_pages(path)
+        except (OSError, ValueError, zlib.error):
+            return None
+
+    def put(self, sha256: str, pages: List[str]):
+        write_pages(self.path(sha256), pages)
+
+    def report(self) -> Dict:
+        files = list(self.cache_dir.glob(f"*/*-{self.tag}.pages"))
+        return {
+            'dir': str(self.cache_dir),
+            'extractor': self.extractor,
+            'entries': len(files),
+            'bytes': sum(f.stat().st_size for f in files),
+        }
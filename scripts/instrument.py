@@ -0,0 +1,229 @@
+"""
+Per-Stage Instrumentation
+
+Records where the time and memory of a build (build_index.py) or a query
+run (query.py) went, stage by stage, for their reports. Every entry into
+a stage adds to its totals, so a stage that runs once per document or
+batch (extraction, embedding) is reported as one line:
+
+    calls          entries into the stage
+    wall_s         wall-clock seconds inside it
+    cpu_s          user + system CPU seconds: the whole process's, or only
+                   the calling thread's for stages that run beside others
+                   on threads
+    items          units of work (documents, chunks, vectors, queries)
+    items_per_sec  items / wall_s
+    rss_mb         largest resident set size seen when leaving the stage
+    peak_rss_mb    the process's peak RSS when the stage was last left
+
+Stages measured in another process (build pool workers) come back as
+``totals()`` dicts and are folded in with ``merge()``.
+
+CPU time of child processes (pdftotext, pool and encoder workers) is
+counted by the OS for the whole process, not per thread, so it cannot be
+split between stages that overlap on threads. ``children_cpu_s()`` gives
+it once, for everything reaped since the recorder was created.
+
+With a profile directory, each stage also runs under cProfile, which
+accumulates across its entries; ``write_profiles()`` dumps
+``<stage>.prof`` (for pstats or snakeviz) and ``<stage>.txt`` (the top
+functions by cumulative time). Stages in pool workers are not profiled.
+Before Python 3.12, cProfile sees only the thread that entered the stage.
+From 3.12 it sees every thread but allows one active profiler, so a stage
+entered while another is being profiled (query.py's concurrent loaders)
+is skipped, with a note on stderr.
+"""
+
+import os
+import sys
+import time
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+PROFILE_LINES = 40      # functions listed per stage in <stage>.txt
+
+
+def _children_cpu() -> float:
+    """CPU seconds of this process's reaped children."""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def peak_rss_mb(children: bool = False) -> Optional[float]:
+    """Peak resident set size of this process so far.
+
+    With *children*, the largest peak of any reaped child process instead.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 ** 2 if sys.platform == 'darwin' else 1024), 1)
+
+
+def rss_mb() -> Optional[float]:
+    """Current resident set size (Linux), else None."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return round(pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2, 1)
+
+
+class Stages:
+    """Accumulating wall / CPU / memory / throughput recorder."""
+
+    def __init__(self, profile_dir: Optional[Path] = None):
+        self.profile_dir = Path(profile_dir) if profile_dir else None
+        self._totals: Dict[str, Dict] = {}
+        self._profiles: Dict[str, object] = {}
+        self._profiled: set = set()
+        self._unprofiled: set = set()
+        self._lock = threading.Lock()
+        self._children_start = _children_cpu()
+
+    def _entry(self, name: str) -> Dict:
+        return self._totals.setdefault(name, {
+            'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'items': 0,
+            'rss_mb': None, 'peak_rss_mb': None,
+        })
+
+    def add(self, name: str, wall_s: float, cpu_s: float, items: int = 0,
+            calls: int = 1, rss: Optional[float] = None,
+            peak_rss: Optional[float] = None):
+        """Add one measurement (or a merged total) to stage *name*."""
+        with self._lock:
+            entry = self._entry(name)
+            entry['calls'] += calls
+            entry['wall_s'] += wall_s
+            entry['cpu_s'] += cpu_s
+            entry['items'] += items
+            if rss is not None:
+                entry['rss_mb'] = max(entry['rss_mb'] or 0.0, rss)
+            if peak_rss is not None:
+                entry['peak_rss_mb'] = max(entry['peak_rss_mb'] or 0.0,
+                                           peak_rss)
+
+    def _profiler(self, name: str):
+        if self.profile_dir is None:
+            return None
+        import cProfile
+
+        with self._lock:
+            profile = self._profiles.get(name)
+            if profile is None:
+                profile = self._profiles[name] = cProfile.Profile()
+        return profile
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0, thread_cpu: bool = False):
+        """Measure the body as one entry into stage *name*.
+
+        Yields a dict whose ``items`` the body may set once it knows how
+        much work it did. With *thread_cpu*, CPU time is the calling
+        thread's rather than the whole process's.
+        """
+        clock = time.thread_time if thread_cpu else time.process_time
+        record = {'items': items}
+        profile = self._profiler(name)
+        if profile is not None:
+            try:
+                profile.enable()
+                with self._lock:
+                    self._profiled.add(name)
+            except ValueError:
+                # Another profiler is active (Python 3.12+ allows one)
+                profile = None
+                if name not in self._unprofiled:
+                    self._unprofiled.add(name)
+                    print(f"  NOTE: {name} entered while another stage was "
+                          f"being profiled; those entries are not profiled",
+                          file=sys.stderr)
+        wall, cpu = time.perf_counter(), clock()
+        try:
+            yield record
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = clock() - cpu
+            if profile is not None:
+                profile.disable()
+            rss, peak = rss_mb(), peak_rss_mb()
+            if rss is not None and peak is not None:
+                peak = max(peak, rss)       # the two are sampled separately
+            self.add(name, wall, cpu, record['items'], rss=rss, peak_rss=peak)
+
+    def totals(self) -> Dict[str, Dict]:
+        """Raw totals, for merging into another recorder."""
+        with self._lock:
+            return {name: dict(entry) for name, entry in self._totals.items()}
+
+    def merge(self, totals: Dict[str, Dict]):
+        for name, entry in totals.items():
+            self.add(name, entry['wall_s'], entry['cpu_s'], entry['items'],
+                     entry['calls'], entry['rss_mb'], entry['peak_rss_mb'])
+
+    def children_cpu_s(self) -> float:
+        """CPU seconds of child processes reaped since creation."""
+        return round(_children_cpu() - self._children_start, 4)
+
+    def report(self) -> Dict[str, Dict]:
+        """Rounded totals with throughput, in the order stages first ran."""
+        report = {}
+        for name, entry in self.totals().items():
+            wall = entry['wall_s']
+            report[name] = {
+                'calls': entry['calls'],
+                'wall_s': round(wall, 4),
+                'cpu_s': round(entry['cpu_s'], 4),
+                'items': entry['items'],
+                'items_per_sec': round(entry['items'] / wall, 1)
+                                 if entry['items'] and wall else None,
+                'rss_mb': entry['rss_mb'],
+                'peak_rss_mb': entry['peak_rss_mb'],
+            }
+        return report
+
+    def format(self) -> str:
+        """One line per stage, for terminal summaries."""
+        report = self.report()
+        width = max(map(len, report), default=0)
+        lines = []
+        for name, s in report.items():
+            rate = f", {s['items_per_sec']:,.1f}/s" if s['items_per_sec'] \
+                else ''
+            memory = f", peak RSS {s['peak_rss_mb']} MB" \
+                if s['peak_rss_mb'] is not None else ''
+            lines.append(f"  {name:{width}s}: {s['wall_s']:9.3f}s wall, "
+                         f"{s['cpu_s']:9.3f}s CPU, {s['items']} items"
+                         f"{rate}{memory}")
+        return '\n'.join(lines)
+
+    def write_profiles(self) -> Dict[str, str]:
+        """Dump each stage's profile; returns stage -> .prof path."""
+        if self.profile_dir is None:
+            return {}
+        import pstats
+
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        paths = {}
+        for name, profile in self._profiles.items():
+            if name not in self._profiled:
+                continue        # never enabled: no stats to write
+            path = self.profile_dir / f"{name}.prof"
+            profile.dump_stats(str(path))
+            with open(self.profile_dir / f"{name}.txt", 'w') as f:
+                pstats.Stats(profile, stream=f).sort_stats(
+                    'cumulative').print_stats(PROFILE_LINES)
+            paths[name] = str(path)
+        return paths
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Query Server Load Test
+
+Drives a running serve.py with concurrent keep-alive clients and reports
+client-side throughput and latency percentiles alongside the server's own
+/metrics (including the micro-batch size histogram).
+
+Usage:
+    python serve.py --index ./index/faiss.index --chunks ./index/chunks.jsonl &
+
+    python load_test.py --queries-file ../demo/sample_queries.md \
+        --concurrency 16 --requests 500
+
+    # Compare concurrency levels
+    python load_test.py --queries-file ./queries.txt --concurrency 1,8,32 --json
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from query import load_queries
+
+
+async def http_request(reader, writer, host: str, method: str, path: str,
+                       payload: Dict = None) -> Tuple[int, Dict]:
+    """Send one request on an open keep-alive connection."""
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\n"
+        f"Host: {host}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"\r\n".encode() + body
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def get_json(host: str, port: int, path: str) -> Dict:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return (await http_request(reader, writer, host, 'GET', path))[1]
+    finally:
+        writer.close()
+
+
+async def client(host: str, port: int, queries: List[str], top_k: int,
+                 counter, latencies: List[float], errors: List[str]):
+    """Issue requests until the shared counter is exhausted."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for i in counter:
+            started = time.perf_counter()
+            status, response = await http_request(
+                reader, writer, host, 'POST', '/search',
+                {'query': queries[i % len(queries)], 'top_k': top_k},
+            )
+            if status == 200:
+                latencies.append(1000 * (time.perf_counter() - started))
+            else:
+                errors.append(response.get('error', str(status)))
+    finally:
+        writer.close()
+
+
+async def run_level(host: str, port: int, queries: List[str], top_k: int,
+                    concurrency: int, n_requests: int) -> Dict:
+    before = await get_json(host, port, '/metrics')
+    counter = iter(range(n_requests))
+    latencies: List[float] = []
+    errors: List[str] = []
+
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        client(host, port, queries, top_k, counter, latencies, errors)
+        for _ in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - started
+    after = await get_json(host, port, '/metrics')
+
+    batches = after['batches'] - before['batches']
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) \
+        if latencies else (0, 0, 0)
+    return {
+        'concurrency': concurrency,
+        'requests': n_requests,
+        'errors': len(errors),
+        'elapsed_sec': round(elapsed, 3),
+        'queries_per_sec': round(len(latencies) / elapsed, 1),
+        'latency_ms': {'p50': round(float(p50), 2),
+                       'p90': round(float(p90), 2),
+                       'p99': round(float(p99), 2)},
+        'server_batches': batches,
+        'mean_batch_size': round(len(latencies) / batches, 2)
+        if batches else None,
+    }
+
+
+async def run(args, queries: List[str], levels: List[int]) -> Dict:
+    results = []
+    for concurrency in levels:
+        r = await run_level(args.host, args.port, queries, args.top_k,
+                            concurrency, args.requests)
+        results.append(r)
+        if not args.json:
+            lat = r['latency_ms']
+            print(f"  concurrency {concurrency:3d}: "
+                  f"{r['queries_per_sec']:8.1f} q/s  "
+                  f"p50 {lat['p50']:7.2f} ms  p99 {lat['p99']:7.2f} ms  "
+                  f"mean batch {r['mean_batch_size']}  "
+                  f"errors {r['errors']}")
+    return {'levels': results,
+            'server_metrics': await get_json(args.host, args.port, '/metrics')}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load-test a running serve.py instance.'
+    )
+    parser.add_argument('--queries-file', required=True,
+                        help='Queries (one per line, JSONL or .md)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--concurrency', default='16',
+                        help='Concurrent clients, or a comma-separated list '
+                             'of levels to compare (default: 16)')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Requests per concurrency level (default: 500)')
+    parser.add_argument('--top-k', '-k', type=int, default=5,
+                        help='Results per query (default: 5)')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the full report as JSON')
+    args = parser.parse_args()
+
+    queries = load_queries(Path(args.queries_file))
+    if not queries:
+        print(f"ERROR: no queries found in {args.queries_file}",
+              file=sys.stderr)
+        sys.exit(1)
+    levels = [int(c) for c in args.concurrency.split(',')]
+
+    if not args.json:
+        print(f"Load test: {args.requests} requests per level against "
+              f"{args.host}:{args.port}")
+    try:
+        report = asyncio.run(run(args, queries, levels))
+    except ConnectionError as e:
+        print(f"ERROR: cannot reach server: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        hist = report['server_metrics']['batch_size_histogram']
+        print(f"  Server batch sizes: {hist}")
+
+
+if __name__ == '__main__':
+    main()
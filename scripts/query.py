@@ -20,31 +20,138 @@ Usage:
                     --chunks ./index/chunks.jsonl \
                     --query "unemployment insurance adequacy" \
                     --json
+
+    # int8-quantized CPU query encoding (needs a passing check_quantized.py
+    # verdict, by default ./index/quantization_check.json)
+    python query.py --index ./index/faiss.index \
+                    --chunks ./index/chunks.jsonl \
+                    --query "unemployment insurance adequacy" \
+                    --quantize int8
+
+    # Batch mode: one query per line (or JSONL with a "query" field),
+    # results streamed as JSONL
+    python query.py --index ./index/faiss.index \
+                    --chunks ./index/chunks.jsonl \
+                    --queries-file ./queries.txt > results.jsonl
+
+    # Approximate index: widen the search at query time
+    python query.py --index ./index_ivf/faiss.index \
+                    --chunks ./index_ivf/chunks.jsonl \
+                    --query "unemployment insurance adequacy" --nprobe 32
+
+    # Pre-filter by metadata (applied inside the FAISS search)
+    python query.py --index ./index/faiss.index \
+                    --chunks ./index/chunks.jsonl \
+                    --query "minimum wage effects on employment" \
+                    --year 2015-2025 --section Results --section Findings
+
+    # Best chunk of each of the top 10 distinct documents (two-stage
+    # search over the document-centroid index, see doc_index.py)
+    python query.py --index ./index/faiss.index \
+                    --chunks ./index/chunks.jsonl \
+                    --query "minimum wage effects on employment" \
+                    --per-doc -k 10
+
+    # Documents related to one document (graph built by related.py)
+    python query.py --index ./index/faiss.index \
+                    --related labor_market_dynamics_2023 -k 10
+
+    # Search several build outputs (see shards.py) as one index
+    python query.py --index ./shards.json \
+                    --query "minimum wage effects on employment"
+
+    # Warm the model before the first query and show where startup went
+    python query.py --index ./index/faiss.index \
+                    --chunks ./index/chunks.jsonl \
+                    --warmup --startup-times
+
+    # Time, and cProfile, loading, encoding and search (see instrument.py)
+    python query.py --index ./index/faiss.index \
+                    --chunks ./index/chunks.jsonl \
+                    --queries-file ./queries.txt --startup-times \
+                    --profile ./profiles > results.jsonl
+
+Repeated queries are served from an LRU cache of query vectors and a memo
+of result lists tied to the index build (see query_cache.py); pass
+--cache-dir to keep both between runs.
+
+Heavy modules (numpy, faiss, torch, sentence_transformers) are imported
+only when first needed, and the index, chunks and model load concurrently.
 """
 
+import re
 import sys
 import json
+import time
 import argparse
 from pathlib import Path
-from typing import List, Dict
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
-import faiss
+if TYPE_CHECKING:
+    import numpy as np
 
 
 MODEL_NAME = "intfloat/e5-large-v2"
+QUERY_BATCH_SIZE = 64
 
 
-def load_index(index_path: Path, chunks_path: Path):
-    """Load a FAISS index and its corresponding chunk metadata."""
-    print("Loading index ...", file=sys.stderr)
-    index = faiss.read_index(str(index_path))
+def load_chunks(chunks_path: Path):
+    """Open the chunk store for *chunks_path*, or parse chunks.jsonl.
+
+    *chunks_path* may be a ``chunk_store/`` directory or a ``chunks.jsonl``
+    file; a chunk store next to the file is preferred, since it serves rows
+    on demand instead of holding every chunk in memory. Either way the
+    result supports ``len()`` and indexing by FAISS row.
+    """
+    from chunk_store import STORE_DIRNAME, ChunkStore
+
+    store_path = chunks_path if chunks_path.is_dir() else \
+        chunks_path.parent / STORE_DIRNAME
+    if (store_path / "tables.json").exists():
+        return ChunkStore(store_path)
 
     chunks: List[Dict] = []
     with open(chunks_path, 'r') as f:
         for line in f:
             chunks.append(json.loads(line))
+    return chunks
+
 
+def read_faiss_index(index_path: Path):
+    import faiss
+
+    print("Loading index ...", file=sys.stderr)
+    return faiss.read_index(str(index_path))
+
+
+def configure_search(index, nprobe: int = None, ef_search: int = None) -> str:
+    """Apply query-time search breadth to an IVF or HNSW index.
+
+    Returns a short description of the settings in effect (part of the
+    result-cache key, since they change results). Raises ValueError if a
+    parameter does not apply to *index*; a ShardSet applies each parameter
+    to the shards it fits.
+    """
+    import faiss
+
+    if hasattr(index, 'configure'):
+        return index.configure(nprobe, ef_search)
+
+    settings = []
+    for name, value in (('nprobe', nprobe), ('efSearch', ef_search)):
+        if value is None:
+            continue
+        try:
+            faiss.ParameterSpace().set_index_parameter(index, name, value)
+        except RuntimeError:
+            raise ValueError(f"{name} does not apply to this "
+                             f"{type(index).__name__}")
+        settings.append(f"{name}={value}")
+    return ','.join(settings)
+
+
+def check_alignment(index, chunks):
     if index.ntotal != len(chunks):
         print(
             f"WARNING: index has {index.ntotal} vectors but chunks.jsonl "
@@ -52,43 +159,162 @@ def load_index(index_path: Path, chunks_path: Path):
             file=sys.stderr
         )
 
+
+def load_index(index_path: Path, chunks_path: Path):
+    """Load a FAISS index and its corresponding chunk metadata."""
+    index = read_faiss_index(index_path)
+    chunks = load_chunks(chunks_path)
+    check_alignment(index, chunks)
     return index, chunks
 
 
-def load_model():
-    """Load the embedding model (GPU if available, else CPU)."""
+def load_all(index_path: Path, chunks_path: Path, quantize: str = None,
+             warmup: bool = False, max_shard_bytes: int = None,
+             stages=None):
+    """Load the index, chunks and model concurrently.
+
+    Each loader runs on its own thread, so importing torch and reading the
+    model weights overlap with reading the index and opening the chunks.
+    With *warmup*, a dummy query is encoded once the model is loaded, so the
+    first real query does not pay for lazy initialisation. Returns
+    ``(index, chunks, model, timings)``, where *timings* holds seconds per
+    phase plus ``ready`` (wall time of the whole concurrent load).
+
+    When *index_path* is a shard manifest, the returned index and chunks
+    are the same ShardSet (shards.py) and *chunks_path* is ignored. Each
+    phase is also recorded in *stages* (instrument.Stages), as
+    ``load_<phase>`` with the CPU time of its own thread.
+    """
+    from shards import is_manifest, open_shards
+    from instrument import Stages
+
+    timings: Dict[str, float] = {}
+    stages = stages if stages is not None else Stages()
+
+    def timed(name, fn, *args):
+        started = time.perf_counter()
+        with stages.stage(f'load_{name}', thread_cpu=True):
+            result = fn(*args)
+        timings[name] = round(time.perf_counter() - started, 3)
+        return result
+
+    def model_phase():
+        model = timed('model', load_model, quantize)
+        if warmup:
+            timed('warmup', encode_queries, ['warmup'], model)
+        return model
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        if is_manifest(index_path):
+            index = chunks = pool.submit(timed, 'index', open_shards,
+                                         index_path, max_shard_bytes)
+        else:
+            index = pool.submit(timed, 'index', read_faiss_index, index_path)
+            chunks = pool.submit(timed, 'chunks', load_chunks, chunks_path)
+        model = pool.submit(model_phase)
+        index, chunks, model = index.result(), chunks.result(), model.result()
+    timings['ready'] = round(time.perf_counter() - started, 3)
+
+    check_alignment(index, chunks)
+    return index, chunks, model, timings
+
+
+def open_query_cache(index_path: Path, quantize: str = None,
+                     cache_dir: str = None, max_entries: int = None,
+                     search_settings: str = '', index=None):
+    """QueryCache for this model, index build and search settings.
+
+    A ShardSet *index* supplies a fingerprint covering all its shards.
+    """
+    from encoders import model_label
+    from query_cache import QUERY_CACHE_ENTRIES, QueryCache, index_fingerprint
+
+    fingerprint = getattr(index, 'fingerprint', None) or \
+        index_fingerprint(index_path)
+    if search_settings:
+        fingerprint += f"/{search_settings}"
+    return QueryCache(model_label('e5', quantize), fingerprint,
+                      max_entries or QUERY_CACHE_ENTRIES,
+                      Path(cache_dir) if cache_dir else None)
+
+
+def format_timings(timings: Dict[str, float]) -> str:
+    phases = ', '.join(f"{name} {timings[name]:.2f}s"
+                       for name in ('index', 'chunks', 'model', 'warmup')
+                       if name in timings)
+    line = f"Startup: {phases}; ready in {timings['ready']:.2f}s"
+    if 'first_query' in timings:
+        line += f", first result after {timings['first_query']:.2f}s more"
+    return line
+
+
+def load_model(quantize: str = None):
+    """Load the embedding model (GPU if available, else CPU).
+
+    With *quantize* (``int8``), the model runs on CPU with dynamically
+    quantized Linear layers; callers must check the recall verdict first.
+    """
     from sentence_transformers import SentenceTransformer
     import torch
 
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    device = 'cuda' if torch.cuda.is_available() and not quantize else 'cpu'
     print(f"Loading model on {device} ...", file=sys.stderr)
     model = SentenceTransformer(MODEL_NAME, device=device)
     if device == 'cuda':
         model.half()
+    if quantize == 'int8':
+        from encoders import quantize_int8
+        model = quantize_int8(model)
     return model
 
 
-def search(query: str, index, chunks: List[Dict], model,
-           top_k: int = 5) -> List[Dict]:
-    """Encode *query* and return the top-k matching chunks."""
+def load_queries(path: Path) -> List[str]:
+    """Read queries from markdown (``**Query:** "..."``), JSONL or plain text."""
+    text = path.read_text()
+    if path.suffix == '.md':
+        return re.findall(r'\*\*Query:\*\*\s*"(.+?)"', text)
+    if path.suffix == '.jsonl':
+        return [json.loads(line)['query'] for line in text.splitlines()
+                if line.strip()]
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def encode_queries(queries: List[str], model,
+                   batch_size: int = QUERY_BATCH_SIZE) -> 'np.ndarray':
+    """Encode *queries* with the e5 query prefix into float32 unit vectors."""
+    import numpy as np
     import torch
 
-    query_text = f"query: {query}"
     with torch.no_grad():
-        query_vec = model.encode(
-            [query_text],
+        query_vecs = model.encode(
+            [f"query: {q}" for q in queries],
+            batch_size=batch_size,
             normalize_embeddings=True,
             convert_to_numpy=True,
         )
-    query_vec = query_vec.astype(np.float32)
+    return np.ascontiguousarray(query_vecs, dtype=np.float32)
+
 
-    scores, indices = index.search(query_vec, top_k)
+def chunk_by_uid(chunks, uid: int) -> Optional[Dict]:
+    """The chunk a FAISS search returned as *uid*, if *chunks* has it.
 
+    Chunk stores and shard sets map uids to rows; a parsed chunks.jsonl is
+    indexed by row, which is the uid until a build is updated in place.
+    """
+    if hasattr(chunks, 'by_uid'):
+        return chunks.by_uid(uid)
+    return chunks[uid] if 0 <= uid < len(chunks) else None
+
+
+def assemble_results(scores: 'np.ndarray', indices: 'np.ndarray',
+                     chunks) -> List[Dict]:
+    """Turn one row of FAISS scores/ids into result dicts."""
     results: List[Dict] = []
-    for rank, (score, idx) in enumerate(zip(scores[0], indices[0]), start=1):
-        if idx < 0 or idx >= len(chunks):
+    for rank, (score, idx) in enumerate(zip(scores, indices), start=1):
+        chunk = chunk_by_uid(chunks, int(idx)) if idx >= 0 else None
+        if chunk is None:
             continue
-        chunk = chunks[idx]
         text = chunk.get('text', '')
         results.append({
             'rank': rank,
@@ -99,10 +325,274 @@ def search(query: str, index, chunks: List[Dict], model,
             'section': chunk.get('section', ''),
             'snippet': text[:300] + ' ...' if len(text) > 300 else text,
         })
+        if chunk.get('page_start'):
+            results[-1]['pages'] = [chunk['page_start'], chunk['page_end']]
+        if chunk.get('aliases'):
+            # Deduplicated copies of this passage in other documents
+            results[-1]['also_in'] = [
+                {'doc_id': a['doc_id'], 'title': a.get('title', ''),
+                 'year': a.get('year'),
+                 'pages': [a['page_start'], a['page_end']]
+                 if a.get('page_start') else None,
+                 'similarity': a['similarity']}
+                for a in chunk['aliases']
+            ]
+        if 'shard' in chunk:
+            results[-1]['shard'] = chunk['shard']
+    return results
+
+
+def encode_queries_cached(queries: List[str], model, cache,
+                          batch_size: int = QUERY_BATCH_SIZE) -> 'np.ndarray':
+    """encode_queries() that serves repeated queries from *cache*."""
+    import numpy as np
+
+    vectors = [cache.get_embedding(q) for q in queries]
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if missing:
+        encoded = encode_queries([queries[i] for i in missing], model,
+                                 batch_size)
+        for i, vector in zip(missing, encoded):
+            cache.put_embedding(queries[i], vector)
+            vectors[i] = vector
+    return np.stack(vectors)
+
+
+# ── Metadata filters ──
+
+def parse_year_range(text: str) -> Tuple[Optional[int], Optional[int]]:
+    """``2019``, ``2015-2025``, ``2015-`` or ``-2010`` as an inclusive range."""
+    lo, sep, hi = text.partition('-')
+    if not sep:
+        return int(lo), int(lo)
+    return (int(lo) if lo else None), (int(hi) if hi else None)
+
+
+def filter_key(filters: Optional[Dict]) -> str:
+    """Canonical string for *filters* ('' when unfiltered)."""
+    if not filters:
+        return ''
+    return json.dumps({f: sorted(v) if f != 'year' else list(v)
+                       for f, v in filters.items() if v}, sort_keys=True)
+
+
+def match_chunks(chunks, filters: Dict) -> 'np.ndarray':
+    """Row mask for *filters*, from the chunk store's precomputed ranges and
+    bitmaps, or by scanning parsed chunks.jsonl rows."""
+    import numpy as np
+    from chunk_store import matches_doc
+
+    if hasattr(chunks, 'match'):
+        return chunks.match(filters)
+    sections = {s.lower() for s in filters.get('section') or ()}
+    return np.fromiter((
+        matches_doc(c, filters)
+        and (not sections or c.get('section', '').lower() in sections)
+        for c in chunks
+    ), dtype=bool, count=len(chunks))
+
+
+class Selection:
+    """FAISS search parameters restricting a search to filtered rows.
+
+    The row mask is translated to the chunk uids the index returns (an
+    IndexIDMap2 tests its selector against uids). Carries the index's own
+    nprobe / efSearch, since per-call parameters replace them.
+    """
+
+    def __init__(self, index, mask: 'np.ndarray', chunks=None):
+        import numpy as np
+        import faiss
+
+        self.count = int(mask.sum())
+        if hasattr(chunks, 'uid_mask'):
+            mask = chunks.uid_mask(mask)
+        self.bits = np.packbits(mask, bitorder='little')
+        self.selector = faiss.IDSelectorBitmap(len(self.bits),
+                                               faiss.swig_ptr(self.bits))
+        base = faiss.downcast_index(index.index) \
+            if hasattr(index, 'id_map') else index
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            self.params = faiss.SearchParametersIVF(sel=self.selector,
+                                                    nprobe=ivf.nprobe)
+        elif hasattr(base, 'hnsw'):
+            self.params = faiss.SearchParametersHNSW(
+                sel=self.selector, efSearch=base.hnsw.efSearch)
+        else:
+            self.params = faiss.SearchParameters(sel=self.selector)
+
+
+_selections: Dict[str, Selection] = {}
+
+
+def has_tombstones(chunks) -> bool:
+    """Whether *chunks* has removed chunks still present in the index."""
+    return bool(len(getattr(chunks, 'tombstones', ())))
+
+
+def select(index, chunks, filters: Optional[Dict]) -> Optional[Selection]:
+    """Selection for *filters*, reused across queries with the same filters.
+
+    Without filters, a selection is still needed to skip chunks removed by
+    update_index.py that have not been compacted away yet.
+    """
+    key = filter_key(filters)
+    if not key and not has_tombstones(chunks):
+        return None
+    selection = _selections.get(key)
+    if selection is None:
+        if len(_selections) >= 64:
+            _selections.clear()
+        if hasattr(index, 'select'):
+            selection = index.select(filters or {}, key)
+        else:
+            selection = Selection(index, match_chunks(chunks, filters or {}),
+                                  chunks)
+        _selections[key] = selection
+    return selection
+
+
+# ── Per-document search ──
+
+def open_doc_index(index_path: Path, index):
+    """DocIndex (doc_index.py) of the build that holds *index_path*."""
+    from doc_index import DocIndex
+
+    return DocIndex.open(index_path.parent, index)
+
 
+def search_documents(query_vecs: 'np.ndarray', doc_index, chunks,
+                     top_k: int, candidates: Optional[int] = None,
+                     filters: Optional[Dict] = None) -> List[Tuple]:
+    """Two-stage per-document search: ``(scores, uids)`` per query, the
+    best chunk of each of the top-k distinct documents.
+
+    The *candidates* documents whose pooled vectors score highest are
+    re-scored chunk by chunk (default: doc_index.DOC_CANDIDATES); *filters*
+    and tombstones apply to the chunks.
+    """
+    from doc_index import DOC_CANDIDATES
+
+    mask = None
+    if filter_key(filters) or has_tombstones(chunks):
+        mask = match_chunks(chunks, filters or {})
+    uid = getattr(chunks, 'uid', int)
+    return [([score for score, _ in hits], [uid(row) for _, row in hits])
+            for hits in doc_index.search(query_vecs, top_k,
+                                         candidates or DOC_CANDIDATES, mask)]
+
+
+def search_batch(queries: List[str], index, chunks: List[Dict], model,
+                 top_k: int = 5, batch_size: int = QUERY_BATCH_SIZE,
+                 cache=None, filters: Optional[Dict] = None,
+                 doc_index=None, doc_candidates: Optional[int] = None,
+                 stages=None) -> List[List[Dict]]:
+    """Encode all *queries* and run a single FAISS search for the batch.
+
+    With a QueryCache, memoized result lists are returned as-is and only
+    the remaining queries are encoded (reusing cached vectors) and searched.
+    *filters* (``year``, ``doc_id``, ``filename``, ``section``; see
+    match_chunks) restrict the search itself through a FAISS ID selector,
+    so the top-k are the best *matching* chunks rather than a post-filtered
+    subset of the unfiltered top-k. With *doc_index*, results are the top-k
+    distinct documents instead (see search_documents). Encoding and search
+    are timed into *stages* when given.
+    """
+    from instrument import Stages
+
+    stages = stages if stages is not None else Stages()
+    scope = filter_key(filters)
+    if doc_index is not None:
+        scope = f"per_doc:{doc_candidates or ''}/{scope}"
+    if cache is None:
+        results = [None] * len(queries)
+    else:
+        results = [cache.get_results(q, top_k, scope) for q in queries]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if not missing:
+        return results
+
+    selection = None
+    if doc_index is None:
+        selection = select(index, chunks, filters)
+    if selection is not None and selection.count == 0:
+        return [r if r is not None else [] for r in results]
+
+    pending = [queries[i] for i in missing]
+    with stages.stage('encode', items=len(pending)):
+        if cache is None:
+            query_vecs = encode_queries(pending, model, batch_size)
+        else:
+            query_vecs = encode_queries_cached(pending, model, cache,
+                                               batch_size)
+    with stages.stage('search', items=len(pending)):
+        if doc_index is not None:
+            hits = search_documents(query_vecs, doc_index, chunks, top_k,
+                                    doc_candidates, filters)
+        else:
+            hits = list(zip(*index.search(
+                query_vecs, top_k,
+                params=selection.params if selection else None
+            )))
+    for i, (s, ids) in zip(missing, hits):
+        results[i] = assemble_results(s, ids, chunks)
+        if cache is not None:
+            cache.put_results(queries[i], top_k, results[i], scope)
     return results
 
 
+def search(query: str, index, chunks: List[Dict], model,
+           top_k: int = 5, cache=None,
+           filters: Optional[Dict] = None, doc_index=None,
+           doc_candidates: Optional[int] = None, stages=None) -> List[Dict]:
+    """Encode *query* and return the top-k matching chunks."""
+    return search_batch([query], index, chunks, model, top_k,
+                        cache=cache, filters=filters, doc_index=doc_index,
+                        doc_candidates=doc_candidates, stages=stages)[0]
+
+
+def run_queries_file(path: Path, index, chunks: List[Dict], model,
+                     top_k: int, batch_size: int,
+                     filters: Optional[Dict] = None, doc_index=None,
+                     doc_candidates: Optional[int] = None,
+                     cache=None, stages=None) -> Dict:
+    """Search every query in *path* at once and stream JSONL to stdout.
+
+    Queries run as one search_batch call, so with a QueryCache memoized
+    results are reused and only the remaining queries are encoded (from
+    cached vectors where possible) and searched.
+    """
+    from instrument import Stages
+
+    stages = stages if stages is not None else Stages()
+    queries = load_queries(path)
+    if not queries:
+        print(f"ERROR: no queries found in {path}", file=sys.stderr)
+        sys.exit(1)
+
+    started = time.perf_counter()
+    results = search_batch(queries, index, chunks, model, top_k, batch_size,
+                           cache, filters, doc_index, doc_candidates, stages)
+    with stages.stage('output', items=len(queries)):
+        for query, hits in zip(queries, results):
+            record = {'query': query, 'results': hits}
+            sys.stdout.write(json.dumps(record) + '\n')
+        sys.stdout.flush()
+    finished = time.perf_counter()
+
+    elapsed = finished - started
+    timed = stages.report()
+    return {
+        'queries': len(queries),
+        'encode_sec': round(timed.get('encode', {}).get('wall_s', 0.0), 3),
+        'search_sec': round(timed.get('search', {}).get('wall_s', 0.0), 3),
+        'total_sec': round(elapsed, 3),
+        'queries_per_sec': round(len(queries) / elapsed, 1) if elapsed else None,
+        'cache': cache.report() if cache is not None else None,
+    }
+
+
 def format_results(query: str, results: List[Dict]) -> str:
     """Format search results for terminal display."""
     lines = [
@@ -113,40 +603,209 @@ def format_results(query: str, results: List[Dict]) -> str:
         lines.append(f"\n{'=' * 60}")
         lines.append(f"[{r['rank']}]  Score: {r['score']}")
         lines.append(f"  Document : {r['doc_id']}")
+        if r.get('shard'):
+            lines.append(f"  Shard    : {r['shard']}")
         if r['title']:
             lines.append(f"  Title    : {r['title']}")
         if r['year']:
             lines.append(f"  Year     : {r['year']}")
         if r['section']:
             lines.append(f"  Section  : {r['section']}")
+        if r.get('pages'):
+            first, last = r['pages']
+            lines.append(f"  Pages    : {first}" if first == last
+                         else f"  Pages    : {first}-{last}")
+        for alias in r.get('also_in', []):
+            pages = f" (p. {alias['pages'][0]})" if alias['pages'] else ''
+            lines.append(f"  Also in  : {alias['doc_id']}{pages}")
         lines.append(f"\n  {r['snippet']}")
     lines.append("")
     return '\n'.join(lines)
 
 
+def format_related(doc_id: str, related: List[Dict]) -> str:
+    """Format a --related lookup for terminal display."""
+    lines = [f"\nRelated to: {doc_id}", f"Results: {len(related)}", ""]
+    for r in related:
+        year = f" ({r['year']})" if r.get('year') else ''
+        lines.append(f"[{r['rank']}]  Score: {r['score']}  {r['doc_id']}{year}")
+        if r.get('title'):
+            lines.append(f"     {r['title']}")
+    lines.append("")
+    return '\n'.join(lines)
+
+
+def show_related(index_path: Path, doc_id: str, top_k: int,
+                 as_json: bool = False):
+    """Print the documents related to *doc_id*; no model is loaded."""
+    from related import RELATED_DIRNAME, RelatedGraph
+
+    index_dir = index_path.parent
+    try:
+        graph = RelatedGraph(index_dir / RELATED_DIRNAME)
+        related = graph.related(doc_id, top_k)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    if not graph.is_current(index_dir):
+        print("WARNING: the index changed since the related-documents graph "
+              "was built; rerun related.py", file=sys.stderr)
+    if as_json:
+        print(json.dumps({'doc_id': doc_id, 'related': related}, indent=2))
+    else:
+        print(format_related(doc_id, related))
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Query a FAISS semantic search index.'
     )
     parser.add_argument('--index', required=True,
-                        help='Path to faiss.index file')
-    parser.add_argument('--chunks', required=True,
-                        help='Path to chunks.jsonl file')
+                        help='Path to faiss.index file, or a shard manifest '
+                             '(.json, see shards.py)')
+    parser.add_argument('--chunks',
+                        help='Path to chunks.jsonl file (a chunk_store/ '
+                             'next to it is used when present); not needed '
+                             'with a shard manifest')
     parser.add_argument('--query', '-q',
                         help='Search query (omit for interactive mode)')
+    parser.add_argument('--queries-file',
+                        help='Run every query in this file (one per line, '
+                             'JSONL or sample_queries.md) and emit JSONL')
+    parser.add_argument('--batch-size', type=int, default=QUERY_BATCH_SIZE,
+                        help='Query encoding batch size for --queries-file '
+                             f'(default: {QUERY_BATCH_SIZE})')
     parser.add_argument('--top-k', '-k', type=int, default=5,
                         help='Number of results (default: 5)')
     parser.add_argument('--json', action='store_true',
                         help='Output results as JSON')
+    parser.add_argument('--quantize', metavar='MODE',
+                        help='Encode queries with a quantized CPU model (int8)')
+    parser.add_argument('--quantize-check',
+                        help='Recall verdict from check_quantized.py (default: '
+                             'quantization_check.json next to the index)')
+    parser.add_argument('--year', type=parse_year_range,
+                        help='Only chunks from these years: 2019, 2015-2025, '
+                             '2015- or -2010')
+    parser.add_argument('--doc-id', action='append',
+                        help='Only chunks of this document (repeatable)')
+    parser.add_argument('--filename', action='append',
+                        help='Only chunks of this PDF filename (repeatable)')
+    parser.add_argument('--section', action='append',
+                        help='Only chunks from this section, e.g. Results '
+                             '(repeatable, case-insensitive)')
+    parser.add_argument('--per-doc', action='store_true',
+                        help='Return the best chunk of each of the top-k '
+                             'distinct documents')
+    parser.add_argument('--doc-candidates', type=int, default=None,
+                        help='Documents scored chunk by chunk per --per-doc '
+                             'query (default: 100)')
+    parser.add_argument('--related', metavar='DOC_ID',
+                        help='List the top-k documents related to this one '
+                             '(needs a graph built by related.py)')
+    parser.add_argument('--nprobe', type=int,
+                        help='IVF lists to probe (default: as built)')
+    parser.add_argument('--ef-search', type=int,
+                        help='HNSW search breadth (default: as built)')
+    parser.add_argument('--max-shard-memory', type=float, metavar='MB',
+                        help='With a shard manifest, keep at most this many '
+                             'MB of shards loaded (default: no limit)')
+    parser.add_argument('--cache-dir',
+                        help='Persist the query-vector and result caches here')
+    parser.add_argument('--cache-size', type=int, default=None,
+                        help='Entries kept per cache (default: 4096)')
+    parser.add_argument('--warmup', action='store_true',
+                        help='Encode a dummy query while the index loads')
+    parser.add_argument('--startup-times', action='store_true',
+                        help='Print a per-phase startup time breakdown, and '
+                             'per-stage times on exit')
+    parser.add_argument('--profile', metavar='DIR',
+                        help='Write a cProfile dump and summary of each '
+                             'stage (load, encode, search) to this directory')
     args = parser.parse_args()
+    if args.related:
+        if Path(args.index).suffix == '.json':
+            parser.error("--related reads a single build, not a shard manifest")
+        show_related(Path(args.index), args.related, args.top_k, args.json)
+        return
+    if Path(args.index).suffix != '.json' and not args.chunks:
+        parser.error("--chunks is required unless --index is a shard manifest")
+    if args.per_doc and Path(args.index).suffix == '.json':
+        parser.error("--per-doc searches a single build, not a shard manifest")
 
-    index, chunks = load_index(Path(args.index), Path(args.chunks))
-    model = load_model()
+    if args.quantize:
+        from encoders import (QUANTIZE_MODES, model_label,
+                              require_quantization_check)
+
+        if args.quantize not in QUANTIZE_MODES:
+            parser.error(f"--quantize must be one of {', '.join(QUANTIZE_MODES)}")
+        check_path = args.quantize_check or \
+            Path(args.index).parent / "quantization_check.json"
+        try:
+            require_quantization_check(check_path, args.quantize, 'query',
+                                       model_label('e5'))
+        except RuntimeError as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    from instrument import Stages
+
+    stages = Stages(Path(args.profile) if args.profile else None)
+    try:
+        index, chunks, model, timings = load_all(
+            Path(args.index), args.chunks and Path(args.chunks),
+            args.quantize, args.warmup,
+            args.max_shard_memory and int(args.max_shard_memory * 1e6),
+            stages,
+        )
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    if args.startup_times and not args.query:
+        print(format_timings(timings), file=sys.stderr)
+    try:
+        settings = configure_search(index, args.nprobe, args.ef_search)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    doc_index = None
+    if args.per_doc:
+        try:
+            with stages.stage('load_doc_index', thread_cpu=True):
+                doc_index = open_doc_index(Path(args.index), index)
+        except ValueError as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            sys.exit(1)
+    cache = open_query_cache(Path(args.index), args.quantize, args.cache_dir,
+                             args.cache_size, settings, index)
+    filters = {'year': args.year, 'doc_id': args.doc_id,
+               'filename': args.filename, 'section': args.section}
+    per_doc = {'doc_index': doc_index, 'doc_candidates': args.doc_candidates,
+               'stages': stages}
 
-    if args.query:
-        results = search(args.query, index, chunks, model, args.top_k)
+    if args.queries_file:
+        throughput = run_queries_file(Path(args.queries_file), index, chunks,
+                                      model, args.top_k, args.batch_size,
+                                      filters, cache=cache, **per_doc)
+        print(f"{throughput['queries']} queries in {throughput['total_sec']}s "
+              f"(encode {throughput['encode_sec']}s, search "
+              f"{throughput['search_sec']}s): "
+              f"{throughput['queries_per_sec']} queries/sec", file=sys.stderr)
+        counters = throughput['cache']
+        print(f"Cache: {counters['result_hits']} result hits, "
+              f"{counters['embedding_hits']} vector hits, "
+              f"{counters['embedding_misses']} encoded", file=sys.stderr)
+    elif args.query:
+        started = time.perf_counter()
+        results = search(args.query, index, chunks, model, args.top_k, cache,
+                         filters, **per_doc)
+        if args.startup_times:
+            timings['first_query'] = round(time.perf_counter() - started, 3)
+            print(format_timings(timings), file=sys.stderr)
         if args.json:
-            print(json.dumps(results, indent=2))
+            print(json.dumps({'query': args.query, 'results': results,
+                              'cache': cache.report(),
+                              'stages': stages.report()}, indent=2))
         else:
             print(format_results(args.query, results))
     else:
@@ -158,14 +817,22 @@ def main():
                 query = input("Query: ").strip()
                 if not query:
                     continue
-                results = search(query, index, chunks, model, args.top_k)
+                results = search(query, index, chunks, model, args.top_k,
+                                 cache, filters, **per_doc)
                 if args.json:
-                    print(json.dumps(results, indent=2))
+                    print(json.dumps({'query': query, 'results': results,
+                                      'cache': cache.report(),
+                                      'stages': stages.report()}, indent=2))
                 else:
                     print(format_results(query, results))
             except (KeyboardInterrupt, EOFError):
                 print("\nExiting.")
                 break
+    cache.save()
+    if args.startup_times:
+        print("Stages:\n" + stages.format(), file=sys.stderr)
+    for name, path in stages.write_profiles().items():
+        print(f"Profile of {name}: {path}", file=sys.stderr)
 
 
 if __name__ == '__main__':
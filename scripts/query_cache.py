@@ -0,0 +1,166 @@
+"""
+Query Embedding and Result Cache
+
+LRU caches used by query.py and serve.py so repeated queries (dashboards,
+saved searches) skip the encoder and, when the index is unchanged, the
+FAISS search as well.
+
+    embeddings   (model, normalized query)              -> float32 vector
+    results      (index fingerprint, normalized query, k, filters)
+                                                        -> result list
+
+Queries are normalized by collapsing whitespace. The index fingerprint
+comes from ``index_report.json`` (``index_fingerprint``), so every rebuild
+invalidates memoized results automatically, while query vectors stay valid
+for as long as the model does.
+
+With a cache directory the caches persist between runs:
+    embeddings.npz    float32 vectors with the model and query of each row
+    results.json      memoized results for the fingerprint they were made for
+"""
+
+import os
+import json
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+QUERY_CACHE_ENTRIES = 4096
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(query.split())
+
+
+def index_fingerprint(index_path: Path) -> str:
+    """Fingerprint of the index build, from index_report.json if present.
+
+    Indexes built before the report carried a fingerprint fall back to the
+    size and modification time of the index file.
+    """
+    report_path = index_path.parent / "index_report.json"
+    if report_path.exists():
+        with open(report_path) as f:
+            fingerprint = json.load(f).get('index_fingerprint')
+        if fingerprint:
+            return fingerprint
+    st = index_path.stat()
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+class QueryCache:
+    """LRU query-vector cache and top-k result memo."""
+
+    def __init__(self, model_name: str, fingerprint: str,
+                 max_entries: int = QUERY_CACHE_ENTRIES,
+                 cache_dir: Optional[Path] = None):
+        self.model_name = model_name
+        self.fingerprint = fingerprint
+        self.max_entries = max_entries
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.embeddings: OrderedDict = OrderedDict()
+        self.results: OrderedDict = OrderedDict()
+        self.stats = {'embedding_hits': 0, 'embedding_misses': 0,
+                      'result_hits': 0, 'result_misses': 0}
+        if self.cache_dir is not None:
+            self._load()
+
+    # ── Lookups ──
+
+    def get_results(self, query: str, top_k: int,
+                    scope: str = '') -> Optional[List[Dict]]:
+        """Memoized results; *scope* distinguishes e.g. filtered searches."""
+        key = (normalize_query(query), top_k, scope)
+        results = self.results.get(key)
+        if results is None:
+            self.stats['result_misses'] += 1
+            return None
+        self.results.move_to_end(key)
+        self.stats['result_hits'] += 1
+        return results
+
+    def put_results(self, query: str, top_k: int, results: List[Dict],
+                    scope: str = ''):
+        self._put(self.results, (normalize_query(query), top_k, scope),
+                  results)
+
+    def get_embedding(self, query: str) -> Optional[np.ndarray]:
+        key = (self.model_name, normalize_query(query))
+        vector = self.embeddings.get(key)
+        if vector is None:
+            self.stats['embedding_misses'] += 1
+            return None
+        self.embeddings.move_to_end(key)
+        self.stats['embedding_hits'] += 1
+        return vector
+
+    def put_embedding(self, query: str, vector: np.ndarray):
+        self._put(self.embeddings, (self.model_name, normalize_query(query)),
+                  np.asarray(vector, dtype=np.float32))
+
+    def _put(self, entries: OrderedDict, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.max_entries:
+            entries.popitem(last=False)
+
+    def report(self) -> Dict:
+        lookups = self.stats['embedding_hits'] + self.stats['embedding_misses']
+        return {
+            **self.stats,
+            'embedding_entries': len(self.embeddings),
+            'result_entries': len(self.results),
+            'embedding_hit_rate': round(self.stats['embedding_hits'] / lookups,
+                                        4) if lookups else None,
+        }
+
+    # ── Persistence ──
+
+    def _load(self):
+        embeddings_path = self.cache_dir / "embeddings.npz"
+        if embeddings_path.exists():
+            with np.load(embeddings_path) as saved:
+                for model, query, vector in zip(saved['models'],
+                                                saved['queries'],
+                                                saved['vectors']):
+                    self.embeddings[(str(model), str(query))] = vector
+
+        results_path = self.cache_dir / "results.json"
+        if results_path.exists():
+            with open(results_path) as f:
+                memo = json.load(f)
+            if memo.get('fingerprint') == self.fingerprint:
+                for query, top_k, scope, results in memo['entries']:
+                    self.results[(query, top_k, scope)] = results
+
+    def _replace(self, name: str, write):
+        path = self.cache_dir / name
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'wb') as f:
+            write(f)
+        os.replace(tmp, path)
+
+    def save(self):
+        """Write both caches to the cache directory, if one is configured."""
+        if self.cache_dir is None:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        keys = list(self.embeddings)
+        self._replace("embeddings.npz", lambda f: np.savez(
+            f,
+            models=np.array([model for model, _ in keys], dtype=str),
+            queries=np.array([query for _, query in keys], dtype=str),
+            vectors=np.array(list(self.embeddings.values()),
+                             dtype=np.float32),
+        ))
+        memo = {
+            'fingerprint': self.fingerprint,
+            'entries': [[q, k, scope, r]
+                        for (q, k, scope), r in self.results.items()],
+        }
+        self._replace("results.json",
+                      lambda f: f.write(json.dumps(memo).encode()))
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Related-Documents Graph
+
+Builds a "papers similar to this one" graph for a build_index.py output
+directory in one batched pass, instead of one search() per chunk, and
+serves lookups from it (query.py --related DOC_ID).
+
+    1. chunk kNN: every chunk's --k nearest chunks of *other* documents,
+       by cosine similarity, computed as blocked matrix multiplies over the
+       memory-mapped embeddings.npy. Query blocks of --block_size rows are
+       spread over --workers threads (numpy releases the GIL in BLAS);
+       each keeps a running top-k while it streams the column tiles, so
+       memory is about --workers x (2 tiles + one score tile) plus the
+       n x k result, whatever the corpus size.
+    2. doc graph: chunk neighbours are aggregated per document pair. A
+       document A's coverage by B is the mean, over A's chunks, of the
+       best similarity to a chunk of B among that chunk's neighbours (0
+       if none). The score of (A, B) is the mean of both directions'
+       coverage, and each document keeps its --doc_k best partners.
+
+Tombstoned chunks (update_index.py remove) take no part. The graph is
+written in CSR form to ``related/`` in the build directory:
+
+    indptr.npy    int64, document i's neighbours are entries
+                  indptr[i]:indptr[i + 1]
+    indices.npy   int32 neighbour positions in docs.json, best first
+    scores.npy    float32 scores of those neighbours
+    docs.json     doc_id, title and year per position, the build's
+                  index_fingerprint and the parameters used
+
+A lookup reads docs.json and two slices of the memory-mapped arrays. The
+graph is not updated in place: after update_index.py changes the build,
+lookups warn until it is rebuilt.
+
+Usage:
+    python related.py --index_dir ./index
+    python related.py --index_dir ./index --k 30 --doc_k 50 --workers 16
+    python query.py --index ./index/faiss.index --chunks ./index/chunks.jsonl \
+                    --related labor_market_dynamics_2023
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from chunk_store import STORE_DIRNAME, ChunkStore, replace_store
+
+
+RELATED_DIRNAME = "related"
+RELATED_VERSION = 1
+CHUNK_K = 20            # nearest chunks of other documents per chunk
+DOC_K = 20              # related documents kept per document
+BLOCK_SIZE = 4096       # rows per query block and column tile
+TOP_K_GROUP = 32        # columns per group when selecting a tile's top-k
+
+
+def _unit(vectors) -> np.ndarray:
+    """float32 copy of *vectors* with L2-normalised rows."""
+    block = np.array(vectors, dtype=np.float32)
+    norms = np.linalg.norm(block, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return block / norms
+
+
+# ── Chunk kNN ────────────────────────────────────────────────────────────────
+
+def _tile_top_k(sims: np.ndarray, k: int,
+                group: int = TOP_K_GROUP) -> Tuple[np.ndarray, np.ndarray]:
+    """``(scores, columns)`` of the *k* largest entries of each row.
+
+    A row's top k always lie in the k column groups with the highest
+    maxima, so only those k * *group* candidates are partitioned; this is
+    several times cheaper than partitioning whole tile rows.
+    """
+    n, width = sims.shape
+    if width <= k * group:
+        top = np.argpartition(sims, -min(k, width), axis=1)[:, -min(k, width):]
+        return np.take_along_axis(sims, top, axis=1), top
+    if width % group:
+        sims = np.hstack([sims, np.full((n, -width % group), -np.inf,
+                                        dtype=sims.dtype)])
+    maxima = sims.reshape(n, -1, group).max(axis=2)
+    groups = np.argpartition(maxima, -k, axis=1)[:, -k:]
+    cols = (groups[:, :, None] * group + np.arange(group)).reshape(n, -1)
+    candidates = np.take_along_axis(sims, cols, axis=1)
+    top = np.argpartition(candidates, -k, axis=1)[:, -k:]
+    return (np.take_along_axis(candidates, top, axis=1),
+            np.take_along_axis(cols, top, axis=1))
+
+
+def chunk_knn(vectors, row_doc: np.ndarray, live: np.ndarray, k: int,
+              block_size: int = BLOCK_SIZE,
+              workers: int = 1) -> Tuple[np.ndarray, np.ndarray]:
+    """Each row's *k* most similar live rows of another document.
+
+    *row_doc* gives each row's document; rows outside *live* neither get
+    nor appear as neighbours. Returns ``(ids, scores)``, both ``(n, k)``,
+    ids -1 (score -inf) where fewer than *k* exist.
+    """
+    n = len(vectors)
+    k = max(min(k, n - 1), 1)
+    ids = np.full((n, k), -1, dtype=np.int64)
+    scores = np.full((n, k), -np.inf, dtype=np.float32)
+
+    def _query_block(start: int):
+        stop = min(start + block_size, n)
+        queries = _unit(vectors[start:stop])
+        best_scores = scores[start:stop]
+        best_ids = ids[start:stop]
+        for col in range(0, n, block_size):
+            tile = _unit(vectors[col:col + block_size])
+            sims = queries @ tile.T
+            sims[row_doc[start:stop, None] ==
+                 row_doc[None, col:col + len(tile)]] = -np.inf
+            sims[:, ~live[col:col + len(tile)]] = -np.inf
+            tile_scores, tile_cols = _tile_top_k(sims, k)
+            merged = np.hstack([best_scores, tile_scores])
+            merged_ids = np.hstack([best_ids, tile_cols + col])
+            top = np.argpartition(merged, -k, axis=1)[:, -k:]
+            best_scores = np.take_along_axis(merged, top, axis=1)
+            best_ids = np.take_along_axis(merged_ids, top, axis=1)
+        best_ids[~np.isfinite(best_scores)] = -1
+        scores[start:stop] = best_scores
+        ids[start:stop] = best_ids
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        list(pool.map(_query_block, range(0, n, block_size)))
+    ids[~live] = -1
+    scores[~live] = -np.inf
+    return ids, scores
+
+
+# ── Document graph ───────────────────────────────────────────────────────────
+
+def doc_graph(ids: np.ndarray, scores: np.ndarray, row_doc: np.ndarray,
+              live: np.ndarray, n_docs: int,
+              doc_k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Aggregate chunk neighbours into a CSR document graph.
+
+    Returns ``(indptr, indices, scores)`` over *n_docs* documents, each
+    row sorted by descending score and cut to *doc_k* entries.
+    """
+    rows = np.repeat(np.arange(len(ids)), ids.shape[1])
+    neighbours = ids.ravel()
+    sims = scores.ravel()
+    valid = neighbours >= 0
+    rows, neighbours, sims = rows[valid], neighbours[valid], sims[valid]
+    other = row_doc[neighbours].astype(np.int64)
+
+    # Best similarity from each chunk to each neighbouring document
+    order = np.lexsort((-sims, other, rows))
+    rows, other, sims = rows[order], other[order], sims[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (other[1:] != other[:-1])
+    rows, other, sims = rows[first], other[first], sims[first]
+
+    # Coverage of A by B, averaged over A's live chunks
+    source = row_doc[rows].astype(np.int64)
+    chunks_per_doc = np.bincount(row_doc[live], minlength=n_docs)
+    pairs, inverse = np.unique(source * n_docs + other, return_inverse=True)
+    coverage = np.bincount(inverse, weights=sims).astype(np.float32) / \
+        chunks_per_doc[pairs // n_docs]
+
+    # Symmetric score: mean of both directions
+    a, b = pairs // n_docs, pairs % n_docs
+    both, inverse = np.unique(np.concatenate([a * n_docs + b, b * n_docs + a]),
+                              return_inverse=True)
+    pair_scores = (np.bincount(inverse, weights=np.concatenate(
+        [coverage, coverage])) / 2).astype(np.float32)
+    a, b = both // n_docs, both % n_docs
+
+    order = np.lexsort((-pair_scores, a))
+    a, b, pair_scores = a[order], b[order], pair_scores[order]
+    counts = np.bincount(a, minlength=n_docs)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.arange(len(a)) - starts[a]
+    keep = rank < doc_k
+    a, b, pair_scores = a[keep], b[keep], pair_scores[keep]
+    indptr = np.zeros(n_docs + 1, dtype=np.int64)
+    np.cumsum(np.bincount(a, minlength=n_docs), out=indptr[1:])
+    return indptr, b.astype(np.int32), pair_scores
+
+
+# ── Build ────────────────────────────────────────────────────────────────────
+
+def build_related(index_dir: Path, k: int = CHUNK_K, doc_k: int = DOC_K,
+                  block_size: int = BLOCK_SIZE, workers: int = 1) -> Dict:
+    """Compute the related-documents graph of a build and write it.
+
+    The timings and graph size are also recorded under ``related`` in the
+    build's index_report.json.
+    """
+    started = time.time()
+    embeddings_path = index_dir / "embeddings.npy"
+    if not embeddings_path.exists():
+        raise ValueError(f"{index_dir} has no embeddings.npy (single-copy "
+                         f"builds keep vectors only in the index)")
+    vectors = np.load(embeddings_path, mmap_mode='r')
+    store = ChunkStore(index_dir / STORE_DIRNAME)
+    try:
+        if len(store) != len(vectors):
+            raise ValueError(f"embeddings.npy has {len(vectors)} rows but the "
+                             f"chunk store has {len(store)}")
+        row_doc = np.asarray(store.columns['doc'])
+        live = store.live_mask()
+        docs = [{'doc_id': d['doc_id'], 'title': d['title'],
+                 'year': d['year']} for d in store.docs]
+    finally:
+        store.close()
+    report_path = index_dir / "index_report.json"
+    with open(report_path) as f:
+        report = json.load(f)
+    fingerprint = report.get('index_fingerprint')
+
+    print(f"Chunk kNN: {int(live.sum())} chunks, k={k}, "
+          f"{block_size}-row tiles on {workers} threads ...")
+    ids, scores = chunk_knn(vectors, row_doc, live, k, block_size, workers)
+    knn_sec = time.time() - started
+    indptr, indices, doc_scores = doc_graph(ids, scores, row_doc, live,
+                                            len(docs), doc_k)
+
+    out = index_dir / RELATED_DIRNAME
+    tmp = out.with_name(out.name + '.tmp')
+    tmp.mkdir(parents=True, exist_ok=True)
+    np.save(tmp / "indptr.npy", indptr)
+    np.save(tmp / "indices.npy", indices)
+    np.save(tmp / "scores.npy", doc_scores)
+    params = {'k': k, 'doc_k': doc_k, 'block_size': block_size}
+    with open(tmp / "docs.json", 'w') as f:
+        json.dump({'version': RELATED_VERSION, 'index_fingerprint': fingerprint,
+                   'params': params, 'docs': docs}, f)
+    replace_store(tmp, out)
+
+    elapsed = time.time() - started
+    result = {
+        'chunks': int(live.sum()),
+        'documents': int(np.count_nonzero(np.diff(indptr))),
+        'edges': int(len(indices)),
+        **params,
+        'workers': workers,
+        'knn_sec': round(knn_sec, 2),
+        'total_sec': round(elapsed, 2),
+        'chunks_per_sec': round(int(live.sum()) / knn_sec, 1)
+                          if knn_sec else None,
+    }
+    report['related'] = {'index_fingerprint': fingerprint, **result}
+    tmp_report = report_path.with_name(report_path.name + '.tmp')
+    with open(tmp_report, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmp_report, report_path)
+    return result
+
+
+# ── Lookup ───────────────────────────────────────────────────────────────────
+
+class RelatedGraph:
+    """Memory-mapped view of a related/ directory."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        if not (self.path / "docs.json").exists():
+            raise ValueError(f"no related-documents graph in {self.path.parent};"
+                             f" build one with related.py")
+        with open(self.path / "docs.json") as f:
+            meta = json.load(f)
+        if meta.get('version') != RELATED_VERSION:
+            raise ValueError(f"{self.path}: unsupported graph version "
+                             f"{meta.get('version')}")
+        self.fingerprint = meta['index_fingerprint']
+        self.params = meta['params']
+        self.docs = meta['docs']
+        self._positions = {d['doc_id']: i for i, d in enumerate(self.docs)}
+        self.indptr = np.load(self.path / "indptr.npy", mmap_mode='r')
+        self.indices = np.load(self.path / "indices.npy", mmap_mode='r')
+        self.scores = np.load(self.path / "scores.npy", mmap_mode='r')
+
+    def is_current(self, index_dir: Path) -> bool:
+        """Whether the build has not changed since the graph was computed."""
+        with open(Path(index_dir) / "index_report.json") as f:
+            return json.load(f).get('index_fingerprint') == self.fingerprint
+
+    def related(self, doc_id: str, top_k: int = 5) -> List[Dict]:
+        """The *top_k* documents most related to *doc_id*, best first."""
+        position = self._positions.get(doc_id)
+        if position is None:
+            raise ValueError(f"{doc_id} is not in the related-documents graph")
+        lo, hi = int(self.indptr[position]), int(self.indptr[position + 1])
+        hi = min(hi, lo + top_k)
+        return [{'rank': rank, 'score': round(float(score), 4),
+                 **self.docs[int(other)]}
+                for rank, (other, score) in enumerate(
+                    zip(self.indices[lo:hi], self.scores[lo:hi]), start=1)]
+
+
+# ── CLI ──────────────────────────────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the related-documents graph of a built index.'
+    )
+    parser.add_argument('--index_dir', required=True,
+                        help='build_index.py output directory')
+    parser.add_argument('--k', type=int, default=CHUNK_K,
+                        help='Nearest chunks of other documents per chunk '
+                             f'(default: {CHUNK_K})')
+    parser.add_argument('--doc_k', type=int, default=DOC_K,
+                        help='Related documents kept per document '
+                             f'(default: {DOC_K})')
+    parser.add_argument('--block_size', type=int, default=BLOCK_SIZE,
+                        help=f'Rows per matrix-multiply tile '
+                             f'(default: {BLOCK_SIZE})')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Threads computing query blocks '
+                             '(default: all cores)')
+    args = parser.parse_args()
+
+    index_dir = Path(args.index_dir)
+    try:
+        result = build_related(index_dir, args.k, args.doc_k,
+                               args.block_size, args.workers)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Related documents: {result['documents']} documents, "
+          f"{result['edges']} edges in {result['total_sec']}s "
+          f"({result['chunks_per_sec']} chunks/sec)")
+    print(f"Saved: {index_dir / RELATED_DIRNAME}/")
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+"""
+Semantic Search Query Server
+
+Long-lived HTTP front end for a FAISS index built by build_index.py. The
+index, chunks and e5-large-v2 are loaded once; concurrent requests are
+collected into micro-batches (up to --max-batch queries or --batch-window-ms
+after the first one arrives), encoded together and answered with a single
+batched FAISS search.
+
+Endpoints:
+    POST /search    {"query": "...", "top_k": 5}  ->  {"query", "results"}
+                    optional "filters": {"year": "2015-2025" or [lo, hi],
+                    "doc_id" / "filename" / "section": [...]}
+    GET  /metrics   request counts, latency percentiles, batch-size histogram
+    GET  /health    {"status": "ok", "chunks": N}
+
+The server binds to 127.0.0.1 by default and has no authentication; put a
+reverse proxy in front of it before exposing it beyond the local host.
+
+Usage:
+    python serve.py --index ./index/faiss.index --chunks ./index/chunks.jsonl
+
+    curl -s localhost:8765/search -d '{"query": "minimum wage effects"}'
+    curl -s localhost:8765/metrics
+
+    # Serve several build outputs as one index (see shards.py)
+    python serve.py --index ./shards.json --max-shard-memory 4000
+
+    # Drive it with concurrent clients
+    python load_test.py --queries-file ../demo/sample_queries.md \
+        --concurrency 16 --requests 500
+"""
+
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+from collections import Counter, deque
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from encoders import QUANTIZE_MODES, model_label, require_quantization_check
+from query import (
+    QUERY_BATCH_SIZE, load_all, format_timings, configure_search,
+    open_query_cache, parse_year_range, filter_key, select,
+    encode_queries_cached, assemble_results,
+)
+
+
+# ── Invariants ───────────────────────────────────────────────────────────────
+
+DEFAULT_PORT = 8765
+MAX_BATCH = 32              # queries per micro-batch
+BATCH_WINDOW_MS = 5.0       # how long the first query waits for company
+MAX_TOP_K = 100
+MAX_BODY_BYTES = 64 * 1024
+LATENCY_WINDOW = 10000      # recent requests kept for percentiles
+
+
+# ── Metrics ──────────────────────────────────────────────────────────────────
+
+class Metrics:
+    """Request counters, recent latencies and the batch-size histogram."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batch_sizes: Counter = Counter()
+        self.latencies_ms: deque = deque(maxlen=LATENCY_WINDOW)
+        self.batch_ms: deque = deque(maxlen=LATENCY_WINDOW)
+
+    def record_batch(self, size: int, elapsed_ms: float):
+        self.batches += 1
+        self.batch_sizes[size] += 1
+        self.batch_ms.append(elapsed_ms)
+
+    def record_request(self, elapsed_ms: float, ok: bool = True):
+        self.requests += 1
+        if ok:
+            self.latencies_ms.append(elapsed_ms)
+        else:
+            self.errors += 1
+
+    @staticmethod
+    def _percentiles(values) -> Optional[Dict]:
+        if not values:
+            return None
+        p50, p90, p99 = np.percentile(np.fromiter(values, float), [50, 90, 99])
+        return {'p50': round(float(p50), 2), 'p90': round(float(p90), 2),
+                'p99': round(float(p99), 2), 'max': round(max(values), 2)}
+
+    def report(self) -> Dict:
+        uptime = time.time() - self.started
+        return {
+            'uptime_sec': round(uptime, 1),
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'mean_batch_size': round(sum(k * v for k, v
+                                         in self.batch_sizes.items())
+                                     / self.batches, 2)
+            if self.batches else None,
+            'batch_size_histogram': {str(k): v for k, v
+                                     in sorted(self.batch_sizes.items())},
+            'latency_ms': self._percentiles(self.latencies_ms),
+            'batch_ms': self._percentiles(self.batch_ms),
+        }
+
+
+# ── Micro-batching ───────────────────────────────────────────────────────────
+
+class MicroBatcher:
+    """Collect concurrent queries and answer each batch with one search.
+
+    Encoding and FAISS run in a worker thread so the event loop keeps
+    accepting connections while a batch is in flight; batches themselves are
+    processed one at a time. Memoized results are answered straight from
+    *cache* on the event loop; query vectors are looked up on the batch
+    thread. Queries with different metadata filters share a batch but are
+    searched in one group per filter set.
+    """
+
+    def __init__(self, index, chunks, model, metrics: Metrics, cache,
+                 max_batch: int = MAX_BATCH,
+                 window_ms: float = BATCH_WINDOW_MS):
+        self.index = index
+        self.chunks = chunks
+        self.model = model
+        self.metrics = metrics
+        self.cache = cache
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.pending: asyncio.Queue = asyncio.Queue()
+
+    async def submit(self, query: str, top_k: int,
+                     filters: Optional[Dict] = None) -> List[Dict]:
+        results = self.cache.get_results(query, top_k, filter_key(filters))
+        if results is not None:
+            return results
+        future = asyncio.get_running_loop().create_future()
+        await self.pending.put((query, top_k, filters, future))
+        return await future
+
+    async def _collect(self) -> List[Tuple[str, int, Optional[Dict],
+                                           asyncio.Future]]:
+        batch = [await self.pending.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.pending.get(),
+                                                    remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _search(self, queries: List[str], top_k: int,
+                filters: Optional[Dict]):
+        """Scores and ids for *queries*, or None if no chunk matches."""
+        selection = select(self.index, self.chunks, filters)
+        if selection is not None and selection.count == 0:
+            return None
+        query_vecs = encode_queries_cached(queries, self.model, self.cache,
+                                           min(len(queries), QUERY_BATCH_SIZE))
+        return self.index.search(
+            query_vecs, top_k,
+            params=selection.params if selection else None
+        )
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            groups: Dict[str, List] = {}
+            for item in batch:
+                groups.setdefault(filter_key(item[2]), []).append(item)
+            started = time.perf_counter()
+            for scope, group in groups.items():
+                await self._run_group(loop, scope, group)
+            self.metrics.record_batch(len(batch),
+                                      1000 * (time.perf_counter() - started))
+
+    async def _run_group(self, loop, scope: str, group: List):
+        queries = [q for q, _, _, _ in group]
+        top_k = max(k for _, k, _, _ in group)
+        try:
+            found = await loop.run_in_executor(
+                None, self._search, queries, top_k, group[0][2]
+            )
+        except Exception as e:
+            for _, _, _, future in group:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for n, (query, k, _, future) in enumerate(group):
+            if found is None:
+                results = []
+            else:
+                scores, indices = found
+                results = assemble_results(scores[n][:k], indices[n][:k],
+                                           self.chunks)
+            self.cache.put_results(query, k, results, scope)
+            if not future.done():
+                future.set_result(results)
+
+
+# ── HTTP ─────────────────────────────────────────────────────────────────────
+
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large',
+               500: 'Internal Server Error'}
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """Parse one HTTP/1.1 request; returns (method, path, headers, body)."""
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+    except ValueError:
+        raise ValueError('malformed request line')
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get('content-length', 0))
+    if length > MAX_BODY_BYTES:
+        raise OverflowError
+    body = await reader.readexactly(length) if length else b''
+    return method.upper(), target.split('?', 1)[0], headers, body
+
+
+def write_response(writer: asyncio.StreamWriter, status: int, payload: Dict,
+                   keep_alive: bool):
+    body = json.dumps(payload).encode()
+    writer.write(
+        f"HTTP/1.1 {status} {STATUS_TEXT[status]}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        f"\r\n".encode() + body
+    )
+
+
+def parse_filters(raw) -> Optional[Dict]:
+    """Validate the optional "filters" object of a search request."""
+    if raw is None:
+        return None
+    if not isinstance(raw, dict) or set(raw) - {'year', 'doc_id', 'filename',
+                                                 'section'}:
+        raise ValueError('"filters" may only have year, doc_id, filename '
+                         'and section')
+    filters = {}
+    year = raw.get('year')
+    try:
+        if isinstance(year, (str, int)) and not isinstance(year, bool):
+            filters['year'] = parse_year_range(str(year))
+        elif isinstance(year, list) and len(year) == 2 and all(
+                y is None or isinstance(y, int) for y in year):
+            filters['year'] = tuple(year)
+        elif year is not None:
+            raise ValueError
+    except ValueError:
+        raise ValueError('"year" must be "2019", "2015-2025" or [lo, hi]')
+    for field in ('doc_id', 'filename', 'section'):
+        values = raw.get(field)
+        if isinstance(values, str):
+            values = [values]
+        if values is not None and not (
+                isinstance(values, list)
+                and all(isinstance(v, str) for v in values)):
+            raise ValueError(f'"{field}" must be a string or list of strings')
+        filters[field] = values
+    return filters
+
+
+def parse_search(body: bytes,
+                 default_top_k: int) -> Tuple[str, int, Optional[Dict]]:
+    request = json.loads(body or b'{}')
+    query = request.get('query')
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError('"query" must be a non-empty string')
+    top_k = request.get('top_k', default_top_k)
+    if not isinstance(top_k, int) or not 1 <= top_k <= MAX_TOP_K:
+        raise ValueError(f'"top_k" must be an integer in 1..{MAX_TOP_K}')
+    return query.strip(), top_k, parse_filters(request.get('filters'))
+
+
+def make_handler(batcher: MicroBatcher, metrics: Metrics, n_chunks: int,
+                 default_top_k: int):
+    cache = batcher.cache
+
+    async def handle(reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except OverflowError:
+                    write_response(writer, 413, {'error': 'body too large'},
+                                   False)
+                    break
+                except (ValueError, asyncio.IncompleteReadError):
+                    write_response(writer, 400, {'error': 'bad request'},
+                                   False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+
+                if path == '/search':
+                    if method != 'POST':
+                        write_response(writer, 405, {'error': 'use POST'},
+                                       keep_alive)
+                    else:
+                        started = time.perf_counter()
+                        try:
+                            query, top_k, filters = parse_search(
+                                body, default_top_k)
+                        except ValueError as e:
+                            metrics.record_request(0, ok=False)
+                            write_response(writer, 400, {'error': str(e)},
+                                           keep_alive)
+                        else:
+                            try:
+                                results = await batcher.submit(query, top_k,
+                                                               filters)
+                            except Exception as e:
+                                metrics.record_request(0, ok=False)
+                                write_response(writer, 500,
+                                               {'error': str(e)}, keep_alive)
+                            else:
+                                metrics.record_request(
+                                    1000 * (time.perf_counter() - started)
+                                )
+                                write_response(writer, 200,
+                                               {'query': query,
+                                                'results': results},
+                                               keep_alive)
+                elif path == '/metrics':
+                    report = {**metrics.report(), 'cache': cache.report()}
+                    if hasattr(batcher.index, 'shards'):
+                        report['shards'] = batcher.index.report()
+                    write_response(writer, 200, report, keep_alive)
+                elif path == '/health':
+                    write_response(writer, 200,
+                                   {'status': 'ok', 'chunks': n_chunks},
+                                   keep_alive)
+                else:
+                    write_response(writer, 404, {'error': 'not found'},
+                                   keep_alive)
+
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(args, index, chunks, model, cache):
+    metrics = Metrics()
+    batcher = MicroBatcher(index, chunks, model, metrics, cache,
+                           args.max_batch, args.batch_window_ms)
+    batch_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(
+        make_handler(batcher, metrics, len(chunks), args.top_k),
+        args.host, args.port,
+    )
+    print(f"Serving {len(chunks)} chunks on http://{args.host}:{args.port} "
+          f"(micro-batches of up to {args.max_batch}, "
+          f"{args.batch_window_ms} ms window)", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a FAISS semantic search index over local HTTP.'
+    )
+    parser.add_argument('--index', required=True,
+                        help='Path to faiss.index file, or a shard manifest '
+                             '(.json, see shards.py)')
+    parser.add_argument('--chunks',
+                        help='Path to chunks.jsonl file (not needed with a '
+                             'shard manifest)')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Bind address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help=f'Port (default: {DEFAULT_PORT})')
+    parser.add_argument('--top-k', '-k', type=int, default=5,
+                        help='Default results per query (default: 5)')
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH,
+                        help=f'Queries per micro-batch (default: {MAX_BATCH})')
+    parser.add_argument('--batch-window-ms', type=float,
+                        default=BATCH_WINDOW_MS,
+                        help='Time to wait for more queries after the first '
+                             f'(default: {BATCH_WINDOW_MS})')
+    parser.add_argument('--nprobe', type=int,
+                        help='IVF lists to probe (default: as built)')
+    parser.add_argument('--ef-search', type=int,
+                        help='HNSW search breadth (default: as built)')
+    parser.add_argument('--max-shard-memory', type=float, metavar='MB',
+                        help='With a shard manifest, keep at most this many '
+                             'MB of shards loaded (default: no limit)')
+    parser.add_argument('--cache-dir',
+                        help='Persist the query-vector and result caches here '
+                             '(saved on shutdown)')
+    parser.add_argument('--cache-size', type=int, default=None,
+                        help='Entries kept per cache (default: 4096)')
+    parser.add_argument('--quantize', choices=QUANTIZE_MODES,
+                        help='Encode queries with a quantized CPU model')
+    parser.add_argument('--quantize-check',
+                        help='Recall verdict from check_quantized.py (default: '
+                             'quantization_check.json next to the index)')
+    args = parser.parse_args()
+    if Path(args.index).suffix != '.json' and not args.chunks:
+        parser.error("--chunks is required unless --index is a shard manifest")
+
+    if args.host not in ('127.0.0.1', 'localhost', '::1'):
+        print(f"WARNING: binding to {args.host}; the server has no "
+              f"authentication", file=sys.stderr)
+
+    if args.quantize:
+        check_path = args.quantize_check or \
+            Path(args.index).parent / "quantization_check.json"
+        try:
+            require_quantization_check(check_path, args.quantize, 'query',
+                                       model_label('e5'))
+        except RuntimeError as e:
+            print(f"ERROR: {e}", file=sys.stderr)
+            sys.exit(1)
+
+    try:
+        index, chunks, model, timings = load_all(
+            Path(args.index), args.chunks and Path(args.chunks),
+            args.quantize, warmup=True,
+            max_shard_bytes=args.max_shard_memory
+            and int(args.max_shard_memory * 1e6),
+        )
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(format_timings(timings), file=sys.stderr)
+    try:
+        settings = configure_search(index, args.nprobe, args.ef_search)
+    except ValueError as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    cache = open_query_cache(Path(args.index), args.quantize, args.cache_dir,
+                             args.cache_size, settings, index)
+
+    # Treat SIGTERM like Ctrl-C so the caches are saved on shutdown
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        asyncio.run(serve(args, index, chunks, model, cache))
+    except KeyboardInterrupt:
+        print("\nExiting.", file=sys.stderr)
+    finally:
+        cache.save()
+
+
+if __name__ == '__main__':
+    main()
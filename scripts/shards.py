@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Sharded Index Search
+
+Searches several build_index.py output directories (one per institution)
+as one index. A shard manifest lists the directories:
+
+    {"version": 1,
+     "shards": [{"name": "inst_a", "path": "inst_a_index"},
+                {"name": "inst_b", "path": "/data/inst_b_index"}]}
+
+Relative paths are resolved against the manifest's directory. Each shard
+keeps its own faiss.index, chunks and index_report.json, so adding an
+institution means building its shard and registering it once; rebuilding a
+shard needs no manifest change.
+
+``ShardSet`` stands in for both the FAISS index and the chunk list in
+query.py and serve.py (pass the manifest as ``--index``). A search fans out
+to every shard on a thread pool, since FAISS releases the GIL while
+searching, and the per-shard top-k lists are merged with a heap into one
+global ranking. Returned ids combine the shard's position in the manifest
+(high bits) with the chunk's uid within the shard (low SHARD_ID_BITS bits).
+
+Shard indexes are loaded on first use. With a memory cap, the least
+recently used idle shards are evicted to make room, so a search over more
+shards than fit in memory streams them through the cap instead of failing.
+Chunk stores are memory-mapped and stay open.
+
+Usage:
+    # Register build outputs
+    python shards.py ./shards.json --add inst_a=./inst_a_index \
+                                   --add inst_b=./inst_b_index
+
+    # List shards with their size and build
+    python shards.py ./shards.json
+
+    # Query all shards
+    python query.py --index ./shards.json --query "minimum wage effects"
+"""
+
+import os
+import sys
+import json
+import heapq
+import hashlib
+import argparse
+import threading
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+MANIFEST_VERSION = 1
+SHARD_ID_BITS = 40          # uid bits of a global id; the rest is the shard
+
+
+# ── Manifest ─────────────────────────────────────────────────────────────────
+
+def read_manifest(path: Path) -> Dict:
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f"{path}: unsupported shard manifest version "
+                         f"{manifest.get('version')}")
+    return manifest
+
+
+def is_manifest(path: Path) -> bool:
+    return path.suffix == '.json'
+
+
+def register_shard(manifest_path: Path, name: str, shard_dir: Path):
+    """Add or update shard *name* in the manifest (created if missing)."""
+    if manifest_path.exists():
+        manifest = read_manifest(manifest_path)
+    else:
+        manifest = {'version': MANIFEST_VERSION, 'shards': []}
+    if not (shard_dir / "faiss.index").exists():
+        raise ValueError(f"{shard_dir} has no faiss.index")
+    try:
+        path = os.path.relpath(shard_dir.resolve(),
+                               manifest_path.resolve().parent)
+    except ValueError:      # different drive
+        path = str(shard_dir.resolve())
+    shards = [s for s in manifest['shards'] if s['name'] != name]
+    replaced = len(shards) != len(manifest['shards'])
+    entry = {'name': name, 'path': path}
+    if replaced:
+        position = [s['name'] for s in manifest['shards']].index(name)
+        shards.insert(position, entry)
+    else:
+        shards.append(entry)
+    manifest['shards'] = shards
+    write_manifest(manifest_path, manifest)
+
+
+def write_manifest(manifest_path: Path, manifest: Dict):
+    """Replace the manifest atomically (via a temporary file)."""
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = manifest_path.with_name(manifest_path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, manifest_path)
+
+
+# ── Shards ───────────────────────────────────────────────────────────────────
+
+class Shard:
+    """One build output directory; index and chunks are loaded on demand."""
+
+    def __init__(self, name: str, path: Path):
+        self.name = name
+        self.path = path
+        self.index_path = path / "faiss.index"
+        self.chunks_path = path / "chunks.jsonl"
+        report_path = path / "index_report.json"
+        self.report = json.loads(report_path.read_text()) \
+            if report_path.exists() else {}
+        self.count = (self.report.get('stats') or {}).get('faiss_ntotal')
+        self.model = self.report.get('embedding_model')
+        self.fingerprint = self.report.get('index_fingerprint') or \
+            f"{self.index_path.stat().st_size}-{self.index_path.stat().st_mtime_ns}"
+        from chunk_store import STORE_DIRNAME
+        memory_mapped = (path / STORE_DIRNAME / "tables.json").exists()
+        self.nbytes = self.index_path.stat().st_size + (
+            0 if memory_mapped else self.chunks_path.stat().st_size
+        )
+
+        self.index = None
+        self.chunks = None
+        self.loading = False
+        self.users = 0
+        self.last_used = 0
+        self.selections: Dict = {}
+
+    def open_chunks(self):
+        if self.chunks is None:
+            from query import load_chunks
+            self.chunks = load_chunks(self.chunks_path)
+        return self.chunks
+
+    def load(self, nprobe: int = None, ef_search: int = None):
+        import faiss
+
+        index = faiss.read_index(str(self.index_path))
+        if self.count is None:
+            self.count = index.ntotal
+        elif index.ntotal != self.count:
+            raise ValueError(f"shard {self.name}: index has {index.ntotal} "
+                             f"vectors, its report says {self.count}")
+        self.configure(nprobe, ef_search, index)
+        self.open_chunks()
+        return index
+
+    def configure(self, nprobe: int = None, ef_search: int = None,
+                  index=None):
+        import faiss
+
+        index = index if index is not None else self.index
+        for name, value in (('nprobe', nprobe), ('efSearch', ef_search)):
+            if value is not None:
+                try:
+                    faiss.ParameterSpace().set_index_parameter(index, name,
+                                                               value)
+                except RuntimeError:
+                    pass    # e.g. nprobe on a flat shard
+        self.selections.clear()
+
+    def evict(self):
+        self.index = None
+        self.selections.clear()
+        if isinstance(self.chunks, list):
+            self.chunks = None
+
+
+class ShardSelection:
+    """Per-shard row masks for one filter set (see query.select); None for
+    shards searched unrestricted."""
+
+    def __init__(self, key: str, masks: Dict[str, Optional[np.ndarray]],
+                 sizes: Dict[str, int]):
+        self.key = key
+        self.masks = masks
+        self.count = int(sum(sizes[name] if m is None else m.sum()
+                             for name, m in masks.items()))
+        self.params = self
+
+
+class ShardSet:
+    """The shards of a manifest, searched as one index.
+
+    Supports the parts of the FAISS index and chunk list interfaces that
+    query.py uses: ``ntotal``, ``search(x, k, params)``, ``len()`` and
+    ``by_uid`` for global ids.
+    """
+
+    def __init__(self, manifest_path: Path, max_bytes: int = None,
+                 workers: int = None):
+        self.manifest_path = Path(manifest_path)
+        manifest = read_manifest(self.manifest_path)
+        base = self.manifest_path.parent
+        self.shards = [Shard(s['name'], base / s['path'])
+                       for s in manifest['shards']]
+        if not self.shards:
+            raise ValueError(f"{manifest_path}: no shards")
+        models = {s.model for s in self.shards if s.model}
+        if len(models) > 1:
+            raise ValueError(f"shards were embedded with different models "
+                             f"({', '.join(sorted(models))}); their scores "
+                             f"are not comparable")
+        self.max_bytes = max_bytes
+        self.workers = workers or min(len(self.shards), os.cpu_count() or 1)
+        self.nprobe = None
+        self.ef_search = None
+        self.loads = 0
+        self.evictions = 0
+        self._cond = threading.Condition()
+        self._clock = 0
+        self._pool = ThreadPoolExecutor(max_workers=self.workers)
+
+        # Shards without a row count in their report are loaded up front
+        for shard in self.shards:
+            if shard.count is None:
+                self._release(self._acquire(shard))
+        self.ntotal = sum(s.count for s in self.shards)
+        self.fingerprint = hashlib.sha256('\0'.join(
+            f"{s.name}={s.fingerprint}" for s in self.shards
+        ).encode()).hexdigest()[:16]
+
+    # ── Residency ──
+
+    def _resident_bytes(self) -> int:
+        return sum(s.nbytes for s in self.shards
+                   if s.index is not None or s.loading)
+
+    def _acquire(self, shard: Shard) -> Shard:
+        """Load *shard* if needed (evicting idle shards over the cap) and pin
+        it until _release()."""
+        with self._cond:
+            while shard.index is None:
+                if shard.loading:
+                    self._cond.wait()
+                    continue
+                resident = self._resident_bytes()
+                if self.max_bytes is None or resident == 0 or \
+                        resident + shard.nbytes <= self.max_bytes:
+                    shard.loading = True
+                    break
+                idle = [s for s in self.shards if s.index is not None
+                        and s.users == 0]
+                if idle:
+                    min(idle, key=lambda s: s.last_used).evict()
+                    self.evictions += 1
+                else:
+                    self._cond.wait()
+            else:
+                shard.users += 1
+                return shard
+
+        try:
+            index = shard.load(self.nprobe, self.ef_search)
+        except BaseException:
+            with self._cond:
+                shard.loading = False
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            shard.index = index
+            shard.loading = False
+            shard.users += 1
+            self.loads += 1
+            self._cond.notify_all()
+        return shard
+
+    def _release(self, shard: Shard):
+        with self._cond:
+            shard.users -= 1
+            self._clock += 1
+            shard.last_used = self._clock
+            self._cond.notify_all()
+
+    def configure(self, nprobe: int = None, ef_search: int = None) -> str:
+        """Search breadth for the IVF / HNSW shards (others ignore it)."""
+        with self._cond:
+            self.nprobe, self.ef_search = nprobe, ef_search
+            for shard in self.shards:
+                if shard.index is not None:
+                    shard.configure(nprobe, ef_search)
+        return ','.join(f"{name}={value}" for name, value in
+                        (('nprobe', nprobe), ('efSearch', ef_search))
+                        if value is not None)
+
+    # ── Search ──
+
+    @property
+    def tombstones(self) -> np.ndarray:
+        """Positions of shards with removed chunks awaiting compaction."""
+        from query import has_tombstones
+
+        return np.array([i for i, s in enumerate(self.shards)
+                         if has_tombstones(s.open_chunks())])
+
+    def select(self, filters: Dict, key: str) -> ShardSelection:
+        from query import has_tombstones, match_chunks
+
+        masks = {}
+        for s in self.shards:
+            chunks = s.open_chunks()
+            masks[s.name] = match_chunks(chunks, filters) \
+                if key or has_tombstones(chunks) else None
+        return ShardSelection(key, masks,
+                              {s.name: s.count for s in self.shards})
+
+    def _search_shard(self, shard: Shard, x: np.ndarray, k: int,
+                      selection: Optional[ShardSelection]):
+        from query import Selection
+
+        mask = selection.masks[shard.name] if selection else None
+        if mask is not None and not mask.any():
+            return None
+        self._acquire(shard)
+        try:
+            params = None
+            if mask is not None:
+                if selection.key not in shard.selections:
+                    shard.selections[selection.key] = Selection(
+                        shard.index, mask, shard.chunks)
+                params = shard.selections[selection.key].params
+            return shard.index.search(x, k, params=params)
+        finally:
+            self._release(shard)
+
+    def search(self, x: np.ndarray, k: int, params=None):
+        """Fan *x* out to every shard and merge the per-shard top-k.
+
+        Returns FAISS-style ``(scores, ids)`` with global ids; missing
+        results are padded with id -1.
+        """
+        # Resident shards first, so they are searched while others load
+        order = sorted(range(len(self.shards)),
+                       key=lambda i: self.shards[i].index is None)
+        futures = {i: self._pool.submit(self._search_shard, self.shards[i],
+                                        x, k, params)
+                   for i in order}
+        per_shard = [(i << SHARD_ID_BITS, futures[i].result()) for i in order]
+
+        scores = np.full((len(x), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(x), k), -1, dtype=np.int64)
+        for q in range(len(x)):
+            ranked = heapq.merge(*(
+                [(-float(s), int(i) | offset)
+                 for s, i in zip(found[0][q], found[1][q]) if i >= 0]
+                for offset, found in per_shard if found is not None
+            ))
+            for j, (neg, row) in enumerate(islice(ranked, k)):
+                scores[q, j], ids[q, j] = -neg, row
+        return scores, ids
+
+    # ── Chunks ──
+
+    def __len__(self) -> int:
+        return self.ntotal
+
+    def by_uid(self, global_id: int) -> Optional[Dict]:
+        from query import chunk_by_uid
+
+        i = global_id >> SHARD_ID_BITS
+        if not 0 <= i < len(self.shards):
+            return None
+        shard = self.shards[i]
+        chunk = chunk_by_uid(shard.open_chunks(),
+                             global_id & ((1 << SHARD_ID_BITS) - 1))
+        if chunk is None:
+            return None
+        chunk = dict(chunk)
+        chunk['shard'] = shard.name
+        return chunk
+
+    def report(self) -> Dict:
+        return {
+            'shards': len(self.shards),
+            'resident': [s.name for s in self.shards if s.index is not None],
+            'resident_bytes': self._resident_bytes(),
+            'max_bytes': self.max_bytes,
+            'loads': self.loads,
+            'evictions': self.evictions,
+        }
+
+
+def open_shards(manifest_path: Path, max_bytes: int = None,
+                workers: int = None) -> ShardSet:
+    print(f"Opening shards from {manifest_path} ...", file=sys.stderr)
+    return ShardSet(manifest_path, max_bytes, workers)
+
+
+# ── CLI ──────────────────────────────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Create, update or list a shard manifest.'
+    )
+    parser.add_argument('manifest', help='Path to the shard manifest (.json)')
+    parser.add_argument('--add', action='append', default=[],
+                        metavar='NAME=DIR',
+                        help='Register build output DIR as shard NAME '
+                             '(repeatable; replaces a shard of that name)')
+    parser.add_argument('--remove', action='append', default=[],
+                        metavar='NAME', help='Drop shard NAME (repeatable)')
+    args = parser.parse_args()
+
+    manifest_path = Path(args.manifest)
+    if not is_manifest(manifest_path):
+        parser.error("the manifest must be a .json file")
+    try:
+        for spec in args.add:
+            name, sep, shard_dir = spec.partition('=')
+            if not sep or not name:
+                parser.error(f"--add expects NAME=DIR, got {spec!r}")
+            register_shard(manifest_path, name, Path(shard_dir))
+        if args.remove:
+            manifest = read_manifest(manifest_path)
+            manifest['shards'] = [s for s in manifest['shards']
+                                  if s['name'] not in args.remove]
+            write_manifest(manifest_path, manifest)
+        shards = ShardSet(manifest_path, workers=1)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"{len(shards.shards)} shards, {shards.ntotal} vectors")
+    for s in shards.shards:
+        index_type = (s.report.get('index') or {}).get('type', 'flat')
+        print(f"  {s.name:24s} {s.count:>10d} vectors  {index_type:8s} "
+              f"{s.nbytes / 1e6:9.1f} MB  {s.path}")
+
+
+if __name__ == '__main__':
+    main()
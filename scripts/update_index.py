@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+In-Place Index Updates
+
+Appends documents to, and removes documents from, a build_index.py output
+directory without rebuilding it. Every chunk has a stable 64-bit ``uid``
+(the id stored in the FAISS IndexIDMap2 and in chunk_store/ids.npy), so
+existing chunks keep their ids across updates:
+
+    add      extract, chunk and embed only the given PDFs and append them
+             with fresh uids; a PDF whose doc_id is already indexed
+             replaces it
+    remove   tombstone the chunks of the given documents; searches skip
+             them immediately, but they stay in place until compaction
+    compact  once tombstones reach --threshold of the index, rewrite the
+             index, chunk store, chunks.jsonl, embeddings.npy and
+             doc_index.npy without them (uids are preserved)
+
+Text, chunks, embeddings and chunk-store rows are appended in place, and
+removals only record uids and rewrite the per-document metadata, so remove
+never opens the FAISS index. add does not scale with the delta alone:
+FAISS serialises whole indexes, so it rewrites faiss.index every time. It
+memory-maps the existing index rather than reading it, except for IVF
+types, whose memory-mapped lists are read-only.
+
+Usage:
+    python update_index.py add --index_dir ./index --pdf ./new/paper.pdf
+    python update_index.py add --index_dir ./index --pdf_dir ./new_pdfs
+    python update_index.py remove --index_dir ./index --doc_id withdrawn_paper
+    python update_index.py compact --index_dir ./index --threshold 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from build_index import (
+    STORE_DIRNAME, IndexVectors, add_to_index, base_index,
+    generate_embeddings, make_fingerprint, new_faiss_index, process_document,
+    _tmp_path,
+)
+from chunk_store import (
+    ChunkStore, ChunkStoreWriter, append_npy, append_store, read_tombstones,
+    replace_store, write_aliases, write_tombstones,
+)
+from doc_index import DOC_INDEX_FILENAME, doc_centroids, write_doc_index
+from encoders import load_encoder
+
+
+COMPACT_THRESHOLD = 0.2     # tombstoned fraction that triggers compaction
+UPDATE_LOG_ENTRIES = 50     # recent operations kept in index_report.json
+# FAISS reads IVF lists with IO_FLAG_MMAP as read-only on-disk lists
+MMAP_INDEX_TYPES = ('flat', 'sq_fp16', 'sq8', 'hnsw')
+
+
+# ── Build state ──────────────────────────────────────────────────────────────
+
+def load_report(index_dir: Path) -> Dict:
+    """The report of a build, checked for stable ids."""
+    with open(index_dir / "index_report.json") as f:
+        report = json.load(f)
+    if 'ids' not in report:
+        raise ValueError(f"{index_dir} was built before stable chunk ids; "
+                         f"rebuild it once with build_index.py")
+    return report
+
+
+def load_build(index_dir: Path, mmap: bool = False):
+    """The report and FAISS index of a build, checked for stable ids.
+
+    With *mmap*, index types that allow it are memory-mapped instead of
+    read into memory.
+    """
+    import faiss
+
+    report = load_report(index_dir)
+    flags = faiss.IO_FLAG_MMAP \
+        if mmap and report['index']['type'] in MMAP_INDEX_TYPES else 0
+    index = faiss.read_index(str(index_dir / "faiss.index"), flags)
+    if not hasattr(index, 'id_map'):
+        raise ValueError(f"{index_dir} was built before stable chunk ids; "
+                         f"rebuild it once with build_index.py")
+    return report, index
+
+
+def save_index(index_dir: Path, index):
+    import faiss
+
+    index_path = index_dir / "faiss.index"
+    faiss.write_index(index, str(_tmp_path(index_path)))
+    os.replace(_tmp_path(index_path), index_path)
+
+
+def rewrite_metadata(index_dir: Path, drop: set, append: List[Dict] = ()):
+    """Rewrite metadata.jsonl without documents in *drop*, plus *append*."""
+    path = index_dir / "metadata.jsonl"
+    with open(path) as src, open(_tmp_path(path), 'w') as dst:
+        for line in src:
+            if json.loads(line)['doc_id'] not in drop:
+                dst.write(line)
+        for meta in append:
+            dst.write(json.dumps(meta) + '\n')
+    os.replace(_tmp_path(path), path)
+
+
+def update_report(index_dir: Path, report: Dict, ntotal: int,
+                  operation: Dict):
+    """Record *operation* and refresh counts and the index fingerprint.
+
+    *ntotal* is the number of vectors in faiss.index, tombstoned included.
+    """
+    timestamp = datetime.utcnow().isoformat() + 'Z'
+    tombstones = len(read_tombstones(index_dir / STORE_DIRNAME))
+    with open(index_dir / "metadata.jsonl") as f:
+        docs = sum(1 for _ in f)
+
+    report['index_fingerprint'] = make_fingerprint(
+        timestamp, report['embedding_model'], ntotal
+    )
+    report['ids']['tombstones'] = tombstones
+    # chunk_count is the searchable chunks; faiss_ntotal includes tombstones
+    report['stats'].update(docs_indexed=docs,
+                           chunk_count=ntotal - tombstones,
+                           faiss_ntotal=ntotal)
+    report['storage']['index_bytes'] = (index_dir / "faiss.index").stat().st_size
+    embeddings_path = index_dir / "embeddings.npy"
+    if embeddings_path.exists():
+        report['storage']['embeddings_bytes'] = embeddings_path.stat().st_size
+    updates = report.get('updates') or []
+    updates.append({'timestamp': timestamp, **operation})
+    report['updates'] = updates[-UPDATE_LOG_ENTRIES:]
+
+    report_path = index_dir / "index_report.json"
+    with open(_tmp_path(report_path), 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(_tmp_path(report_path), report_path)
+
+    ratio = tombstones / max(ntotal, 1)
+    if ratio >= COMPACT_THRESHOLD:
+        print(f"  {tombstones} tombstoned chunks ({100 * ratio:.0f}% of the "
+              f"index); run 'update_index.py compact'")
+
+
+# ── Remove ───────────────────────────────────────────────────────────────────
+
+def tombstone_documents(index_dir: Path,
+                        doc_ids: List[str]) -> Tuple[int, set]:
+    """Tombstone the live chunks of *doc_ids* (doc_id or filename).
+
+    Aliases from --dedup builds that point into these documents are
+    dropped with them, as are the documents' own aliases. Returns the
+    number of chunks tombstoned and the doc_ids that had live chunks or
+    aliases.
+    """
+    store_path = index_dir / STORE_DIRNAME
+    store = ChunkStore(store_path)
+    try:
+        mask = store.match({'doc_id': doc_ids}, aliases=False) | \
+            store.match({'filename': doc_ids}, aliases=False)
+        uids = np.asarray(store.ids)[mask] if store.ids is not None else \
+            np.flatnonzero(mask)
+        docs = [i for i, d in enumerate(store.docs)
+                if d['doc_id'] in doc_ids or d['filename'] in doc_ids]
+        aliases = store.aliases
+        own = np.isin(aliases['doc'], docs)
+        found = set(np.unique(store.columns['doc'][mask]).tolist()) | \
+            set(np.unique(aliases['doc'][own]).tolist())
+        matched = {store.docs[i]['doc_id'] for i in found}
+        tombstones = store.tombstones
+    finally:
+        store.close()
+    if len(uids):
+        write_tombstones(store_path, np.concatenate([tombstones, uids]))
+    if len(aliases):
+        shared = np.isin(aliases['uid'], uids) & ~own
+        if shared.any():
+            print(f"  {int(shared.sum())} duplicate chunks of other documents "
+                  f"shared these vectors and are no longer searchable; "
+                  f"rebuild to restore them")
+        if own.any() or shared.any():
+            write_aliases(store_path, aliases[~(own | shared)])
+    return len(uids), matched
+
+
+def remove_documents(index_dir: Path, doc_ids: List[str]) -> Dict:
+    started = time.time()
+    report = load_report(index_dir)
+    removed, matched = tombstone_documents(index_dir, doc_ids)
+    if not matched:
+        raise ValueError(f"no indexed chunks for {', '.join(doc_ids)}")
+    rewrite_metadata(index_dir, matched)
+    operation = {'op': 'remove', 'docs': sorted(matched),
+                 'chunks_removed': removed,
+                 'seconds': round(time.time() - started, 3)}
+    update_report(index_dir, report, report['stats']['faiss_ntotal'],
+                  operation)
+    return operation
+
+
+# ── Add ──────────────────────────────────────────────────────────────────────
+
+def add_documents(index_dir: Path, pdfs: List[Path], encoder_kind: str,
+                  device: str, extract_cache: Optional[str] = None) -> Dict:
+    """Extract, chunk and embed *pdfs* and append them to the build.
+
+    Nothing is written until the new chunks are embedded, so a model
+    mismatch or an encoding failure leaves the build as it was; only then
+    are earlier copies of the documents tombstoned and replaced.
+    """
+    started = time.time()
+    report, index = load_build(index_dir, mmap=True)
+    chunking = report['chunking']
+
+    chunks: List[Dict] = []
+    metas: List[Dict] = []
+    for pdf_path in pdfs:
+        result = process_document(pdf_path, chunking['target'],
+                                  chunking['overlap'], chunking['min'],
+                                  extract_cache=extract_cache)
+        if result['meta'] is None:
+            print(f"  ERROR processing {pdf_path.name}: {result['error']}")
+            continue
+        print(f"  {pdf_path.name}: {len(result['chunks'])} chunks")
+        metas.append(result['meta'])
+        chunks.extend(result['chunks'])
+
+    if chunks:
+        encoder = load_encoder(encoder_kind, device)
+        try:
+            if encoder.name != report['embedding_model']:
+                raise ValueError(f"the index was built with "
+                                 f"{report['embedding_model']}, not "
+                                 f"{encoder.name}")
+            embeddings = generate_embeddings(chunks, encoder)
+        finally:
+            encoder.close()
+
+    # Re-adding a document replaces it
+    doc_ids = [m['doc_id'] for m in metas]
+    replaced, _ = tombstone_documents(index_dir, doc_ids)
+
+    next_uid = report['ids']['next_uid']
+    uids = np.arange(next_uid, next_uid + len(chunks), dtype=np.int64)
+    for chunk, uid in zip(chunks, uids):
+        chunk['uid'] = int(uid)
+
+    if chunks:
+        n_rows = index.ntotal
+        add_to_index(index, embeddings, uids)
+        embeddings_path = index_dir / "embeddings.npy"
+        if embeddings_path.exists():
+            append_npy(embeddings_path, embeddings)
+        with open(index_dir / "chunks.jsonl", 'a') as f:
+            for chunk in chunks:
+                f.write(json.dumps(chunk) + '\n')
+        append_store(index_dir / STORE_DIRNAME, chunks)
+        doc_index_path = index_dir / DOC_INDEX_FILENAME
+        if doc_index_path.exists():
+            ranges = np.load(index_dir / STORE_DIRNAME / "doc_ranges.npy")
+            ranges = ranges[ranges['start'] >= n_rows]
+            ranges['start'] -= n_rows
+            ranges['end'] -= n_rows
+            append_npy(doc_index_path, doc_centroids(embeddings, ranges))
+        save_index(index_dir, index)
+        report['ids']['next_uid'] = int(next_uid + len(chunks))
+    rewrite_metadata(index_dir, set(doc_ids), metas)
+
+    operation = {'op': 'add', 'docs': doc_ids, 'chunks_added': len(chunks),
+                 'chunks_replaced': replaced,
+                 'seconds': round(time.time() - started, 3)}
+    update_report(index_dir, report, index.ntotal, operation)
+    return operation
+
+
+# ── Compact ──────────────────────────────────────────────────────────────────
+
+def compact(index_dir: Path, threshold: float = COMPACT_THRESHOLD,
+            force: bool = False) -> Dict:
+    """Drop tombstoned chunks from every artifact, keeping uids."""
+    import faiss
+
+    started = time.time()
+    report, index = load_build(index_dir)
+    store_path = index_dir / STORE_DIRNAME
+    store = ChunkStore(store_path)
+    tombstones = store.tombstones
+    ratio = len(tombstones) / max(index.ntotal, 1)
+    if not len(tombstones) or (ratio < threshold and not force):
+        store.close()
+        print(f"  {len(tombstones)} tombstones ({100 * ratio:.1f}% of "
+              f"{index.ntotal}); below the {100 * threshold:.0f}% threshold")
+        return {'op': 'compact', 'skipped': True}
+
+    live = np.flatnonzero(store.live_mask())
+    uids = np.asarray(store.ids)[live] if store.ids is not None else live
+    embeddings_path = index_dir / "embeddings.npy"
+    vectors = np.load(embeddings_path, mmap_mode='r') \
+        if embeddings_path.exists() else IndexVectors(index)
+    print(f"Compacting {index_dir}: dropping {len(tombstones)} of "
+          f"{index.ntotal} chunks ...")
+
+    keep_rows = set(live.tolist())
+    # Chunk store and chunks.jsonl, row for row
+    with ChunkStoreWriter(_tmp_path(store_path)) as writer:
+        for row in live:
+            writer.add(store[int(row)])
+        for uid in np.unique(store.aliases['uid']):
+            if store.row_of(int(uid)) in keep_rows:
+                for source in store.aliases_of(int(uid)):
+                    writer.add_alias(int(uid), source, source['similarity'])
+    chunks_path = index_dir / "chunks.jsonl"
+    with open(chunks_path) as src, open(_tmp_path(chunks_path), 'w') as dst:
+        for row, line in enumerate(src):
+            if row in keep_rows:
+                dst.write(line)
+    store.close()
+
+    # Index: remove in place, except HNSW, which cannot remove vectors, and
+    # IVF, whose lists keep the old row numbers that IndexIDMap2 would then
+    # map to the wrong uids. Both are refilled from the surviving vectors;
+    # IVF keeps its trained quantizer.
+    inner = base_index(index)
+    if hasattr(inner, 'hnsw') or hasattr(inner, 'invlists'):
+        if hasattr(inner, 'hnsw'):
+            rebuilt = new_faiss_index('hnsw', report['index'])
+        else:
+            trained = faiss.clone_index(inner)
+            trained.reset()
+            rebuilt = faiss.IndexIDMap2(trained)
+        for start in range(0, len(live), 4096):
+            rows = live[start:start + 4096]
+            add_to_index(rebuilt, vectors[rows], uids[start:start + 4096])
+        index = rebuilt
+    else:
+        index.remove_ids(faiss.IDSelectorBatch(tombstones))
+
+    if embeddings_path.exists():
+        from numpy.lib.format import open_memmap
+        tmp = _tmp_path(embeddings_path)
+        out = open_memmap(tmp, mode='w+', dtype=np.float16,
+                          shape=(len(live), vectors.shape[1]))
+        for start in range(0, len(live), 4096):
+            out[start:start + 4096] = vectors[live[start:start + 4096]]
+        out.flush()
+        del out, vectors
+
+    save_index(index_dir, index)
+    if embeddings_path.exists():
+        os.replace(_tmp_path(embeddings_path), embeddings_path)
+    os.replace(_tmp_path(chunks_path), chunks_path)
+    replace_store(_tmp_path(store_path), store_path)
+
+    # Document ranges were renumbered; pool them again from the survivors
+    doc_index_path = index_dir / DOC_INDEX_FILENAME
+    if doc_index_path.exists():
+        vectors = np.load(embeddings_path, mmap_mode='r') \
+            if embeddings_path.exists() else IndexVectors(index)
+        centroids = doc_centroids(
+            vectors, np.load(store_path / "doc_ranges.npy"))
+        write_doc_index(_tmp_path(doc_index_path), centroids)
+        os.replace(_tmp_path(doc_index_path), doc_index_path)
+
+    operation = {'op': 'compact', 'chunks_dropped': int(len(tombstones)),
+                 'chunks_kept': int(len(live)),
+                 'seconds': round(time.time() - started, 3)}
+    update_report(index_dir, report, index.ntotal, operation)
+    return operation
+
+
+# ── CLI ──────────────────────────────────────────────────────────────────────
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Append to, remove from or compact a built index.'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add = commands.add_parser('add', help='Append (or replace) documents')
+    add.add_argument('--pdf', action='append', default=[],
+                     help='PDF to add (repeatable)')
+    add.add_argument('--pdf_dir', help='Add every PDF in this directory')
+    add.add_argument('--encoder', choices=['e5', 'stub'], default='e5',
+                     help='Must match the build (default: e5)')
+    add.add_argument('--device', choices=['auto', 'cuda', 'cpu'],
+                     default='auto')
+    add.add_argument('--extract_cache',
+                     help='Extraction cache directory (see build_index.py)')
+
+    remove = commands.add_parser('remove', help='Tombstone documents')
+    remove.add_argument('--doc_id', action='append', required=True,
+                        help='doc_id or PDF filename to remove (repeatable)')
+
+    comp = commands.add_parser('compact', help='Drop tombstoned chunks')
+    comp.add_argument('--threshold', type=float, default=COMPACT_THRESHOLD,
+                      help='Compact once this fraction of the index is '
+                           f'tombstoned (default: {COMPACT_THRESHOLD})')
+    comp.add_argument('--force', action='store_true',
+                      help='Compact regardless of the threshold')
+
+    for sub in (add, remove, comp):
+        sub.add_argument('--index_dir', required=True,
+                         help='build_index.py output directory')
+    args = parser.parse_args()
+
+    index_dir = Path(args.index_dir)
+    try:
+        if args.command == 'add':
+            pdfs = [Path(p) for p in args.pdf]
+            if args.pdf_dir:
+                pdfs += sorted(Path(args.pdf_dir).glob("*.pdf"))
+            if not pdfs:
+                parser.error("add needs --pdf or --pdf_dir")
+            result = add_documents(index_dir, pdfs, args.encoder, args.device,
+                                   args.extract_cache)
+        elif args.command == 'remove':
+            result = remove_documents(index_dir, args.doc_id)
+        else:
+            result = compact(index_dir, args.threshold, args.force)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}", file=sys.stderr)
+        sys.exit(1)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()